@@ -0,0 +1,3 @@
+from sandbox.report import progress
+
+__all__ = ["progress"]
@@ -0,0 +1,32 @@
+from sandbox import serializer
+
+from pathlib import Path
+from typing import Any, Optional
+
+# one json event per line, the server tails this file while the tool runs
+PROGRESS_FILE = "progress.jsonl"
+
+directory: Optional[Path] = None
+
+
+def start(workdir: Path):
+    global directory
+    directory = workdir
+
+
+def emit(event: dict):
+    # outside of a run (a tool tested by hand) progress is dropped
+    if directory is None:
+        return
+
+    line = serializer.dumps(event, directory=directory)
+    with open(directory / PROGRESS_FILE, "a") as f:
+        f.write(line + "\n")
+
+
+def progress(fraction: float, message: str = ""):
+    emit({"progress": min(max(float(fraction), 0.0), 1.0), "message": str(message)})
+
+
+def partial(result: Any):
+    emit({"partial": result})
@@ -1,20 +1,17 @@
-from sandbox import serializer
+from sandbox import serializer, report
 
-from typing import Any, Callable
+from typing import Any, Callable, Generator
 from functools import partial
 from pathlib import Path
 import importlib.util
+import inspect
 import traceback
+import json
 import sys
 import os
 
 
-def runner(file: Path, workdir: Path) -> Any:
-    os.chdir(workdir)
-
-    with open("args.json", "r") as f:
-        args = serializer.load(f)
-
+def load_entrypoint(file: Path) -> Callable[..., Any]:
     module_name = file.stem
     spec = importlib.util.spec_from_file_location(module_name, file)
     module = importlib.util.module_from_spec(spec)
@@ -23,10 +20,32 @@ def runner(file: Path, workdir: Path) -> Any:
     if not hasattr(module, module_name):
         raise ValueError(f"no function named: {module_name}")
 
-    func: Callable[[Any], Any] = getattr(module, module_name, None)
+    return getattr(module, module_name, None)
+
+
+def drain(generator: Generator) -> Any:
+    # every yield is reported as it is made, the result is the return value or every yielded value
+    partials = []
+    while True:
+        try:
+            value = next(generator)
+        except StopIteration as stop:
+            return partials if stop.value is None else stop.value
+        report.partial(value)
+        partials.append(value)
+
+
+def run_entrypoint(func: Callable[..., Any], file: Path, workdir: Path):
+    os.chdir(workdir)
+    report.start(workdir)
+
+    with open("args.json", "r") as f:
+        args = serializer.load(f)
 
     try:
         results = partial(func, **args)()
+        if inspect.isgenerator(results):
+            results = drain(results)
     except Exception as e:
         _, _, exc_traceback = sys.exc_info()
         frames = traceback.extract_tb(exc_traceback)
@@ -43,17 +62,89 @@ def runner(file: Path, workdir: Path) -> Any:
         serializer.dump(results, f)
 
 
+def runner(file: Path, workdir: Path) -> Any:
+    os.chdir(workdir)
+    run_entrypoint(load_entrypoint(file), file, workdir)
+
+
+def batch(file: Path, workdir: Path):
+    # the module is imported once, every item runs in its own directory with its own args.json
+    os.chdir(workdir)
+    func = load_entrypoint(file)
+
+    with open("batch.json", "r") as f:
+        items = json.load(f)
+
+    for item in items:
+        run_entrypoint(func, file, workdir / item)
+
+
+def zygote(preload: list[str]):
+    # protocol: one json job per line on stdin, one json status per line on stdout
+    # tool output is redirected to stderr so it can not corrupt the protocol
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w", buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"preload failed: {name} {type(e).__name__}", file=sys.stderr)
+
+    protocol.write(json.dumps({"ready": True}) + "\n")
+
+    for line in sys.stdin:
+        job = json.loads(line)
+
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run = batch if job.get("batch") else runner
+                run(Path(job["file"]), Path(job["workdir"]))
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        # the rusage of the child alone, the zygote's own preload is not counted as cpu time
+        _, status, usage = os.wait4(pid, 0)
+        exit_report = {
+            "status": os.waitstatus_to_exitcode(status),
+            "cpu": usage.ru_utime + usage.ru_stime,
+            "rss": usage.ru_maxrss,
+        }
+        protocol.write(json.dumps(exit_report) + "\n")
+
+
 def main():
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--file", "-f", type=str, required=True)
-    parser.add_argument("--workdir", "-w", type=str, required=True)
+    parser.add_argument("--file", "-f", type=str)
+    parser.add_argument("--workdir", "-w", type=str)
+    parser.add_argument("--batch", "-b", action="store_true")
+    parser.add_argument("--zygote", "-z", action="store_true")
+    parser.add_argument("--preload", "-p", type=str, default="")
     args = parser.parse_args()
 
+    if args.zygote:
+        zygote([name for name in args.preload.split(",") if name])
+        return
+
+    if args.file is None or args.workdir is None:
+        parser.error("--file and --workdir are required")
+
     file = Path(args.file)
     workdir = Path(args.workdir)
 
+    if args.batch:
+        batch(file, workdir)
+        return
+
     runner(file, workdir)
 
 
@@ -1,17 +1,85 @@
 from pathlib import Path, PosixPath
-from typing import Any
+from typing import Any, Optional
+import itertools
+import base64
 import json
+import sys
 import io
 
+# result format, keep in sync with app/utility/serializer.py on the server
+# version 1 is plain json, version 2 wraps the tree in an envelope and writes
+# bytes and arrays above SIDE_FILE_BYTES as raw side files next to the result
+FORMAT_VERSION = 2
+SIDE_FILE_BYTES = 1 << 16
+
+# partial results and the final result share a directory, side file names never repeat
+side_file_names = (f"result-{n}.bin" for n in itertools.count())
+
 
 class JsonEncoder(json.JSONEncoder):
+    def __init__(self, *args, directory: Optional[Path] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.directory = directory
+
     def default(self, obj):
         if isinstance(obj, set):
             return list(obj)
+
         if isinstance(obj, (Path, PosixPath)):
             return {"__path__": str(obj.absolute())}
+
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            return self.encode_bytes(bytes(obj))
+
+        # numpy and pandas are only looked up, a tool that never imported them can not return them
+        numpy = sys.modules.get("numpy")
+        if numpy is not None:
+            if isinstance(obj, numpy.generic):
+                return obj.item()
+            if isinstance(obj, numpy.ndarray):
+                return self.encode_array(numpy, obj)
+
+        pandas = sys.modules.get("pandas")
+        if pandas is not None:
+            if isinstance(obj, pandas.DataFrame):
+                columns = {str(name): obj[name].to_numpy() for name in obj.columns}
+                return {"__dataframe__": {"index": obj.index.to_numpy(), "columns": columns}}
+            if isinstance(obj, pandas.Series):
+                return {"__series__": {"name": str(obj.name), "index": obj.index.to_numpy(), "data": obj.to_numpy()}}
+
         return super().default(obj)
 
+    def side_file(self, data: Any) -> Path:
+        if self.directory is None:
+            raise TypeError("side files need a result directory")
+
+        path = (self.directory / next(side_file_names)).absolute()
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def encode_bytes(self, data: bytes) -> dict:
+        if len(data) <= SIDE_FILE_BYTES or self.directory is None:
+            return {"__bytes__": base64.b64encode(data).decode()}
+
+        path = self.side_file(data)
+        return {"__binary__": {"path": {"__path__": str(path)}, "kind": "bytes", "dtype": "|u1", "shape": [len(data)]}}
+
+    def encode_array(self, numpy: Any, array: Any) -> Any:
+        # object arrays and small arrays stay readable json
+        if array.dtype.hasobject or array.nbytes <= SIDE_FILE_BYTES or self.directory is None:
+            return array.tolist()
+
+        array = numpy.ascontiguousarray(array)
+        path = self.side_file(memoryview(array).cast("B"))
+        binary = {
+            "path": {"__path__": str(path)},
+            "kind": "ndarray",
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+        }
+        return {"__binary__": binary}
+
 
 class JsonDecoder(json.JSONDecoder):
     def __init__(self, *args, **kwargs):
@@ -20,20 +88,37 @@ class JsonDecoder(json.JSONDecoder):
     def object_hook(self, obj):
         if "__path__" in obj:
             return Path(obj["__path__"])
+        if "__bytes__" in obj:
+            return base64.b64decode(obj["__bytes__"])
         return obj
 
 
-def dumps(objects: Any) -> str:
-    return json.dumps(objects, cls=JsonEncoder)
+def envelope(objects: Any) -> dict:
+    return {"__format__": FORMAT_VERSION, "result": objects}
+
+
+def unwrap(objects: Any) -> Any:
+    if not isinstance(objects, dict) or "__format__" not in objects:
+        return objects
+    if objects["__format__"] > FORMAT_VERSION:
+        raise ValueError(f"unsupported result format {objects['__format__']}")
+    return objects["result"]
+
+
+def dumps(objects: Any, directory: Optional[Path] = None) -> str:
+    return json.dumps(envelope(objects), cls=JsonEncoder, directory=directory)
 
 
 def loads(serial: str) -> Any:
-    return json.loads(serial, cls=JsonDecoder)
+    return unwrap(json.loads(serial, cls=JsonDecoder))
 
 
 def dump(objects: Any, file: io.FileIO) -> str:
-    json.dump(objects, file, cls=JsonEncoder)
+    # side files are written next to the result file
+    directory = Path(file.name).parent if isinstance(getattr(file, "name", None), str) else None
+    # dumps takes the c encoder, dump would fall back to the pure python one
+    file.write(json.dumps(envelope(objects), cls=JsonEncoder, directory=directory))
 
 
 def load(file: io.FileIO) -> Any:
-    return json.load(file, cls=JsonDecoder)
+    return unwrap(json.load(file, cls=JsonDecoder))
@@ -15,9 +15,10 @@ class _ENVIRONMENT:
     DATABASE: str = os.environ.get("DATABASE")
     SANDBOX: str = os.environ.get("SANDBOX")
 
-    def __post_init__(self):
-        for name, value in self.__dict__.items():
-            if value is None:
+    def check(self, *names: str):
+        # the web server needs every variable, a sandbox worker node only SANDBOX
+        for name in names or self.__dict__:
+            if getattr(self, name) is None:
                 raise ValueError(f"Missing environment variable: {name}")
 
     @property
@@ -25,7 +26,58 @@ class _ENVIRONMENT:
         return f"https://accounts.google.com/o/oauth2/auth?response_type=code&client_id={self.GOOGLE_CLIENT_ID}&redirect_uri={self.GOOGLE_REDIRECT_URI}&scope=openid%20profile%20email&access_type=online"
 
 
+@dataclass
+class _SETTINGS:
+    DB_THREADS: int = int(os.environ.get("DB_THREADS", "4"))
+    DB_BUSY_TIMEOUT: float = float(os.environ.get("DB_BUSY_TIMEOUT", "5"))
+    WEB_WORKERS: int = int(os.environ.get("WEB_WORKERS", "1"))
+    STATE_DIRECTORY: Path = Path(os.environ.get("STATE_DIRECTORY", "/tmp/pytools-state"))
+    TOOL_CACHE_SIZE: int = int(os.environ.get("TOOL_CACHE_SIZE", "256"))
+    TOOL_CACHE_POLL: float = float(os.environ.get("TOOL_CACHE_POLL", "1"))
+    COUNTER_FLUSH_INTERVAL: float = float(os.environ.get("COUNTER_FLUSH_INTERVAL", "5"))
+    RUN_HISTORY_AGE: float = float(os.environ.get("RUN_HISTORY_AGE", str(30 * 24 * 60 * 60)))
+    RUN_HISTORY_DOWNSAMPLE_AGE: float = float(os.environ.get("RUN_HISTORY_DOWNSAMPLE_AGE", str(7 * 24 * 60 * 60)))
+    RUN_HISTORY_DOWNSAMPLE: int = int(os.environ.get("RUN_HISTORY_DOWNSAMPLE", "10"))
+    POOL_SIZE: int = int(os.environ.get("POOL_SIZE", "5"))
+    POOL_LANES: tuple[tuple[str, int], ...] = tuple(
+        (name, int(size))
+        for name, _, size in (lane.partition("=") for lane in os.environ.get("POOL_LANES", "").split(",") if lane)
+    )
+    LANE_HEAVY_SECONDS: float = float(os.environ.get("LANE_HEAVY_SECONDS", "5"))
+    LANE_HISTORY_AGE: float = float(os.environ.get("LANE_HISTORY_AGE", str(24 * 60 * 60)))
+    WORKER_TOKEN: str = os.environ.get("WORKER_TOKEN", "")
+    WORKER_TIMEOUT: float = float(os.environ.get("WORKER_TIMEOUT", "15"))
+    POOL_RECYCLE_TIMEOUT: float = float(os.environ.get("POOL_RECYCLE_TIMEOUT", "10"))
+    POOL_RETRY_DELAY: float = float(os.environ.get("POOL_RETRY_DELAY", "30"))
+    POOL_MAX_QUEUE: int = int(os.environ.get("POOL_MAX_QUEUE", "20"))
+    JOBS_DIRECTORY: Path = Path(os.environ.get("JOBS_DIRECTORY", "/tmp/pytools"))
+    JOBS_TTL: float = float(os.environ.get("JOBS_TTL", "600"))
+    JOBS_QUOTA_BYTES: int = int(os.environ.get("JOBS_QUOTA_BYTES", str(4 * 1024 * 1024 * 1024)))
+    JOBS_MIN_FREE_BYTES: int = int(os.environ.get("JOBS_MIN_FREE_BYTES", str(512 * 1024 * 1024)))
+    JOBS_DRAIN_TIMEOUT: float = float(os.environ.get("JOBS_DRAIN_TIMEOUT", "30"))
+    SANDBOX_BACKEND: str = os.environ.get("SANDBOX_BACKEND", "isolate")
+    SANDBOX_DIRECTORY: Path = Path(os.environ.get("SANDBOX_DIRECTORY", "/tmp/pytools-boxes"))
+    SANDBOX_CGROUP: Path = Path(os.environ.get("SANDBOX_CGROUP", "/sys/fs/cgroup/pytools"))
+    SANDBOX_UNISOLATED: bool = os.environ.get("SANDBOX_UNISOLATED", "0") == "1"
+    SANDBOX_PRELOAD: tuple[str, ...] = tuple(filter(None, os.environ.get("SANDBOX_PRELOAD", "").split(",")))
+    PRELOAD_TIMEOUT: float = float(os.environ.get("PRELOAD_TIMEOUT", "60"))
+    PRELOAD_IDLE_TIME: int = int(os.environ.get("PRELOAD_IDLE_TIME", "3600"))
+    RESULT_CACHE_DIRECTORY: Path = Path(os.environ.get("RESULT_CACHE_DIRECTORY", "/tmp/pytools-cache"))
+    RESULT_CACHE_SIZE: int = int(os.environ.get("RESULT_CACHE_SIZE", "0"))
+    RESULT_CACHE_AGE: float = float(os.environ.get("RESULT_CACHE_AGE", "86400"))
+    RESULT_PREVIEW_CHARS: int = int(os.environ.get("RESULT_PREVIEW_CHARS", "65536"))
+    RESULT_PREVIEW_ITEMS: int = int(os.environ.get("RESULT_PREVIEW_ITEMS", "100"))
+    RESULT_PREVIEW_STRING: int = int(os.environ.get("RESULT_PREVIEW_STRING", "4096"))
+    BATCH_MAX_ITEMS: int = int(os.environ.get("BATCH_MAX_ITEMS", "20"))
+    PIPELINE_MAX_STEPS: int = int(os.environ.get("PIPELINE_MAX_STEPS", "8"))
+    UPLOAD_MAX_FILE_BYTES: int = int(os.environ.get("UPLOAD_MAX_FILE_BYTES", str(256 * 1024 * 1024)))
+    UPLOAD_MAX_REQUEST_BYTES: int = int(os.environ.get("UPLOAD_MAX_REQUEST_BYTES", str(512 * 1024 * 1024)))
+    DOWNLOAD_ACCEL_PREFIX: str = os.environ.get("DOWNLOAD_ACCEL_PREFIX", "")
+    ADMIN_USERS: tuple[int, ...] = tuple(int(id) for id in os.environ.get("ADMIN_USERS", "").split(",") if id)
+
+
 ENVIRONMENT = _ENVIRONMENT()
+SETTINGS = _SETTINGS()
 
 ALLOWED_CHARACTERS = string.ascii_letters + string.digits + "-_"
 APP_DIRECTORY = Path(__file__).parent
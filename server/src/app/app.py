@@ -6,13 +6,18 @@ from fastapi import FastAPI
 from pathlib import Path
 
 from app.models.tools import create_db_and_tables
-from app.routes import tools, auth, upload, user
-from app import logger, ENVIRONMENT
+from app.routes import tools, auth, upload, user, jobs, batch, pipeline, workers
+from app.utility import processes
+from app import logger, ENVIRONMENT, SETTINGS
+
+ENVIRONMENT.check()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    create_db_and_tables()
+    # web processes start together, one at a time creates and migrates the schema
+    with processes.file_lock(SETTINGS.STATE_DIRECTORY / "schema.lock"):
+        create_db_and_tables()
     yield
 
 
@@ -25,6 +30,10 @@ app.mount("/webfonts", StaticFiles(directory=APP_DIRECTORY / "webfonts"), name="
 app.include_router(upload.router)
 app.include_router(auth.router)
 app.include_router(tools.router)
+app.include_router(jobs.router)
+app.include_router(batch.router)
+app.include_router(pipeline.router)
+app.include_router(workers.router)
 app.include_router(user.router)
 app.add_middleware(SessionMiddleware, secret_key=ENVIRONMENT.SESSION_KEY)
 
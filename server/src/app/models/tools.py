@@ -1,5 +1,8 @@
 from fastapi import Depends, HTTPException
-from typing import Annotated, Optional, Any
+from typing import Annotated, Optional, Any, Callable, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from sqlalchemy import event
 from profanityfilter import ProfanityFilter
 import pyparsing as pp
 from sqlmodel import (
@@ -11,18 +14,48 @@ from sqlmodel import (
     Relationship,
     JSON,
     Column,
+    text,
+    func,
 )
 import hashlib
 import logging
+import asyncio
 import ast
 
-from app import ENVIRONMENT
+from app.utility import schema
+from app import ENVIRONMENT, SETTINGS
 
 logger = logging.getLogger("uvicorn.error")
 
 sqlite_url = f"sqlite:///{ENVIRONMENT.DATABASE}"
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+connect_args = {"check_same_thread": False, "timeout": SETTINGS.DB_BUSY_TIMEOUT}
+engine = create_engine(
+    sqlite_url,
+    connect_args=connect_args,
+    pool_size=SETTINGS.DB_THREADS,
+    max_overflow=SETTINGS.DB_THREADS,
+    pool_timeout=SETTINGS.DB_BUSY_TIMEOUT,
+)
+
+# queries from async routes run here, never on the event loop
+executor = ThreadPoolExecutor(max_workers=SETTINGS.DB_THREADS, thread_name_prefix="database")
+
+T = TypeVar("T")
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # wal lets readers continue while a write transaction is open
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(SETTINGS.DB_BUSY_TIMEOUT * 1000)}")
+    cursor.close()
+
+
+async def run_sync(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
 
 
 def hash_id(id: str) -> int:
@@ -45,6 +78,7 @@ class Tool(SQLModel, table=True):
     name: str
     code: str
     arguments: dict[str, tuple[str, str]] = Field(default={}, sa_column=Column(JSON))
+    argument_schema: Optional[dict[str, dict]] = Field(default=None, sa_column=Column(JSON))
     tags: list[str] = Field(default={}, sa_column=Column(JSON))
     up_votes: list["UpVote"] = Relationship(back_populates="tool")
     down_votes: list["DownVote"] = Relationship(back_populates="tool")
@@ -52,11 +86,40 @@ class Tool(SQLModel, table=True):
     usage: int = Field(default=0)
     # fails: int = Field(default=0)
     public: bool = Field(default=False)
+    # set by an admin, otherwise the lane follows the tool's measured runtime
+    lane: Optional[str] = Field(default=None)
     annonymous: bool = Field(default=True)
     user_id: int = Field(default=None, foreign_key="user.id")
     user: User = Relationship(back_populates="tools")
 
 
+# bumped on every change to a tool, other workers poll it to drop stale cached metadata
+class ToolVersion(SQLModel, table=True):
+    tool_id: int = Field(primary_key=True)
+    version: int = Field(default=0, index=True)
+
+
+# one row per sandbox run, durations in seconds and memory in KiB
+# old successful runs are downsampled, a kept row stands for weight runs
+class RunRecord(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    created: float = Field(index=True)
+    tool_id: int = Field(index=True)
+    code_hash: str
+    args_hash: str
+    items: int = Field(default=1)
+    queue_wait: float
+    init: float
+    run: float
+    cleanup: Optional[float] = None
+    cpu: Optional[float] = None
+    rss: Optional[int] = None
+    exit_status: Optional[int] = None
+    status: str
+    output_bytes: int
+    weight: int = Field(default=1)
+
+
 class UpVote(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id")
@@ -95,31 +158,73 @@ def get_user(session: Session, id: int) -> User:
 
 def get_tools_by_index(
     session: Session,
-    start: int,
-    end: int,
+    after: int,
+    limit: int,
     only_public: bool = True,
 ) -> list[tuple[int, str]]:
     with session:
-        conditions = []
+        conditions = [Tool.id > after]
         if only_public:
-            conditions = [Tool.public == True]
-        statement = select(Tool.id, Tool.name).where(*conditions).offset(start).limit(end - start)
+            conditions.append(Tool.public == True)
+        statement = select(Tool.id, Tool.name).where(*conditions).order_by(Tool.id).limit(limit)
         return session.exec(statement).all()
 
 
+def search_query(tags: list[str]) -> str:
+    # every term is quoted, user input can not inject fts5 query syntax
+    return " ".join('"' + tag.replace('"', '""') + '"*' for tag in tags)
+
+
 def get_tools_by_tags(
     session: Session,
     tags: list[str],
-    start: int,
-    end: int,
+    after: int,
+    limit: int,
     only_public: bool = True,
-) -> list[Tool]:
+) -> list[tuple[int, str]]:
+    public = "AND tool.public = 1" if only_public else ""
+    statement = text(
+        f"""
+        SELECT tool.id, tool.name FROM tool_search
+        JOIN tool ON tool.id = tool_search.rowid
+        WHERE tool_search MATCH :query AND tool.id > :after {public}
+        ORDER BY tool.id LIMIT :limit
+        """
+    )
     with session:
-        conditions = [Tool.tags.ilike(f"%{tag}%") for tag in tags]
-        if only_public:
-            conditions.append(Tool.public == True)
-        statement = select(Tool.id, Tool.name).where(*conditions).offset(start).limit(end - start)
-        return session.exec(statement).all()
+        params = {"query": search_query(tags), "after": after, "limit": limit}
+        return [tuple(row) for row in session.exec(statement, params=params).all()]
+
+
+def get_docstrings(tool_name: str, tool_source: str) -> str:
+    try:
+        tree = ast.parse(tool_source)
+    except SyntaxError:
+        return ""
+
+    docstrings = [ast.get_docstring(tree) or ""]
+    for node in FunctionVisitor(tree):
+        if node.name == tool_name:
+            docstrings.append(ast.get_docstring(node) or "")
+
+    return "\n".join(filter(None, docstrings))
+
+
+def index_tool(session: Session, tool: Tool):
+    unindex_tool(session, tool.id)
+    statement = text("INSERT INTO tool_search (rowid, name, tags, docstring) VALUES (:id, :name, :tags, :docstring)")
+    params = {
+        "id": tool.id,
+        "name": tool.name.replace("_", " ") + " " + tool.name,
+        "tags": " ".join(tool.tags),
+        "docstring": get_docstrings(tool.name, tool.code),
+    }
+    session.exec(statement, params=params)
+    session.commit()
+
+
+def unindex_tool(session: Session, tool_id: int):
+    session.exec(text("DELETE FROM tool_search WHERE rowid = :id"), params={"id": tool_id})
 
 
 def get_user_tools(session: Session, user: User) -> list[Tool]:
@@ -142,6 +247,7 @@ def get_tool(session: Session, id: Optional[int]):
 def del_tool(session: Session, tool: Tool):
     if not tool:
         return False
+    unindex_tool(session, tool.id)
     session.delete(tool)
     session.commit()
     return True
@@ -154,9 +260,121 @@ def get_tool_by_id(session: Session, tool_id: int) -> Tool | None:
     return result
 
 
+def flush_counters(session: Session, usage: dict[int, int], votes: list[SQLModel]):
+    statement = text("UPDATE tool SET usage = usage + :count WHERE id = :id")
+    for tool_id, count in usage.items():
+        session.exec(statement, params={"id": tool_id, "count": count})
+    session.add_all(votes)
+    session.commit()
+
+
+def get_tool_usage(session: Session, tool_id: int) -> int:
+    return session.exec(select(Tool.usage).where(Tool.id == tool_id)).first() or 0
+
+
+def bump_tool_version(session: Session, tool_id: int):
+    # one statement, concurrent writers can not hand out the same version
+    statement = text(
+        """
+        INSERT INTO toolversion (tool_id, version)
+        VALUES (:id, (SELECT coalesce(max(version), 0) + 1 FROM toolversion))
+        ON CONFLICT (tool_id) DO UPDATE SET version = excluded.version
+        """
+    )
+    session.exec(statement, params={"id": tool_id})
+    session.commit()
+
+
+def get_tool_versions(session: Session, after: int) -> list[tuple[int, int]]:
+    with session:
+        statement = select(ToolVersion.tool_id, ToolVersion.version).where(ToolVersion.version > after)
+        return [tuple(row) for row in session.exec(statement).all()]
+
+
+def get_latest_tool_version(session: Session) -> int:
+    with session:
+        return session.exec(select(func.max(ToolVersion.version))).one() or 0
+
+
+def add_run_records(session: Session, records: list[RunRecord]):
+    session.add_all(records)
+    session.commit()
+
+
+def prune_run_records(session: Session, expire_before: float, downsample_before: float, keep_every: int):
+    session.exec(text("DELETE FROM runrecord WHERE created < :before"), params={"before": expire_before})
+
+    # failed runs are rare and interesting, they are never downsampled
+    if keep_every > 1:
+        params = {"before": downsample_before, "every": keep_every}
+        sampled = "created < :before AND weight = 1 AND status = 'OK' AND exit_status = 0"
+        session.exec(text(f"DELETE FROM runrecord WHERE {sampled} AND id % :every != 0"), params=params)
+        session.exec(text(f"UPDATE runrecord SET weight = :every WHERE {sampled}"), params=params)
+    session.commit()
+
+
+def get_run_summary(session: Session, since: float, limit: int) -> list[dict]:
+    statement = text(
+        """
+        SELECT tool_id,
+            sum(weight) AS runs,
+            sum(weight * (status != 'OK' OR exit_status != 0)) AS failures,
+            sum(weight * coalesce(cpu, 0)) AS cpu,
+            sum(weight * run) AS run,
+            sum(weight * run) / sum(weight) AS mean_run,
+            sum(weight * queue_wait) / sum(weight) AS mean_queue_wait,
+            max(rss) AS max_rss,
+            sum(weight * output_bytes) AS output_bytes
+        FROM runrecord WHERE created >= :since
+        GROUP BY tool_id ORDER BY cpu DESC, run DESC LIMIT :limit
+        """
+    )
+    with session:
+        rows = session.exec(statement, params={"since": since, "limit": limit})
+        return [dict(row._mapping) for row in rows]
+
+
+def get_tool_runtimes(session: Session, since: float) -> dict[int, float]:
+    # mean seconds per item, a batch run is spread over its items
+    statement = text(
+        """
+        SELECT tool_id, sum(weight * run / items) / sum(weight) FROM runrecord
+        WHERE created >= :since GROUP BY tool_id
+        """
+    )
+    with session:
+        return {tool_id: runtime for tool_id, runtime in session.exec(statement, params={"since": since})}
+
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
 
+    with Session(engine) as session:
+        columns = [row[1] for row in session.exec(text("PRAGMA table_info(tool)")).all()]
+        if "argument_schema" not in columns:
+            session.exec(text("ALTER TABLE tool ADD COLUMN argument_schema JSON"))
+        if "lane" not in columns:
+            session.exec(text("ALTER TABLE tool ADD COLUMN lane VARCHAR"))
+
+        # compile schemas for tools uploaded before they existed
+        for tool in session.exec(select(Tool).where(Tool.argument_schema.is_(None))).all():
+            try:
+                tool.argument_schema = schema.compile_schema(tool.arguments)
+            except schema.SchemaError as e:
+                logger.info(f"tool {tool.id} has no argument schema: {e}")
+        session.commit()
+
+        session.exec(text("CREATE INDEX IF NOT EXISTS ix_tool_public_id ON tool (public, id)"))
+        session.exec(text("CREATE VIRTUAL TABLE IF NOT EXISTS tool_search USING fts5(name, tags, docstring)"))
+
+        # backfill tools created before the search index existed
+        indexed = session.exec(text("SELECT count(*) FROM tool_search")).one()[0]
+        if indexed != session.exec(text("SELECT count(*) FROM tool")).one()[0]:
+            session.exec(text("DELETE FROM tool_search"))
+            for tool in session.exec(select(Tool)).all():
+                index_tool(session, tool)
+        session.commit()
+
 
 def get_session():
     with Session(engine) as session:
@@ -233,10 +451,16 @@ def create_tool(user_id: int, tool_name: str, tool_source: str) -> Tool:
     tags.append(tool_name)
     arguments = get_arguments(tool_name, tool_source)
 
+    try:
+        argument_schema = schema.compile_schema(arguments)
+    except schema.SchemaError as e:
+        raise HTTPException(status_code=400, detail=f"Annotation Error: {e}")
+
     return Tool(
         name=tool_name,
         code=tool_source,
         arguments=arguments,
+        argument_schema=argument_schema,
         user_id=user_id,
         tags=tags,
     )
@@ -2,7 +2,7 @@ from app import ENVIRONMENT
 from fastapi import Depends, APIRouter, HTTPException, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.security import OAuth2PasswordBearer
-from app.models.tools import SessionDep, User, hash_id, get_user
+from app.models.tools import SessionDep, User, hash_id, get_user, run_sync
 from app import TEMPLATES
 import requests
 from pydantic import ValidationError
@@ -70,7 +70,8 @@ async def auth_google(request: Request, code: str, session: SessionDep):
 
     user_info_json = user_info.json()
     id = hash_id(user_info_json["id"])
-    request.session["user"] = get_user(session, id).model_dump_json()
+    user = await run_sync(get_user, session, id)
+    request.session["user"] = user.model_dump_json()
 
     return RedirectResponse(url="/")
 
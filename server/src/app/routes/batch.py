@@ -0,0 +1,144 @@
+from fastapi import HTTPException, Request, APIRouter
+from fastapi.responses import HTMLResponse, Response
+from zipfile import ZipFile
+from pathlib import Path
+import asyncio
+import json
+
+from app.utility import ingest, render, runs, sandbox, schema, serializer
+from app.models import tools as db_tools
+from app.routes.tools import (
+    Tempdir,
+    PathEncoder,
+    isolate,
+    counter,
+    recorder,
+    lane_assigner,
+    sandbox_busy,
+    client_key,
+    get_visible_tool,
+    ingest_form,
+    record_run,
+    load_results,
+    write_results,
+)
+from app import SETTINGS
+
+router = APIRouter()
+
+# batch fields may hold every item's arguments
+MAX_ITEMS_BYTES = 1 << 20
+
+
+def parse_items(fields: dict[str, str]) -> list[dict[str, str]]:
+    try:
+        items = json.loads(fields.get("items", ""))
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Batch items must be a json list")
+
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise HTTPException(status_code=400, detail="Batch items must be a json list")
+
+    if not 0 < len(items) <= SETTINGS.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch must have 1 to {SETTINGS.BATCH_MAX_ITEMS} items")
+
+    return [{str(k): str(v) for k, v in item.items()} for item in items]
+
+
+def write_artifact(temp_dir: Path, items: list[str]) -> Path:
+    artifact = temp_dir / "batch.zip"
+    with ZipFile(artifact, "w") as zip_file:
+        for item in items:
+            for path in sorted((temp_dir / item).rglob("*")):
+                if path.is_file():
+                    zip_file.write(path, path.relative_to(temp_dir))
+    return artifact
+
+
+def read_results(temp_dir: Path, items: list[str]) -> list:
+    results = []
+    for item in items:
+        results_file = temp_dir / item / "result.json"
+        if not results_file.exists():
+            results.append("Runner Failed")
+            continue
+        results.append(load_results(results_file))
+    return results
+
+
+@router.post("/batch/tool/{id}")
+async def run_batch(
+    request: Request,
+    id: int,
+    temp_dir: Tempdir,
+    session: db_tools.SessionDep,
+):
+    tool = await get_visible_tool(request, session, id)
+
+    lane = lane_assigner.lane_for(tool, batch=True)
+    if isolate.full(lane):
+        raise sandbox_busy(isolate.retry_after(lane))
+
+    if tool.argument_schema is None:
+        raise HTTPException(status_code=400, detail="Unsupported Tool Arguments")
+
+    form = ingest.FormIngest(
+        temp_dir,
+        SETTINGS.UPLOAD_MAX_FILE_BYTES,
+        SETTINGS.UPLOAD_MAX_REQUEST_BYTES,
+        max_field_bytes=MAX_ITEMS_BYTES,
+        directory_for=lambda name: ingest.indexed_directory(temp_dir, name, "item", SETTINGS.BATCH_MAX_ITEMS),
+    )
+    fields, files = await ingest_form(request, form)
+    items = parse_items(fields)
+
+    if any(int(name.partition(".")[0]) >= len(items) for name in files):
+        raise HTTPException(status_code=400, detail="Batch upload for a missing item")
+
+    # every item is validated before the box is leased
+    names, arguments = [], {}
+    for index, item in enumerate(items):
+        directory = ingest.box_directory(temp_dir / f"item-{index}")
+
+        prefix = f"{index}."
+        paths = {name.removeprefix(prefix): upload.path for name, upload in files.items() if name.startswith(prefix)}
+        try:
+            kwargs = schema.validate(tool.argument_schema, item, paths)
+        except schema.SchemaError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid Argument: item {index} {e}")
+
+        with open(directory / "args.json", "w") as f:
+            serializer.dump(kwargs, f)
+        names.append(directory.name)
+        arguments[directory.name] = kwargs
+
+    temp_tool = (temp_dir / tool.name).with_suffix(".py")
+    with open(temp_tool, "w") as f:
+        f.write(tool.code)
+    with open(temp_dir / "batch.json", "w") as f:
+        json.dump(names, f)
+
+    input_bytes = await asyncio.to_thread(runs.directory_bytes, temp_dir) if recorder.enabled else 0
+
+    # !DANGER! user submitted code
+    try:
+        stats = await isolate.run(temp_tool, temp_dir, items=len(names), lane=lane, client=client_key(request))
+    except sandbox.SandboxBusy as e:
+        raise sandbox_busy(e.retry_after)
+
+    lane_assigner.observe(tool.id, stats.run / len(names))
+
+    digests = {upload.path: upload.sha256 for upload in files.values()}
+    await record_run(tool, temp_dir, arguments, digests, stats, input_bytes, items=len(names))
+
+    results = {
+        "items": await asyncio.to_thread(read_results, temp_dir, names),
+        "artifact": await asyncio.to_thread(write_artifact, temp_dir, names),
+    }
+    await asyncio.to_thread(write_results, temp_dir / "result.json", results)
+
+    counter.add_usage(tool.id, len(names))
+
+    if request.headers.get("HX-Request") == "true":
+        return HTMLResponse(content=await asyncio.to_thread(render.render, results, temp_dir.name))
+    return Response(content=json.dumps(results, cls=PathEncoder), media_type="application/json")
@@ -0,0 +1,153 @@
+from fastapi import FastAPI, HTTPException, Request, APIRouter
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
+from functools import partial
+from pathlib import Path
+import asyncio
+import json
+
+from app.utility import jobs, render, metadata
+from app.models import tools as db_tools
+from app.routes.tools import (
+    Tempdir,
+    PathEncoder,
+    reaper,
+    counter,
+    client_key,
+    get_visible_tool,
+    prepare_run,
+    execute_run,
+)
+from app import TEMPLATES, SETTINGS
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if manager.directory is not None:
+        manager.directory.mkdir(parents=True, exist_ok=True)
+    yield
+    # runs before the sandbox pool stops, draining jobs still have their boxes
+    await manager.stop(SETTINGS.JOBS_DRAIN_TIMEOUT)
+
+
+# several web processes share job state through files, one process keeps it in memory
+manager = jobs.JobManager(directory=SETTINGS.STATE_DIRECTORY / "jobs" if SETTINGS.WEB_WORKERS > 1 else None)
+router = APIRouter(lifespan=lifespan)
+
+
+async def run_job(
+    tool: metadata.ToolMetadata,
+    temp_dir: Path,
+    kwargs: dict,
+    digests: dict,
+    client: str,
+    job: jobs.Job,
+):
+    # progress and partial results reach the job while the tool is still running
+    follower = jobs.ProgressFollower(job, temp_dir / jobs.PROGRESS_FILE)
+    watcher = asyncio.create_task(follower.run())
+    try:
+        results = await execute_run(tool, temp_dir, kwargs, digests, client=client)
+    finally:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+        await reaper.release(temp_dir)
+
+    await follower.poll()
+
+    counter.add_usage(tool.id)
+    return results
+
+
+async def job_response(request: Request, job: jobs.Job, status_code: int = 200, seen: int = 0):
+    if request.headers.get("HX-Request") != "true":
+        content = json.dumps(job.summary(seen), cls=PathEncoder)
+        return Response(content=content, media_type="application/json", status_code=status_code)
+
+    # the page already shows the first seen partial results, only newer ones are sent
+    seen = max(0, min(seen, len(job.partials)))
+    # side files of partial results live in the job directory too
+    directory = SETTINGS.JOBS_DIRECTORY / job.id
+    partials = [await asyncio.to_thread(render.render, result, directory=directory) for result in job.partials[seen:]]
+
+    if job.status == "done":
+        content = "".join(f"<div>{html}</div>" for html in partials)
+        # a generator without a return value results in its partials, they are already shown
+        if not (seen or partials) or job.result != job.partials:
+            content += await asyncio.to_thread(render.render, job.result, job.id)
+        return HTMLResponse(content=content)
+
+    if job.status == "failed":
+        return HTMLResponse(content=render.render(job.error))
+
+    return TEMPLATES.TemplateResponse(
+        "components/job_pending.html",
+        {
+            "request": request,
+            "root_path": request.scope.get("root_path"),
+            "id": job.id,
+            "status": job.status,
+            "progress": job.progress,
+            "partials": partials,
+            "seen": len(job.partials),
+        },
+    )
+
+
+@router.post("/job/tool/{id}")
+async def submit_job(
+    request: Request,
+    id: int,
+    temp_dir: Tempdir,
+    session: db_tools.SessionDep,
+):
+    tool = await get_visible_tool(request, session, id)
+    kwargs, digests = await prepare_run(request, tool, temp_dir)
+
+    # the job directory name is secret, it doubles as the job id
+    reaper.retain(temp_dir)
+    run = partial(run_job, tool, temp_dir, kwargs, digests, client_key(request))
+    job = manager.submit(temp_dir.name, tool.id, run, workdir=temp_dir)
+    return await job_response(request, job, status_code=202)
+
+
+@router.get("/job/{id}")
+async def job_status(request: Request, id: str, seen: int = 0):
+    job = await manager.find(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job Not Found")
+
+    return await job_response(request, job, seen=seen)
+
+
+@router.get("/job/{id}/events")
+async def job_events(id: str):
+    job = await manager.find(id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job Not Found")
+
+    async def events():
+        status, progress, seen = None, None, 0
+        while True:
+            for index in range(seen, len(job.partials)):
+                data = json.dumps({"index": index, "result": job.partials[index]}, cls=PathEncoder)
+                yield f"event: partial\ndata: {data}\n\n"
+            seen = len(job.partials)
+
+            if job.progress is not progress:
+                progress = job.progress
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+
+            if job.status != status:
+                status = job.status
+                data = json.dumps(job.summary(), cls=PathEncoder)
+                yield f"event: {status}\ndata: {data}\n\n"
+
+            if job.finished:
+                return
+
+            if not await job.wait(15):
+                yield ": keepalive\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
@@ -0,0 +1,172 @@
+from fastapi import HTTPException, Request, APIRouter
+from fastapi.responses import HTMLResponse, Response
+from pathlib import Path
+from typing import Any
+import asyncio
+import json
+
+from app.utility import ingest, metadata, render, schema, serializer
+from app.models import tools as db_tools
+from app.routes.tools import (
+    Tempdir,
+    PathEncoder,
+    isolate,
+    counter,
+    sandbox_busy,
+    client_key,
+    get_visible_tool,
+    ingest_form,
+    execute_run,
+    write_results,
+)
+from app import SETTINGS
+
+router = APIRouter()
+
+# the steps field holds every step's arguments and mappings
+MAX_STEPS_BYTES = 1 << 20
+
+
+def parse_steps(fields: dict[str, str]) -> list[dict]:
+    invalid = HTTPException(status_code=400, detail="Pipeline steps must be a json list of steps")
+    try:
+        steps = json.loads(fields.get("steps", ""))
+    except json.JSONDecodeError:
+        raise invalid
+
+    if not isinstance(steps, list) or not 0 < len(steps) <= SETTINGS.PIPELINE_MAX_STEPS:
+        raise invalid
+
+    parsed = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or not isinstance(step.get("tool"), int):
+            raise invalid
+        args, mapping = step.get("args", {}), step.get("map", {})
+        if not isinstance(args, dict) or not isinstance(mapping, dict):
+            raise invalid
+
+        # a mapping reads "<step>" or "<step>.<key>.<index>..." from an earlier step's result
+        for reference in mapping.values():
+            source = str(reference).split(".")[0]
+            if not source.isdigit() or int(source) >= index:
+                raise HTTPException(status_code=400, detail=f"Step {index} maps from a later step")
+
+        args = {str(k): str(v) for k, v in args.items()}
+        parsed.append({"tool": step["tool"], "args": args, "map": {str(k): str(v) for k, v in mapping.items()}})
+    return parsed
+
+
+def resolve(results: list, reference: str) -> Any:
+    source, *keys = reference.split(".")
+    value = results[int(source)]
+    for key in keys:
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            raise KeyError(reference)
+    return value
+
+
+def step_arguments(temp_dir: Path, step: dict, results: list) -> tuple[dict, dict]:
+    # outputs of earlier steps are handed over by path, the files stay where they were written
+    fields, files = dict(step["args"]), {}
+    for name, reference in step["map"].items():
+        try:
+            value = resolve(results, reference)
+        except KeyError:
+            raise HTTPException(status_code=400, detail=f"Pipeline output {reference} not found")
+
+        if isinstance(value, serializer.BinaryRef):
+            value = Path(value.path)
+
+        if isinstance(value, Path):
+            if not value.resolve().is_relative_to(temp_dir.resolve()) or not value.is_file():
+                raise HTTPException(status_code=400, detail=f"Pipeline output {reference} is not a job file")
+            files[name] = value
+        else:
+            fields[name] = str(value)
+    return fields, files
+
+
+def check_step(index: int, tool: metadata.ToolMetadata, step: dict, uploads: dict[str, Path]):
+    # mapped arguments are only known once the earlier steps ran, everything else is checked now
+    if tool.argument_schema is None:
+        raise HTTPException(status_code=400, detail=f"Step {index} has unsupported tool arguments")
+
+    unknown = [name for name in step["map"] if name not in tool.argument_schema]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Invalid Argument: step {index} unknown argument {unknown[0]}")
+
+    remaining = {name: arg for name, arg in tool.argument_schema.items() if name not in step["map"]}
+    try:
+        schema.validate(remaining, step["args"], uploads)
+    except schema.SchemaError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid Argument: step {index} {e}")
+
+
+@router.post("/pipeline")
+async def run_pipeline(
+    request: Request,
+    temp_dir: Tempdir,
+    session: db_tools.SessionDep,
+):
+    if isolate.full():
+        raise sandbox_busy(isolate.retry_after())
+
+    form = ingest.FormIngest(
+        temp_dir,
+        SETTINGS.UPLOAD_MAX_FILE_BYTES,
+        SETTINGS.UPLOAD_MAX_REQUEST_BYTES,
+        max_field_bytes=MAX_STEPS_BYTES,
+        directory_for=lambda name: ingest.indexed_directory(temp_dir, name, "step", SETTINGS.PIPELINE_MAX_STEPS),
+    )
+    fields, files = await ingest_form(request, form)
+    steps = parse_steps(fields)
+
+    if any(int(name.partition(".")[0]) >= len(steps) for name in files):
+        raise HTTPException(status_code=400, detail="Pipeline upload for a missing step")
+
+    # every tool and every argument that is not mapped is checked before the first box is leased
+    tools, uploads = [], []
+    for index, step in enumerate(steps):
+        prefix = f"{index}."
+        step_uploads = {name.removeprefix(prefix): f.path for name, f in files.items() if name.startswith(prefix)}
+        tool = await get_visible_tool(request, session, step["tool"])
+        check_step(index, tool, step, step_uploads)
+        tools.append(tool)
+        uploads.append(step_uploads)
+
+    digests = {upload.path: upload.sha256 for upload in files.values()}
+    results = []
+    for index, (tool, step) in enumerate(zip(tools, steps)):
+        step_dir = ingest.box_directory(temp_dir / f"step-{index}")
+
+        fields, mapped = step_arguments(temp_dir, step, results)
+        try:
+            kwargs = schema.validate(tool.argument_schema, fields, {**uploads[index], **mapped})
+        except schema.SchemaError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid Argument: step {index} {e}")
+
+        # written after the uploads so an upload can not replace the tool
+        with open((step_dir / tool.name).with_suffix(".py"), "w") as f:
+            f.write(tool.code)
+        with open(step_dir / "args.json", "w") as f:
+            serializer.dump(kwargs, f)
+
+        # the whole job directory is mounted, a step reads earlier outputs where they are
+        # uploads were hashed while they arrived, outputs of earlier steps are hashed off the loop when needed
+        step_results = await execute_run(tool, step_dir, kwargs, digests, mount=temp_dir, client=client_key(request))
+        results.append(step_results)
+        counter.add_usage(tool.id)
+
+        if isinstance(step_results, str) and step_results.startswith("Runtime Error"):
+            break
+
+    results = {"steps": results, "result": results[-1]}
+    await asyncio.to_thread(write_results, temp_dir / "result.json", results)
+
+    if request.headers.get("HX-Request") == "true":
+        return HTMLResponse(content=await asyncio.to_thread(render.render, results, temp_dir.name))
+    return Response(content=json.dumps(results, cls=PathEncoder), media_type="application/json")
@@ -3,8 +3,10 @@ from fastapi.responses import (
     JSONResponse,
     StreamingResponse,
     FileResponse,
+    Response,
 )
 from urllib.parse import (
+    quote,
     unquote,
     parse_qs,
     quote_plus,
@@ -14,21 +16,23 @@ from urllib.parse import (
     urlencode,
 )
 from fastapi import FastAPI, HTTPException, Request, APIRouter, Depends, Query
-from starlette.datastructures import UploadFile as StarUploadFile
-from typing import Literal, get_origin, Annotated, Optional
-from contextlib import asynccontextmanager, suppress
+from typing import Annotated, Optional
+from contextlib import asynccontextmanager
 from zipfile import ZipFile
 from pathlib import Path
 from io import BytesIO
-import asyncio
 import secrets
-import shutil
+import asyncio
+import base64
 import time
 import stat
 import os
 
-from app.utility import sandbox, render, serializer, security
-from app import TEMPLATES, ALLOWED_CHARACTERS, logger
+from python_multipart.exceptions import MultipartParseError, QuerystringParseError
+from app.utility import sandbox, render, serializer, security, cache, ingest, metadata, schema, counters, runs, lanes
+from app.utility import processes, remote
+from app.utility import reaper as jobs_reaper
+from app import TEMPLATES, ALLOWED_CHARACTERS, SETTINGS, logger
 from app.models import tools as db_tools
 from app.routes.auth import User
 import json
@@ -39,21 +43,75 @@ class PathEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, PosixPath):
             return str(obj)
+        if isinstance(obj, serializer.BinaryRef):
+            return {"file": obj.path, "kind": obj.kind, "dtype": obj.dtype, "shape": obj.shape}
+        if isinstance(obj, bytes):
+            return base64.b64encode(obj).decode()
         return super().default(obj)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # job directories are reachable by name but can not be listed from a box
+    SETTINGS.JOBS_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    os.chmod(SETTINGS.JOBS_DIRECTORY, stat.S_IRWXU | stat.S_IXGRP | stat.S_IXOTH)
+
+    # worker nodes hand results back to the process that queued the job
+    if SETTINGS.WEB_WORKERS > 1 and remote_workers.enabled:
+        raise RuntimeError("WORKER_TOKEN needs WEB_WORKERS=1")
+
+    # each web process runs its own boxes, the leader also does the shared housekeeping
+    await process.claim()
+    isolate.place(process.index * isolate.workers)
+    if process.leader:
+        await asyncio.to_thread(results_cache.scan)
+        await asyncio.to_thread(reaper.scan)
+        results_cache.start()
+        reaper.start()
+
+    await tool_cache.start()
+    counter.start()
+    recorder.start(prune=process.leader)
+    lane_assigner.start()
+    remote_workers.start()
+    await isolate.start()
     yield
-    delete_tasks = []
-    for task in asyncio.all_tasks():
-        if "delete" in task.get_name():
-            delete_tasks.append(task)
-            task.cancel()
-    await asyncio.gather(*delete_tasks)
-
-
-isolate = sandbox.IsolationWorkers()
+    await isolate.stop()
+    await remote_workers.stop()
+    await lane_assigner.stop()
+    await recorder.stop()
+    await counter.stop()
+    await tool_cache.stop()
+    await reaper.stop()
+    await results_cache.stop()
+    process.release()
+
+
+process = processes.ProcessSlot(SETTINGS.STATE_DIRECTORY / "processes", SETTINGS.WEB_WORKERS)
+remote_workers = remote.RemoteWorkers(SETTINGS.WORKER_TOKEN, SETTINGS.WORKER_TIMEOUT)
+isolate = sandbox.IsolationWorkers(remote=remote_workers if remote_workers.enabled else None)
+results_cache = cache.ResultCache(
+    SETTINGS.RESULT_CACHE_DIRECTORY,
+    SETTINGS.RESULT_CACHE_SIZE,
+    SETTINGS.RESULT_CACHE_AGE,
+    shared=process.shared,
+)
+reaper = jobs_reaper.JobReaper(
+    SETTINGS.JOBS_DIRECTORY,
+    SETTINGS.JOBS_TTL,
+    SETTINGS.JOBS_QUOTA_BYTES,
+    SETTINGS.JOBS_MIN_FREE_BYTES,
+    shared=process.shared,
+)
+tool_cache = metadata.MetadataCache(SETTINGS.TOOL_CACHE_SIZE, SETTINGS.TOOL_CACHE_POLL)
+counter = counters.CounterAggregator(SETTINGS.COUNTER_FLUSH_INTERVAL)
+recorder = runs.RunRecorder(
+    SETTINGS.COUNTER_FLUSH_INTERVAL,
+    SETTINGS.RUN_HISTORY_AGE,
+    SETTINGS.RUN_HISTORY_DOWNSAMPLE_AGE,
+    SETTINGS.RUN_HISTORY_DOWNSAMPLE,
+)
+lane_assigner = lanes.LaneAssigner(SETTINGS.LANE_HEAVY_SECONDS, SETTINGS.LANE_HISTORY_AGE)
 router = APIRouter(lifespan=lifespan)
 
 
@@ -61,29 +119,66 @@ def secret_dir_name(length=32):
     return "".join(secrets.choice(ALLOWED_CHARACTERS) for _ in range(length))
 
 
-async def delete_temp_dir(temp_dir: Path):
-    try:
-        with suppress(asyncio.CancelledError):
-            await asyncio.sleep(60 * 10)
-    finally:
-        if temp_dir.exists() and temp_dir.is_dir():
-            shutil.rmtree(temp_dir)
-
-
 async def get_temp_dir():
+    temp_dir = SETTINGS.JOBS_DIRECTORY / secret_dir_name(32)
+    os.mkdir(temp_dir)
+    os.chmod(temp_dir, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+    reaper.add(temp_dir)
     try:
-        temp_dir = Path("/tmp") / secret_dir_name(32)
-        os.mkdir(temp_dir)
-        os.chmod(temp_dir, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
         yield temp_dir
     finally:
-        task = delete_temp_dir(temp_dir)
-        asyncio.create_task(task, name=f"delete-{temp_dir}")
+        await reaper.release(temp_dir)
 
 
 Tempdir = Annotated[Path, Depends(get_temp_dir)]
 
 
+def client_key(request: Request) -> str:
+    # waiting jobs are queued fairly per user, anonymous clients by address
+    if "user" in request.session:
+        return f"user:{User.model_validate_json(request.session['user']).id}"
+    host = request.headers.get("X-Real-IP") or (request.client.host if request.client else "")
+    return f"address:{host}"
+
+
+def sandbox_busy(retry_after: int) -> HTTPException:
+    headers = {"Retry-After": str(retry_after)}
+    return HTTPException(status_code=503, detail="Sandbox Busy", headers=headers)
+
+
+@router.get("/status/sandbox", response_class=JSONResponse)
+async def sandbox_status():
+    return {
+        **isolate.status(),
+        "process": process.status(),
+        "cache": results_cache.status(),
+        "jobs": reaper.status(),
+        "tools": tool_cache.status(),
+        "counters": counter.status(),
+        "runs": recorder.status(),
+        "assignment": lane_assigner.status(),
+    }
+
+
+@router.get("/status/runs", response_class=JSONResponse)
+async def run_status(
+    request: Request,
+    session: db_tools.SessionDep,
+    seconds: float = Query(24 * 60 * 60, gt=0),
+    limit: int = Query(50, ge=1, le=200),
+):
+    # run history shows which tools ran and how they failed, only admins see it
+    if "user" not in request.session:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    user: User = User.model_validate_json(request.session["user"])
+    if user.id not in SETTINGS.ADMIN_USERS:
+        raise HTTPException(status_code=403, detail="Requires admin.")
+
+    # tools ordered by the cpu time they used, downsampled rows count with their weight
+    since = time.time() - seconds
+    return await db_tools.run_sync(db_tools.get_run_summary, session, since, limit)
+
+
 @router.route("/", methods=["GET", "POST"])
 async def read_root(request: Request):
     return TEMPLATES.TemplateResponse(
@@ -100,26 +195,23 @@ async def read_root(request: Request):
 async def get_tools(
     request: Request,
     session: db_tools.SessionDep,
-    start: int = Query(0, ge=0),
-    end: int = Query(100, ge=0),
+    after: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=200),
 ):
-    if start > end:
-        raise HTTPException(status_code=400, detail="Invalid index range")
-
     body = await request.body()
     search_string = unquote(body.decode())
     query_params = parse_qs(search_string)
     tags = query_params.get("search", [""])[0].split()
 
     if tags:
-        tools = db_tools.get_tools_by_tags(session, tags, start, end)
+        tools = await db_tools.run_sync(db_tools.get_tools_by_tags, session, tags, after, limit)
     else:
-        tools = db_tools.get_tools_by_index(session, start, end)
+        tools = await db_tools.run_sync(db_tools.get_tools_by_index, session, after, limit)
 
-    if len(tools) < (end - start):
-        end = None
+    # keyset pagination, the next page starts after the last id of this one
+    next_after = tools[-1][0] if len(tools) == limit else None
 
-    content = render.list_items(request.scope.get("root_path"), tools, end, tags)
+    content = render.list_items(request.scope.get("root_path"), tools, next_after, limit, tags)
 
     return HTMLResponse(content=content)
 
@@ -129,7 +221,7 @@ async def get_user_tools(request: Request, session: db_tools.SessionDep):
     if "user" not in request.session:
         return HTMLResponse(content="")
     user: User = User.model_validate_json(request.session["user"])
-    tools = db_tools.get_user_tools(session, user)
+    tools = await db_tools.run_sync(db_tools.get_user_tools, session, user)
     content = render.list_item_user(request.scope.get("root_path"), tools)
     return HTMLResponse(content=content)
 
@@ -137,18 +229,7 @@ async def get_user_tools(request: Request, session: db_tools.SessionDep):
 # currently unused
 @router.get("/tool/{id}/link", response_class=HTMLResponse)
 async def tool_link(request: Request, id: int, session: db_tools.SessionDep):
-    tool = db_tools.get_tool_by_id(session, id)
-
-    if tool is None:
-        raise HTTPException(status_code=404, detail="Tool Not Found")
-
-    if not tool.public:
-        if "user" not in request.session:
-            raise HTTPException(status_code=404, detail="Tool Not Found")
-        user: User = User.model_validate_json(request.session["user"])
-
-        if tool.user_id != user.id:
-            raise HTTPException(status_code=404, detail="Tool Not Found")
+    tool = await get_visible_tool(request, session, id)
 
     form_data = {}
     if len(tool.arguments):
@@ -170,26 +251,12 @@ async def tool_link(request: Request, id: int, session: db_tools.SessionDep):
 
 @router.get("/tool/{id}", response_class=HTMLResponse)
 async def entrypoint_page(request: Request, id: int, session: db_tools.SessionDep):
-    tool = db_tools.get_tool_by_id(session, id)
-
-    if tool is None:
-        raise HTTPException(status_code=404, detail="Tool Not Found")
-
-    if not tool.public:
-        if "user" not in request.session:
-            raise HTTPException(status_code=404, detail="Tool Not Found")
-        user: User = User.model_validate_json(request.session["user"])
-        if tool.user_id != user.id:
-            raise HTTPException(status_code=404, detail="Tool Not Found")
+    tool = await get_visible_tool(request, session, id)
+    runs = await db_tools.run_sync(db_tools.get_tool_usage, session, tool.id)
+    runs += counter.pending_usage(tool.id)
 
+    # query parameters replace the defaults of the cached form
     query = dict(request.query_params)
-    arguments = tool.arguments
-
-    for name, default in query.items():
-        if name not in arguments:
-            continue
-        t, d = arguments[name]
-        arguments[name] = (t, default)
 
     return TEMPLATES.TemplateResponse(
         "pages/tool.html",
@@ -197,12 +264,12 @@ async def entrypoint_page(request: Request, id: int, session: db_tools.SessionDe
             "header_title": "PyTools",
             "tool": tool.name,
             "tool_id": tool.id,
-            "runs": tool.usage,
+            "runs": runs,
             "request": request,
             "root_path": request.scope.get("root_path"),
             "endpoint": f"/tool/{tool.id}",
             "code": tool.code,
-            "form_groups": render.args_to_form(tool.arguments),
+            "form_groups": tool.form.render(query),
             "time": time.time(),
         },
     )
@@ -210,17 +277,7 @@ async def entrypoint_page(request: Request, id: int, session: db_tools.SessionDe
 
 @router.get("/download/tool/{id}", response_class=HTMLResponse)
 async def download_tool(request: Request, id: int, session: db_tools.SessionDep):
-    tool = db_tools.get_tool_by_id(session, id)
-
-    if tool is None:
-        raise HTTPException(status_code=404, detail="Tool Not Found")
-
-    if not tool.public:
-        if "user" not in request.session:
-            raise HTTPException(status_code=404, detail="Tool Not Found")
-        user: User = User.model_validate_json(request.session["user"])
-        if tool.user_id != user.id:
-            raise HTTPException(status_code=404, detail="Tool Not Found")
+    tool = await get_visible_tool(request, session, id)
 
     zip_buffer = BytesIO()
     with ZipFile(zip_buffer, "w") as zip_file:
@@ -248,28 +305,23 @@ async def public_tool(
         raise HTTPException(status_code=403, detail="Forbidden")
 
     user: User = User.model_validate_json(request.session.get("user"))
-    tool = db_tools.get_tool_by_id(session, id)
-
-    if user.id != tool.user_id:
-        raise HTTPException(status_code=403, detail="Forbidden")
+    tool = await db_tools.run_sync(db_tools.get_tool_by_id, session, id)
 
     if tool is None:
         raise HTTPException(status_code=404, detail="Tool Not Found")
 
+    if user.id != tool.user_id:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
     tool.public = public
-    session.commit()
+    await db_tools.run_sync(session.commit)
+    await tool_cache.invalidate(session, id, tool)
 
     return HTMLResponse(status_code=200)
 
 
-@router.post("/tool/{id}", response_class=HTMLResponse)
-async def run_isolated(
-    request: Request,
-    id: int,
-    temp_dir: Tempdir,
-    session: db_tools.SessionDep,
-) -> str:
-    tool = db_tools.get_tool_by_id(session, id)
+async def get_visible_tool(request: Request, session: db_tools.Session, id: int) -> metadata.ToolMetadata:
+    tool = await tool_cache.get(session, id)
 
     if tool is None:
         raise HTTPException(status_code=404, detail="Tool Not Found")
@@ -281,76 +333,216 @@ async def run_isolated(
         if tool.user_id != user.id:
             raise HTTPException(status_code=404, detail="Tool Not Found")
 
-    form_data = {}
+    return tool
+
+
+async def ingest_form(request: Request, form: ingest.FormIngest) -> tuple[dict, dict]:
+    try:
+        return await form.ingest(request)
+    except ingest.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (ingest.UploadInvalid, MultipartParseError, QuerystringParseError):
+        raise HTTPException(status_code=400, detail="Malformed Form")
+
+
+async def prepare_run(request: Request, tool: metadata.ToolMetadata, temp_dir: Path) -> tuple[dict, dict]:
+    # reject before reading the upload when no box slot can be queued
+    lane = lane_assigner.lane_for(tool)
+    if isolate.full(lane) and not results_cache.enabled(tool.tags):
+        raise sandbox_busy(isolate.retry_after(lane))
+
+    temp_tool = (temp_dir / tool.name).with_suffix(".py")
+
+    fields, files = {}, {}
     if len(tool.arguments):
-        form_data = await request.form()
+        form = ingest.FormIngest(temp_dir, SETTINGS.UPLOAD_MAX_FILE_BYTES, SETTINGS.UPLOAD_MAX_REQUEST_BYTES)
+        fields, files = await ingest_form(request, form)
 
     # overwrite form params with query params
     # query_params = dict(request.query_params)
     # form_data.update(query_params)
 
-    kwargs = {}
-    temp_tool = (temp_dir / tool.name).with_suffix(".py")
+    # written after the uploads so an upload can not replace the tool
     with open(temp_tool, "w") as f:
         f.write(tool.code)
 
-    for key, value in form_data.items():
-        # TODO: saftey check: tool arguments have been parsed at this point (maybe pre cast them?)
-        python_type = eval(tool.arguments[key][0])
+    if tool.argument_schema is None:
+        raise HTTPException(status_code=400, detail="Unsupported Tool Arguments")
 
-        if isinstance(value, StarUploadFile):
-            upload_path = temp_dir / value.filename
-            with open(upload_path, "wb+") as f:
-                f.write(value.file.read())
-            kwargs[key] = upload_path
-        elif get_origin(python_type) is Literal:
-            kwargs[key] = str(value)
-        else:
-            kwargs[key] = python_type(value)
+    try:
+        paths = {key: upload.path for key, upload in files.items()}
+        kwargs = schema.validate(tool.argument_schema, fields, paths)
+    except schema.SchemaError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid Argument: {e}")
+
+    digests = {upload.path: upload.sha256 for upload in files.values()}
 
     with open(temp_dir / "args.json", "w") as f:
         serializer.dump(kwargs, f)
 
-    tool.usage = tool.usage + 1
-    session.commit()
+    return kwargs, digests
+
+
+async def record_run(
+    tool: metadata.ToolMetadata,
+    temp_dir: Path,
+    kwargs: dict,
+    digests: dict,
+    stats: sandbox.RunStats,
+    input_bytes: int,
+    items: int = 1,
+):
+    if not recorder.enabled:
+        return
+
+    def measure() -> tuple[str, int]:
+        output_bytes = runs.directory_bytes(temp_dir) - input_bytes
+        return cache.arguments_digest(kwargs, digests), max(0, output_bytes)
+
+    args_hash, output_bytes = await asyncio.to_thread(measure)
+    recorder.add(tool.id, tool.code_hash, args_hash, stats, output_bytes, items)
+
+
+# results can be megabytes of json, routes parse and write them in a thread
+def load_results(path: Path):
+    with open(path, "r") as f:
+        return serializer.load(f)
+
+
+def write_results(path: Path, results):
+    with open(path, "w") as f:
+        serializer.dump(results, f)
+
+
+async def execute_run(
+    tool: metadata.ToolMetadata,
+    temp_dir: Path,
+    kwargs: dict,
+    digests: dict,
+    mount: Optional[Path] = None,
+    client: str = "",
+):
+    cacheable = results_cache.enabled(tool.tags)
+    temp_tool = (temp_dir / tool.name).with_suffix(".py")
+
+    if cacheable:
+        cache_key = await asyncio.to_thread(results_cache.key, tool.code, kwargs, digests)
+        results = await asyncio.to_thread(results_cache.load, cache_key, temp_dir)
+        if results is not None:
+            # previews and downloads read the result from the job directory
+            await asyncio.to_thread(write_results, temp_dir / "result.json", results)
+            return results
+
+    input_bytes = await asyncio.to_thread(runs.directory_bytes, temp_dir) if recorder.enabled else 0
 
     # !DANGER! user submitted code
-    await isolate.run(temp_tool, temp_dir)
+    try:
+        stats = await isolate.run(temp_tool, temp_dir, mount=mount, lane=lane_assigner.lane_for(tool), client=client)
+    except sandbox.SandboxBusy as e:
+        raise sandbox_busy(e.retry_after)
+
+    lane_assigner.observe(tool.id, stats.run)
+    await record_run(tool, temp_dir, kwargs, digests, stats, input_bytes)
 
     results_file = temp_dir / "result.json"
     if not results_file.exists():
         raise HTTPException(status_code=404, detail="Runner Failed")
 
-    with open(results_file, "r") as f:
-        results = serializer.load(f)
+    results = await asyncio.to_thread(load_results, results_file)
+
+    runtime_error = isinstance(results, str) and results.startswith("Runtime Error")
+    if cacheable and not runtime_error:
+        await asyncio.to_thread(results_cache.store, cache_key, results, temp_dir)
+
+    return results
+
+
+@router.post("/tool/{id}", response_class=HTMLResponse)
+async def run_isolated(
+    request: Request,
+    id: int,
+    temp_dir: Tempdir,
+    session: db_tools.SessionDep,
+) -> str:
+    tool = await get_visible_tool(request, session, id)
+    kwargs, digests = await prepare_run(request, tool, temp_dir)
+    results = await execute_run(tool, temp_dir, kwargs, digests, client=client_key(request))
+
+    counter.add_usage(tool.id)
 
     if request.headers.get("HX-Request") == "true":
-        return HTMLResponse(content=render.render(results))
+        return HTMLResponse(content=await asyncio.to_thread(render.render, results, temp_dir.name))
     else:
         return json.dumps(results, cls=PathEncoder)
 
 
-@security.constant_time_with_random_delay(0.2, 1)
+@router.get("/result/{job}", response_class=HTMLResponse)
+async def result_part(job: str, path: str = "[]", offset: Optional[int] = Query(None, ge=0)):
+    not_found = HTTPException(status_code=404, detail="Result Not Found")
+
+    if not job or any(c not in ALLOWED_CHARACTERS for c in job):
+        raise not_found
+
+    results_file = SETTINGS.JOBS_DIRECTORY / job / "result.json"
+
+    def load_part(keys: list) -> str:
+        with open(results_file, "r") as f:
+            results = serializer.load(f)
+        return render.ResultPreview(job).render_part(results, keys, offset)
+
+    try:
+        content = await asyncio.to_thread(load_part, json.loads(path))
+    except (OSError, ValueError, KeyError, TypeError):
+        raise not_found
+
+    return HTMLResponse(content=content)
+
+
+def strong_etag(stat_result: os.stat_result) -> str:
+    # job files are written once by the runner, inode + size + mtime identify the content
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
 @router.get("/download/{file_str:path}", response_class=FileResponse)
-async def download_file(file_str: str):
+@security.constant_time_with_random_delay(0.2, 1)
+async def download_file(request: Request, file_str: str):
     file_path = Path("/") / Path(file_str)
     file_path = file_path.resolve()
 
     forbidden = HTTPException(status_code=403, detail="Forbidden File Access")
 
-    if not str(file_path).startswith("/tmp/"):
+    jobs_directory = SETTINGS.JOBS_DIRECTORY.resolve()
+    if not file_path.is_relative_to(jobs_directory):
         raise forbidden
 
-    if not file_path.exists():
+    try:
+        stat_result = file_path.stat()
+    except OSError:
         raise forbidden
 
-    if not file_path.is_file():
+    if not stat.S_ISREG(stat_result.st_mode):
         raise forbidden
 
+    etag = strong_etag(stat_result)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=600"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+
+    # let the reverse proxy stream the file with sendfile, it also answers range requests
+    if SETTINGS.DOWNLOAD_ACCEL_PREFIX:
+        location = quote(f"{SETTINGS.DOWNLOAD_ACCEL_PREFIX}{file_path.relative_to(jobs_directory)}")
+        headers["X-Accel-Redirect"] = location
+        headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(file_path.name)}"
+        return Response(status_code=200, headers=headers, media_type="application/octet-stream")
+
     return FileResponse(
         file_path,
         media_type="application/octet-stream",
         filename=file_path.name,
+        headers=headers,
+        stat_result=stat_result,
     )
 
 
@@ -3,8 +3,10 @@ from fastapi.responses import HTMLResponse
 from fastapi.exceptions import HTTPException
 from app.models import tools
 from app.models.tools import SessionDep, User, FilterDep, get_user
+from app.routes.tools import tool_cache
+from app.utility import lanes
 from pathlib import Path
-from app import TEMPLATES, logger
+from app import TEMPLATES, SETTINGS, logger
 from typing import Optional
 from urllib.parse import parse_qsl
 
@@ -21,7 +23,7 @@ async def tool_delete(
         logger.info("user is not logged in")
         return HTMLResponse(status_code=407)
 
-    tool = tools.get_tool(session, id)
+    tool = await tools.run_sync(tools.get_tool, session, id)
     if tool is None:
         logger.info("unable to find tool")
         return HTMLResponse(status_code=404)
@@ -32,7 +34,8 @@ async def tool_delete(
         logger.info("tool does not belong to user")
         return HTMLResponse(status_code=404)
 
-    tools.del_tool(session, tool)
+    await tools.run_sync(tools.del_tool, session, tool)
+    await tool_cache.invalidate(session, id)
     return HTMLResponse(status_code=200)
 
 
@@ -71,14 +74,16 @@ async def tool_upload_post(
     if not clean:
         raise HTTPException(status_code=400, detail="Blocked by profanity filter.")
 
-    db_tool: Optional[tools.Tool] = tools.get_tool(session, id)
+    db_tool: Optional[tools.Tool] = await tools.run_sync(tools.get_tool, session, id)
 
     if db_tool is None:
         tool = tools.create_tool(user.id, Path(name).stem, code.decode())
         if tool is None:
             raise HTTPException(status_code=404, detail="Error creating tool.")
-        session.add(tool)
-        session.commit()
+        await tools.run_sync(tools.add_tool, session, tool)
+        await tools.run_sync(tools.index_tool, session, tool)
+        # sqlite can hand out the id of a deleted tool again
+        await tool_cache.invalidate(session, tool.id, tool)
 
     else:
         tool = tools.create_tool(user.id, Path(name).stem, code.decode())
@@ -87,8 +92,11 @@ async def tool_upload_post(
         db_tool.name = tool.name
         db_tool.code = tool.code
         db_tool.arguments = tool.arguments
+        db_tool.argument_schema = tool.argument_schema
         db_tool.tags = tool.tags
-        session.commit()
+        await tools.run_sync(session.commit)
+        await tools.run_sync(tools.index_tool, session, db_tool)
+        await tool_cache.invalidate(session, db_tool.id, db_tool)
 
     return HTMLResponse(status_code=200)
 
@@ -101,7 +109,7 @@ async def user_settings(
     if "user" not in request.session:
         raise HTTPException(status_code=404, detail="Requires Login.")
     user: User = User.model_validate_json(request.session["user"])
-    user: User = get_user(session, user.id)
+    user: User = await tools.run_sync(get_user, session, user.id)
 
     form_data = await request.form()
 
@@ -110,7 +118,7 @@ async def user_settings(
 
     # update session and database
     request.session["user"] = user.model_dump_json()
-    session.commit()
+    await tools.run_sync(session.commit)
 
     return HTMLResponse(status_code=200)
 
@@ -127,7 +135,7 @@ async def tool_set_public(
         raise HTTPException(status_code=404, detail="Requires login.")
     user: User = User.model_validate_json(request.session["user"])
 
-    db_tool: Optional[tools.Tool] = tools.get_tool(session, id)
+    db_tool: Optional[tools.Tool] = await tools.run_sync(tools.get_tool, session, id)
 
     if db_tool is None:
         raise HTTPException(status_code=404, detail="Tool does not exist.")
@@ -141,5 +149,36 @@ async def tool_set_public(
     if anonymous is not None:
         db_tool.annonymous = anonymous
 
-    session.commit()
+    await tools.run_sync(session.commit)
+    await tool_cache.invalidate(session, id, db_tool)
+    return HTMLResponse(status_code=200)
+
+
+@router.post("/manage/tool/lane/{id}", response_class=HTMLResponse)
+async def tool_set_lane(
+    request: Request,
+    session: SessionDep,
+    id: int,
+    lane: str = "",
+):
+    # admins pin a tool to a lane, an empty lane goes back to assignment by runtime
+    if "user" not in request.session:
+        raise HTTPException(status_code=404, detail="Requires login.")
+    user: User = User.model_validate_json(request.session["user"])
+
+    if user.id not in SETTINGS.ADMIN_USERS:
+        raise HTTPException(status_code=403, detail="Requires admin.")
+
+    if lane and lane not in lanes.LANES:
+        raise HTTPException(status_code=400, detail=f"Lane must be one of {', '.join(lanes.LANES)}.")
+
+    db_tool: Optional[tools.Tool] = await tools.run_sync(tools.get_tool, session, id)
+
+    if db_tool is None:
+        raise HTTPException(status_code=404, detail="Tool does not exist.")
+
+    db_tool.lane = lane or None
+
+    await tools.run_sync(session.commit)
+    await tool_cache.invalidate(session, id, db_tool)
     return HTMLResponse(status_code=200)
@@ -0,0 +1,76 @@
+from fastapi import HTTPException, Request, APIRouter, Depends, Query
+from fastapi.responses import Response, StreamingResponse
+from typing import Annotated
+import json
+
+from app.utility import archive
+from app.routes.tools import remote_workers
+from app import SETTINGS, logger
+
+router = APIRouter()
+
+# a worker polls again right away, long enough to keep idle polling cheap
+MAX_LEASE_WAIT = 30
+
+
+def worker_name(request: Request, worker: str = Query(min_length=1, max_length=64)) -> str:
+    # the feature does not exist for clients without the shared token
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not remote_workers.authorized(token):
+        raise HTTPException(status_code=404, detail="Not Found")
+    return worker
+
+
+Worker = Annotated[str, Depends(worker_name)]
+
+
+@router.post("/worker/lease")
+async def worker_lease(
+    worker: Worker,
+    lanes: str = Query(min_length=1),
+    wait: float = Query(20, ge=0, le=MAX_LEASE_WAIT),
+):
+    job = await remote_workers.offer(worker, tuple(lanes.split(",")), wait)
+    if job is None:
+        return Response(status_code=204)
+
+    # the box sees the same paths as on the server, the worker only maps them under its root
+    headers = {
+        "X-Job": job.id,
+        "X-Tool": str(job.dir / job.tool.name),
+        "X-Workdir": str(job.dir),
+        "X-Mount": str(job.mount),
+        "X-Items": str(job.items),
+        "X-Wall-Time": str(job.wall_time),
+    }
+    return StreamingResponse(archive.stream_tar(job.mount), media_type="application/x-tar", headers=headers)
+
+
+@router.post("/worker/heartbeat")
+async def worker_heartbeat(worker: Worker):
+    remote_workers.touch(worker)
+    return Response(status_code=204)
+
+
+@router.post("/worker/result/{job_id}")
+async def worker_result(request: Request, worker: Worker, job_id: str):
+    remote_workers.touch(worker)
+    job = remote_workers.leased(worker, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job Not Found")
+
+    try:
+        report = json.loads(request.headers.get("X-Run-Stats", "null"))
+    except json.JSONDecodeError:
+        report = None
+
+    # the archive holds only the files the run wrote or changed
+    try:
+        await archive.receive_tar(request.stream(), job.mount, SETTINGS.JOBS_QUOTA_BYTES)
+    except (archive.ArchiveError, OSError, EOFError) as e:
+        logger.error(f"worker {worker} result for {job_id} rejected: {e!r}")
+        remote_workers.finish(job, None)
+        raise HTTPException(status_code=400, detail="Invalid Archive")
+
+    remote_workers.finish(job, report if isinstance(report, dict) else {"status": "XX"})
+    return Response(status_code=204)
@@ -1,5 +1,10 @@
 def runner():
     import uvicorn
-    from app.app import app
+    from app import SETTINGS
 
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # each worker process imports the app itself, they share the port
+    uvicorn.run("app.app:app", host="0.0.0.0", port=8080, workers=SETTINGS.WEB_WORKERS)
+
+
+if __name__ == "__main__":
+    runner()
@@ -0,0 +1,195 @@
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional
+from pathlib import Path
+import threading
+import tarfile
+import asyncio
+import queue
+import stat
+import os
+
+# job directories travel between the server and worker nodes as uncompressed tar streams
+# uploads are mostly already compressed, gzip would only cost cpu on both ends
+CHUNK_BYTES = 1 << 16
+QUEUE_CHUNKS = 16
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def snapshot(directory: Path) -> dict[str, tuple[int, int]]:
+    # relative path to (size, mtime), a worker only sends back what the run changed
+    return {
+        str(path.relative_to(directory)): (stat.st_size, stat.st_mtime_ns)
+        for path in directory.rglob("*")
+        if path.is_file() and not path.is_symlink()
+        for stat in (path.stat(),)
+    }
+
+
+def write_tar(directory: Path, file, names: Optional[Iterable[str]] = None):
+    with tarfile.open(fileobj=file, mode="w|") as tar:
+        for name in sorted(names if names is not None else snapshot(directory)):
+            tar.add(directory / name, arcname=name, recursive=False)
+
+
+def read_tar(file, directory: Path, max_bytes: int) -> int:
+    try:
+        return extract(file, directory, max_bytes)
+    except tarfile.TarError as e:
+        raise ArchiveError(f"archive unreadable: {e}")
+
+
+def box_directories(root: Path, path: Path):
+    # boxes run as their own user, like on the server every directory of a job is world writable
+    path.mkdir(parents=True, exist_ok=True)
+    while path.is_relative_to(root):
+        os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+        if path == root:
+            break
+        path = path.parent
+
+
+def extract(file, directory: Path, max_bytes: int) -> int:
+    # only regular files and directories inside directory are extracted, links are refused
+    total = 0
+    root = directory.resolve()
+    with tarfile.open(fileobj=file, mode="r|") as tar:
+        for member in tar:
+            target = (root / member.name).resolve()
+            if not target.is_relative_to(root) or target == root:
+                raise ArchiveError(f"archive member outside the job directory: {member.name}")
+
+            if member.isdir():
+                box_directories(root, target)
+                continue
+            if not member.isfile():
+                raise ArchiveError(f"archive member is not a file: {member.name}")
+
+            total += member.size
+            if total > max_bytes:
+                raise ArchiveError("archive exceeds the job quota")
+
+            box_directories(root, target.parent)
+            source = tar.extractfile(member)
+            with open(target, "wb") as f:
+                while chunk := source.read(CHUNK_BYTES):
+                    f.write(chunk)
+    return total
+
+
+def put(chunks: queue.Queue, chunk: Optional[bytes], stopped: threading.Event):
+    # gives up once the other side stopped, a dead reader or writer never blocks this one
+    while not stopped.is_set():
+        try:
+            chunks.put(chunk, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+
+
+class QueueWriter:
+    def __init__(self, chunks: queue.Queue, stopped: threading.Event):
+        self.chunks = chunks
+        self.stopped = stopped
+
+    def write(self, data: bytes) -> int:
+        if self.stopped.is_set():
+            raise ArchiveError("archive reader went away")
+        put(self.chunks, bytes(data), self.stopped)
+        return len(data)
+
+
+class QueueReader:
+    def __init__(self, chunks: queue.Queue):
+        self.chunks = chunks
+        self.buffer = b""
+        self.closed = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.closed and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.closed = True
+                break
+            self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def run_thread(target: Callable, *args) -> tuple[asyncio.Future, threading.Event]:
+    # a plain thread, a stalled peer must not hold a slot of the default executor
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    finished = threading.Event()
+
+    def resolve(result=None, error: Optional[BaseException] = None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run():
+        try:
+            result = target(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(resolve, result)
+        finally:
+            finished.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    return future, finished
+
+
+def iter_tar(directory: Path, names: Optional[Iterable[str]] = None) -> Iterator[bytes]:
+    chunks: queue.Queue = queue.Queue(QUEUE_CHUNKS)
+    stopped = threading.Event()
+    errors: list[BaseException] = []
+
+    def write():
+        try:
+            write_tar(directory, QueueWriter(chunks, stopped), names)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            put(chunks, None, stopped)
+
+    threading.Thread(target=write, daemon=True).start()
+    try:
+        while (chunk := chunks.get()) is not None:
+            yield chunk
+        if errors:
+            raise ArchiveError(f"archive failed: {errors[0]!r}")
+    finally:
+        stopped.set()
+
+
+async def stream_tar(directory: Path, names: Optional[Iterable[str]] = None) -> AsyncIterator[bytes]:
+    chunks = iter_tar(directory, names)
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+async def receive_tar(stream: AsyncIterator[bytes], directory: Path, max_bytes: int) -> int:
+    chunks: queue.Queue = queue.Queue(QUEUE_CHUNKS)
+    reader, finished = run_thread(read_tar, QueueReader(chunks), directory, max_bytes)
+
+    try:
+        async for chunk in stream:
+            # the reader stops early on a bad archive, the rest of the body is dropped
+            if finished.is_set():
+                break
+            await asyncio.to_thread(put, chunks, chunk, finished)
+    finally:
+        await asyncio.to_thread(put, chunks, None, finished)
+    return await reader
@@ -0,0 +1,328 @@
+from pathlib import Path
+from typing import Optional
+from asyncio import create_subprocess_exec as async_exec
+import shlex
+import shutil
+import asyncio
+import sys
+import os
+from app import logger, ENVIRONMENT, SETTINGS
+
+SUPERVISOR = Path(__file__).parent / "supervise.py"
+
+
+def read_meta(path: Path) -> dict[str, str]:
+    # isolate --meta writes one key:value per line, supervise.py writes the same format
+    try:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    return dict(line.split(":", 1) for line in lines if ":" in line)
+
+
+# a backend gives the pool a place to run the sandbox runner in, the pool leases boxes
+# prepare readies a box before it is leased, spawn starts the runner in it, collect reads
+# the resource usage of a finished run and release tears the box down again
+# root maps job directories of a worker node, the runner always sees the server's paths
+class SandboxBackend:
+    name = ""
+    maps_root = True
+    isolating = True
+
+    def __init__(self, memory: int, processes: int, timeout: float, root: Path = Path("/")):
+        self.memory = memory
+        self.processes = processes
+        self.timeout = timeout
+        self.root = root
+
+    async def start(self):
+        pass
+
+    async def prepare(self, box: int):
+        raise NotImplementedError
+
+    async def release(self, box: int):
+        raise NotImplementedError
+
+    async def spawn(
+        self, box: int, mount: Path, wall_time: int, args: list[str], meta: Optional[Path] = None, pipes: bool = False
+    ) -> asyncio.subprocess.Process:
+        raise NotImplementedError
+
+    async def collect(self, box: int, meta: Path) -> dict[str, str]:
+        return read_meta(meta)
+
+    def outside(self, path: Path) -> Path:
+        return self.root / path.relative_to("/")
+
+    def status(self) -> dict:
+        return {"name": self.name}
+
+
+async def wait_command(timeout: float, *cmd: str):
+    p = await async_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    code = await asyncio.wait_for(p.wait(), timeout)
+    if code != 0:
+        raise RuntimeError(f"{' '.join(cmd)} failed with exit code {code}")
+
+
+def pipe(pipes: bool) -> Optional[int]:
+    return asyncio.subprocess.PIPE if pipes else None
+
+
+# isolate boxes: namespaces, a cgroup and a chroot per box, set up by the setuid isolate binary
+class IsolateBackend(SandboxBackend):
+    name = "isolate"
+
+    async def isolate(self, box: int, *args: str):
+        await wait_command(self.timeout, "isolate", "--cg", *args, f"--box-id={box}")
+
+    async def prepare(self, box: int):
+        await self.isolate(box, "--init")
+
+    async def release(self, box: int):
+        await self.isolate(box, "--cleanup")
+
+    def bind(self, path: Path) -> str:
+        if self.root == Path("/"):
+            return str(path)
+        return f"{path}={self.outside(path)}"
+
+    def command(self, box: int, mount: Path, wall_time: int, *args: str, meta: Optional[Path] = None) -> list[str]:
+        # isolate manual: https://www.ucw.cz/moe/isolate.1.html
+        return [
+            "isolate",
+            *([f"--meta={meta}"] if meta else []),
+            "--share-net",  # internet
+            "--dir=/etc/",  # resolve.conf
+            "--cg",
+            "--cg-mem=104857600",
+            "--env",
+            "HOME=/box",
+            f"--box-id={box}",
+            "--dir=/tmp=",
+            f"--dir={self.bind(mount)}:rw",
+            f"--dir=/sandbox={ENVIRONMENT.SANDBOX}",
+            f"--processes={self.processes}",
+            f"--wall-time={wall_time}",
+            "--run",
+            "--",
+            "/sandbox/bin/python",
+            "-B",
+            "/sandbox/bin/sandbox",
+            *args,
+        ]
+
+    async def spawn(self, box, mount, wall_time, args, meta=None, pipes=False):
+        cmd = self.command(box, mount, wall_time, *args, meta=meta)
+        return await async_exec(*cmd, stdin=pipe(pipes), stdout=pipe(pipes))
+
+
+# the runner as a plain child process of the server in a scratch directory per box
+# rlimits bound it, nothing isolates it: it can read and write whatever the server can
+# meant for development and benchmarks, never for untrusted tools, create refuses it without SANDBOX_UNISOLATED
+class SubprocessBackend(SandboxBackend):
+    name = "subprocess"
+    maps_root = False
+    isolating = False
+
+    def __init__(
+        self,
+        memory: int,
+        processes: int,
+        timeout: float,
+        root: Path = Path("/"),
+        directory: Path = SETTINGS.SANDBOX_DIRECTORY,
+    ):
+        super().__init__(memory, processes, timeout, root)
+        self.directory = directory
+
+    def box_path(self, box: int) -> Path:
+        return self.directory / f"box-{box}"
+
+    async def prepare(self, box: int):
+        path = self.box_path(box)
+        await asyncio.to_thread(shutil.rmtree, path, ignore_errors=True)
+        path.mkdir(parents=True, mode=0o700)
+
+    async def release(self, box: int):
+        await asyncio.to_thread(shutil.rmtree, self.box_path(box), ignore_errors=True)
+
+    def supervise(self, box: int, wall_time: int, meta: Optional[Path]) -> list[str]:
+        return [
+            sys.executable,
+            "-I",
+            "-S",
+            str(SUPERVISOR),
+            *([f"--meta={meta}"] if meta else []),
+            f"--wall-time={wall_time}",
+            f"--mem={self.memory}",
+            "--",
+        ]
+
+    def wrap(self, box: int, mount: Path, command: list[str]) -> list[str]:
+        return command
+
+    async def spawn(self, box, mount, wall_time, args, meta=None, pipes=False):
+        home = self.box_path(box)
+        runner = [f"{ENVIRONMENT.SANDBOX}/bin/python", "-B", f"{ENVIRONMENT.SANDBOX}/bin/sandbox", *args]
+        cmd = self.supervise(box, wall_time, meta) + self.wrap(box, mount, runner)
+        env = {"PATH": "/usr/local/bin:/usr/bin:/bin", "HOME": str(home), "TMPDIR": str(home)}
+        return await async_exec(*cmd, cwd=home, env=env, stdin=pipe(pipes), stdout=pipe(pipes))
+
+
+# the runner in its own mount, pid, ipc and uts namespaces, started by unshare in milliseconds
+# every mount is remounted read-only, only the job directory and the box scratch directory
+# stay writable. job directories, server state, the result cache and the database are
+# covered before that, and the runner drops root for a uid of its own like isolate boxes,
+# so it can not remount anything. the network is shared like isolate --share-net
+# memory and process count are capped by a cgroup v2 per box below cgroup, the box peak
+# memory is read from it. without a writable cgroup v2 hierarchy with the memory and pids
+# controllers only the rlimits of the supervisor apply
+class NamespaceBackend(SubprocessBackend):
+    name = "namespace"
+    maps_root = True
+    isolating = True
+    # box n runs as uid 60000 + n, the isolate default
+    first_uid = 60000
+
+    def __init__(
+        self,
+        memory: int,
+        processes: int,
+        timeout: float,
+        root: Path = Path("/"),
+        directory: Path = SETTINGS.SANDBOX_DIRECTORY,
+        cgroup: Path = SETTINGS.SANDBOX_CGROUP,
+    ):
+        super().__init__(memory, processes, timeout, root, directory)
+        self.cgroup = cgroup
+        self.cgroups = False
+
+    async def start(self):
+        try:
+            # on a cgroup v1 host the directory is not a cgroup, nothing may be written to it
+            if not (self.cgroup.parent / "cgroup.controllers").exists():
+                raise OSError(f"{self.cgroup.parent} is not a cgroup v2 hierarchy")
+            self.cgroup.mkdir(exist_ok=True)
+            (self.cgroup / "cgroup.subtree_control").write_text("+memory +pids")
+            self.cgroups = True
+        except OSError as e:
+            logger.warning(f"no cgroup v2 at {self.cgroup}, boxes are limited by rlimits only: {e!r}")
+
+    def cgroup_path(self, box: int) -> Path:
+        return self.cgroup / f"box-{box}"
+
+    def stage_path(self, box: int) -> Path:
+        return self.directory / f"stage-{box}"
+
+    def uid(self, box: int) -> int:
+        return self.first_uid + box
+
+    def hidden_directories(self) -> list[Path]:
+        directories = [SETTINGS.JOBS_DIRECTORY, SETTINGS.STATE_DIRECTORY, SETTINGS.RESULT_CACHE_DIRECTORY]
+        if self.root != Path("/"):
+            directories.append(self.outside(SETTINGS.JOBS_DIRECTORY))
+        return directories
+
+    def hidden_files(self) -> list[Path]:
+        # worker nodes have no database
+        if ENVIRONMENT.DATABASE is None:
+            return []
+        return [Path(ENVIRONMENT.DATABASE + suffix) for suffix in ("", "-wal", "-shm", "-journal")]
+
+    async def prepare(self, box: int):
+        await super().prepare(box)
+        # the scratch directory belongs to the box uid, the stage only holds the job directory mount
+        os.chown(self.box_path(box), self.uid(box), self.uid(box))
+        self.stage_path(box).mkdir(mode=0o700, exist_ok=True)
+        if self.cgroups:
+            path = self.cgroup_path(box)
+            path.mkdir(exist_ok=True)
+            (path / "memory.max").write_text(str(self.memory * 1024))
+            (path / "memory.swap.max").write_text("0")
+            (path / "pids.max").write_text(str(self.processes))
+
+    async def release(self, box: int):
+        path = self.cgroup_path(box)
+        if self.cgroups and path.exists():
+            (path / "cgroup.kill").write_text("1")
+            # killed processes leave the cgroup asynchronously, it can only be removed empty
+            deadline = asyncio.get_running_loop().time() + self.timeout
+            while True:
+                try:
+                    path.rmdir()
+                    break
+                except OSError:
+                    if asyncio.get_running_loop().time() > deadline:
+                        raise
+                    await asyncio.sleep(0.01)
+        await asyncio.to_thread(shutil.rmtree, self.stage_path(box), ignore_errors=True)
+        await super().release(box)
+
+    def supervise(self, box: int, wall_time: int, meta: Optional[Path]) -> list[str]:
+        cmd = super().supervise(box, wall_time, meta)
+        if not self.cgroups:
+            return cmd
+        # the cgroup bounds memory, an address space limit would only break large mappings
+        cmd = [arg for arg in cmd if not arg.startswith("--mem=")]
+        return cmd[:-1] + [f"--cgroup={self.cgroup_path(box)}", "--"]
+
+    def wrap(self, box: int, mount: Path, command: list[str]) -> list[str]:
+        home = shlex.quote(str(self.box_path(box)))
+        stage = shlex.quote(str(self.stage_path(box)))
+        target = shlex.quote(str(mount))
+        source = shlex.quote(str(self.outside(mount)))
+        # mountinfo escapes spaces in mount points, a mount that can not be made read-only fails the run
+        readonly = (
+            "awk '{print $5}' /proc/self/mountinfo | sed 's/\\\\040/ /g' | while IFS= read -r point; do"
+            f' if [ "$point" != {target} ] && [ "$point" != {home} ];'
+            ' then mount -o remount,bind,ro "$point" || exit 1; fi; done'
+        )
+        # covered by empty mounts, a path that does not exist has nothing to hide
+        directories = [shlex.quote(str(path)) for path in self.hidden_directories()]
+        files = [shlex.quote(str(path)) for path in self.hidden_files()]
+        hide = [f"{{ [ ! -d {path} ] || mount -t tmpfs -o size=1m,mode=0755 hidden {path}; }}" for path in directories]
+        hide += [f"{{ [ ! -f {path} ] || mount --bind /dev/null {path}; }}" for path in files]
+        uid = self.uid(box)
+        script = " && ".join(
+            [
+                "mount --make-rprivate /",
+                # the job directory is staged first, the directory it lives in is covered next
+                f"mount --bind {source} {stage}",
+                *hide,
+                f"mkdir -p {target}",
+                f"mount --move {stage} {target}",
+                f"mount --bind {home} {home}",
+                readonly,
+                f'exec setpriv --reuid={uid} --regid={uid} --clear-groups --bounding-set=-all --no-new-privs "$@"',
+            ]
+        )
+        namespaces = ["--mount", "--pid", "--ipc", "--uts", "--fork", "--kill-child", "--mount-proc"]
+        return ["unshare", *namespaces, "sh", "-c", script, "sh", *command]
+
+    async def collect(self, box: int, meta: Path) -> dict[str, str]:
+        stats = await super().collect(box, meta)
+        try:
+            # in bytes, isolate reports cg-mem in KiB
+            stats["cg-mem"] = str(int((self.cgroup_path(box) / "memory.peak").read_text()) // 1024)
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    def status(self) -> dict:
+        return {"name": self.name, "cgroup": str(self.cgroup) if self.cgroups else None}
+
+
+BACKENDS = {backend.name: backend for backend in (IsolateBackend, NamespaceBackend, SubprocessBackend)}
+
+
+def create(name: str, memory: int, processes: int, timeout: float, root: Path = Path("/")) -> SandboxBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"unknown sandbox backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    if root != Path("/") and not BACKENDS[name].maps_root:
+        raise ValueError(f"the {name} backend can not run jobs of a worker node root")
+    if not BACKENDS[name].isolating and not SETTINGS.SANDBOX_UNISOLATED:
+        raise ValueError(f"the {name} backend does not isolate tools, set SANDBOX_UNISOLATED=1 to use it anyway")
+    return BACKENDS[name](memory, processes, timeout, root)
@@ -0,0 +1,254 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Optional
+import dataclasses
+import hashlib
+import threading
+import stat
+import secrets
+import asyncio
+import shutil
+import json
+import time
+import os
+
+from app.utility import serializer
+from app import logger
+
+CACHE_TAG = "cache"
+RESULT_FILE = "result.json"
+CACHED_PATH = "__cached__"
+
+# staging directories this old belong to a process that died while storing
+STAGING_AGE = 60 * 60
+
+
+def file_digest(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def map_paths(results: Any, func: Callable[[Path], Any]) -> Any:
+    if isinstance(results, Path):
+        return func(results)
+    if isinstance(results, serializer.BinaryRef):
+        return dataclasses.replace(results, path=map_paths(results.path, func))
+    if isinstance(results, dict) and CACHED_PATH in results:
+        return func(Path(results[CACHED_PATH]))
+    if isinstance(results, dict):
+        return {k: map_paths(v, func) for k, v in results.items()}
+    if isinstance(results, list):
+        return [map_paths(v, func) for v in results]
+    return results
+
+
+def normalize_arguments(kwargs: dict[str, Any], digests: Optional[dict[Path, str]] = None) -> dict:
+    # files are identified by name and content, not by the job directory they were uploaded to
+    digests = digests or {}
+
+    def normalize(value: Path):
+        digest = digests.get(value) or file_digest(value)
+        return {"__file__": value.name, "sha256": digest}
+
+    return {k: map_paths(v, normalize) for k, v in sorted(kwargs.items())}
+
+
+def arguments_digest(kwargs: dict[str, Any], digests: Optional[dict[Path, str]] = None) -> str:
+    payload = json.dumps(normalize_arguments(kwargs, digests), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def entry_size(entry: Path) -> int:
+    return sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+
+
+def copy_file(source: Path, destination: Path):
+    # never a hard link, a later pipeline step could change the shared file through the job directory
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(source, destination)
+
+
+# results are stored under the sha256 of tool code, arguments and input file contents
+# entries are evicted least recently used first, by total size and by age
+# with several web processes the directory is the index: every process picks up entries
+# stored by the others, only the leader evicts and rescans every interval
+# loads, stores and scans do file work and run in threads, the lock guards the index
+class ResultCache:
+    def __init__(self, directory: Path, max_bytes: int, max_age: float, interval: float = 60, shared: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self.shared = shared
+        self.evicting = not shared
+        self.entries: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.task: Optional[asyncio.Task] = None
+        self.lock = threading.RLock()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(size for size, _ in self.entries.values())
+
+    def enabled(self, tags: list[str]) -> bool:
+        return self.max_bytes > 0 and CACHE_TAG in tags
+
+    def scan(self):
+        with self.lock:
+            if self.max_bytes <= 0:
+                return
+
+            self.directory.mkdir(parents=True, exist_ok=True)
+            found = []
+            for entry in self.directory.iterdir():
+                try:
+                    accessed = entry.stat().st_mtime
+                    if entry.name.startswith("."):
+                        # other processes may be storing right now
+                        if not self.shared or time.time() - accessed > STAGING_AGE:
+                            shutil.rmtree(entry, ignore_errors=True)
+                        continue
+                    size = self.entries[entry.name][0] if entry.name in self.entries else entry_size(entry)
+                except FileNotFoundError:
+                    continue
+                found.append((accessed, entry.name, size))
+
+            # access times live on disk, loads by any process touch the entry
+            self.entries = OrderedDict((key, (size, accessed)) for accessed, key, size in sorted(found))
+            self.evict()
+
+    def start(self):
+        # the started cache owns eviction, with several processes that is the leader
+        self.evicting = True
+        if self.shared and self.max_bytes > 0:
+            self.task = asyncio.create_task(self.run(), name="result-cache")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.scan)
+            except OSError as e:
+                logger.error(f"result cache scan failed: {e!r}")
+
+    def adopt(self, key: str):
+        # stored by another process
+        with self.lock:
+            entry = self.directory / key
+            try:
+                self.entries[key] = (entry_size(entry), entry.stat().st_mtime)
+            except FileNotFoundError:
+                pass
+
+    def key(self, code: str, kwargs: dict[str, Any], digests: Optional[dict[Path, str]] = None) -> str:
+        payload = {
+            "code": hashlib.sha256(code.encode()).hexdigest(),
+            "kwargs": normalize_arguments(kwargs, digests),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key: str, temp_dir: Path) -> Optional[Any]:
+        with self.lock:
+            entry = self.directory / key
+            if self.shared and key not in self.entries:
+                self.adopt(key)
+
+            expired = key in self.entries and time.time() - self.entries[key][1] > self.max_age
+            if key not in self.entries or expired or not entry.exists():
+                self.entries.pop(key, None)
+                if self.evicting:
+                    shutil.rmtree(entry, ignore_errors=True)
+                self.misses += 1
+                return None
+
+            def restore(path: Path):
+                copy_file(entry / "files" / path, temp_dir / path)
+                return temp_dir / path
+
+            try:
+                with open(entry / RESULT_FILE, "r") as f:
+                    results = serializer.load(f)
+                results = map_paths(results, restore)
+            except FileNotFoundError:
+                # evicted by the leader while loading
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            size, _ = self.entries.pop(key)
+            self.entries[key] = (size, time.time())
+            try:
+                os.utime(entry)
+            except FileNotFoundError:
+                pass
+            self.hits += 1
+            return results
+
+    def store(self, key: str, results: Any, temp_dir: Path):
+        with self.lock:
+            if key in self.entries:
+                return
+
+            staging = self.directory / f".{key}-{secrets.token_hex(4)}"
+            files = staging / "files"
+
+            def relative(path: Path):
+                path = path.resolve()
+                if not path.is_relative_to(temp_dir.resolve()) or not path.is_file():
+                    raise ValueError(f"uncacheable result path {path}")
+                path = path.relative_to(temp_dir.resolve())
+                copy_file(temp_dir / path, files / path)
+                os.chmod(files / path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                return {CACHED_PATH: str(path)}
+
+            try:
+                files.mkdir(parents=True)
+                stored = map_paths(results, relative)
+                with open(staging / RESULT_FILE, "w") as f:
+                    serializer.dump(stored, f)
+                size = entry_size(staging)
+                os.rename(staging, self.directory / key)
+            except (OSError, ValueError) as e:
+                logger.info(f"result not cached: {e}")
+                shutil.rmtree(staging, ignore_errors=True)
+                return
+
+            self.entries[key] = (size, time.time())
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            if not self.evicting:
+                return
+
+            now = time.time()
+            total = self.total_bytes
+
+            while self.entries:
+                key, (size, accessed) = next(iter(self.entries.items()))
+                if total <= self.max_bytes and now - accessed <= self.max_age:
+                    break
+                del self.entries[key]
+                total -= size
+                shutil.rmtree(self.directory / key, ignore_errors=True)
+
+    def status(self) -> dict:
+        with self.lock:
+            entries, total = len(self.entries), self.total_bytes
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "max_age": self.max_age,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
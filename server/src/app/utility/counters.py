@@ -0,0 +1,68 @@
+from collections import Counter
+from sqlmodel import Session, SQLModel
+from typing import Optional
+import asyncio
+
+from app.models import tools as db_tools
+from app import logger
+
+
+# runs and votes are counted in memory and written in one transaction per interval
+# the run path never waits on the sqlite write lock, stop writes what is left
+class CounterAggregator:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.usage: Counter[int] = Counter()
+        self.votes: list[SQLModel] = []
+        self.flushes = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def add_usage(self, tool_id: int, count: int = 1):
+        self.usage[tool_id] += count
+
+    def add_vote(self, vote: SQLModel):
+        # UpVote, DownVote or Report rows
+        self.votes.append(vote)
+
+    def pending_usage(self, tool_id: int) -> int:
+        return self.usage[tool_id]
+
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name="counter-flush")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.usage and not self.votes:
+            return
+
+        usage, self.usage = self.usage, Counter()
+        votes, self.votes = self.votes, []
+
+        try:
+            with Session(db_tools.engine) as session:
+                await db_tools.run_sync(db_tools.flush_counters, session, dict(usage), votes)
+        except Exception as e:
+            # keep the counts, the next flush tries again
+            logger.error(f"counter flush failed: {e!r}")
+            self.usage.update(usage)
+            self.votes[:0] = votes
+            return
+
+        self.flushes += 1
+
+    def status(self) -> dict:
+        return {
+            "pending_usage": sum(self.usage.values()),
+            "pending_votes": len(self.votes),
+            "flushes": self.flushes,
+        }
@@ -0,0 +1,196 @@
+from python_multipart.multipart import MultipartParser, QuerystringParser, parse_options_header
+from starlette.requests import Request
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Optional
+from urllib.parse import unquote_plus
+import hashlib
+import stat
+import os
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadInvalid(Exception):
+    pass
+
+
+@dataclass
+class IngestedFile:
+    path: Path
+    size: int = 0
+    sha256: str = ""
+
+
+@dataclass
+class _Part:
+    name: str = ""
+    path: Optional[Path] = None
+    data: bytearray = field(default_factory=bytearray)
+    file: Optional[BinaryIO] = None
+    hasher: Any = None
+    size: int = 0
+
+
+def box_directory(path: Path) -> Path:
+    # boxes run as their own user, like the job directory every subdirectory is world writable
+    path.mkdir(exist_ok=True)
+    os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+    return path
+
+
+def indexed_directory(directory: Path, name: str, prefix: str, limit: int) -> Path:
+    # uploads for batches and pipelines are named "<index>.<argument>"
+    index, _, argument = name.partition(".")
+    if not index.isdigit() or int(index) >= limit or not argument:
+        raise UploadInvalid(f"upload {name} must be named <index>.<argument>")
+
+    return box_directory(directory / f"{prefix}-{int(index)}")
+
+
+# streams a form body straight into directory, files are never held in memory
+# byte limits are enforced and file digests computed while the body arrives
+class FormIngest:
+    def __init__(
+        self,
+        directory: Path,
+        max_file_bytes: int,
+        max_request_bytes: int,
+        max_field_bytes: int = 1 << 16,
+        directory_for: Optional[Callable[[str], Path]] = None,
+    ):
+        self.directory = directory
+        self.directory_for = directory_for
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.max_field_bytes = max_field_bytes
+
+        self.fields: dict[str, str] = {}
+        self.files: dict[str, IngestedFile] = {}
+        self.received = 0
+        self.urlencoded = False
+
+        self.part = _Part()
+        self.header_name = b""
+        self.header_value = b""
+        self.disposition = b""
+
+    async def ingest(self, request: Request) -> tuple[dict[str, str], dict[str, IngestedFile]]:
+        length = request.headers.get("content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_request_bytes:
+            raise UploadTooLarge(f"Request exceeds {self.max_request_bytes} bytes")
+
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+
+        if content_type == b"multipart/form-data":
+            if b"boundary" not in params:
+                raise UploadInvalid("Missing multipart boundary")
+            parser = MultipartParser(params[b"boundary"], self.multipart_callbacks())
+        elif content_type == b"application/x-www-form-urlencoded":
+            parser = QuerystringParser(self.querystring_callbacks())
+            self.urlencoded = True
+        else:
+            return self.fields, self.files
+
+        try:
+            async for chunk in request.stream():
+                self.received += len(chunk)
+                if self.received > self.max_request_bytes:
+                    raise UploadTooLarge(f"Request exceeds {self.max_request_bytes} bytes")
+                parser.write(chunk)
+            parser.finalize()
+        finally:
+            if self.part.file is not None:
+                self.part.file.close()
+
+        return self.fields, self.files
+
+    def multipart_callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def querystring_callbacks(self) -> dict:
+        return {
+            "on_field_start": self.on_part_begin,
+            "on_field_name": self.on_field_name,
+            "on_field_data": self.on_part_data,
+            "on_field_end": self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self.part = _Part()
+
+    def on_field_name(self, data: bytes, start: int, end: int):
+        self.part.name += data[start:end].decode("latin-1")
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        if self.header_name.lower() == b"content-disposition":
+            self.disposition = self.header_value
+        self.header_name = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.disposition)
+        self.disposition = b""
+
+        if b"name" not in options:
+            raise UploadInvalid('Content-Disposition "name" missing')
+        self.part.name = options[b"name"].decode()
+
+        if b"filename" not in options:
+            return
+
+        # only the base name is kept, uploads can not escape the job directory
+        filename = Path(options[b"filename"].decode()).name or "upload"
+        directory = self.directory_for(self.part.name) if self.directory_for else self.directory
+        self.part.path = directory / filename
+        self.part.file = open(self.part.path, "wb")
+        self.part.hasher = hashlib.sha256()
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        self.part.size += len(chunk)
+
+        if self.part.file is None:
+            if self.part.size > self.max_field_bytes:
+                raise UploadTooLarge(f"Field {self.part.name} exceeds {self.max_field_bytes} bytes")
+            self.part.data.extend(chunk)
+            return
+
+        if self.part.size > self.max_file_bytes:
+            raise UploadTooLarge(f"File {self.part.path.name} exceeds {self.max_file_bytes} bytes")
+        self.part.file.write(chunk)
+        self.part.hasher.update(chunk)
+
+    def on_part_end(self):
+        if self.part.file is None and self.urlencoded:
+            name = unquote_plus(self.part.name)
+            self.fields[name] = unquote_plus(self.part.data.decode("latin-1"))
+            return
+
+        if self.part.file is None:
+            self.fields[self.part.name] = self.part.data.decode(errors="replace")
+            return
+
+        self.part.file.close()
+        self.files[self.part.name] = IngestedFile(
+            path=self.part.path,
+            size=self.part.size,
+            sha256=self.part.hasher.hexdigest(),
+        )
+        self.part = _Part()
@@ -0,0 +1,273 @@
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Literal, Optional
+from fastapi import HTTPException
+from pathlib import Path
+import asyncio
+import time
+import os
+
+from app.utility import serializer
+from app import ALLOWED_CHARACTERS, logger
+
+JobStatus = Literal["queued", "running", "done", "failed"]
+
+# written by sandbox/report.py inside the job directory
+PROGRESS_FILE = "progress.jsonl"
+PROGRESS_INTERVAL = 0.25
+
+# partial results are kept for late listeners, a long sweep keeps only the first ones
+MAX_PARTIALS = 100
+
+
+@dataclass
+class Job:
+    id: str
+    tool_id: int
+    workdir: Optional[Path] = None
+    status: JobStatus = "queued"
+    result: Any = None
+    error: Optional[str] = None
+    progress: Optional[dict] = None
+    partials: list = field(default_factory=list)
+    created: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def update(self, status: JobStatus, result: Any = None, error: Optional[str] = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.notify()
+
+    def report(self, event: dict):
+        if "partial" in event and len(self.partials) < MAX_PARTIALS:
+            self.partials.append(event["partial"])
+        if "progress" in event:
+            self.progress = {"fraction": event["progress"], "message": event.get("message", "")}
+        self.notify()
+
+    def notify(self):
+        self.updated = time.time()
+
+        # wake every listener, later listeners wait on a fresh event
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def summary(self, seen: int = 0) -> dict:
+        return {
+            "id": self.id,
+            "tool_id": self.tool_id,
+            "status": self.status,
+            "progress": self.progress,
+            "partials": self.partials[seen:],
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+def read_events(path: Path, offset: int) -> tuple[list[dict], int]:
+    # only complete lines are read, a line still being written is picked up next time
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], offset
+
+    end = data.rfind(b"\n") + 1
+    events = []
+    for line in data[:end].splitlines():
+        try:
+            event = serializer.loads(line)
+        except ValueError:
+            continue
+        if isinstance(event, dict):
+            events.append(event)
+    return events, offset + end
+
+
+def write_state(path: Path, job: Job):
+    state = {
+        "tool_id": job.tool_id,
+        "workdir": job.workdir,
+        "status": job.status,
+        "result": job.result,
+        "error": job.error,
+    }
+    temp = path.with_name(f".{path.name}")
+    with open(temp, "w") as f:
+        serializer.dump(state, f)
+    os.replace(temp, path)
+
+
+def read_state(path: Path, mtime: float = 0.0) -> tuple[Optional[dict], float]:
+    # unchanged since mtime reads as None
+    try:
+        modified = path.stat().st_mtime
+        if modified == mtime:
+            return None, mtime
+        with open(path, "r") as f:
+            state = serializer.load(f)
+    except (OSError, ValueError):
+        return None, mtime
+    return (state, modified) if isinstance(state, dict) else (None, mtime)
+
+
+# a job submitted to another web process, nothing here notifies its listeners
+# so waiting polls the state file the owner writes and the progress file of the run
+@dataclass
+class MirroredJob(Job):
+    state: Optional[Path] = None
+    mtime: float = 0.0
+    offset: int = 0
+
+    async def refresh(self):
+        # the state is read first, a finished job wrote all of its progress before it
+        state, self.mtime = await asyncio.to_thread(read_state, self.state, self.mtime)
+        if self.workdir is not None:
+            events, self.offset = await asyncio.to_thread(read_events, self.workdir / PROGRESS_FILE, self.offset)
+            for event in events:
+                self.report(event)
+        if state is not None:
+            self.update(state["status"], state["result"], state["error"])
+
+    async def wait(self, timeout: float) -> bool:
+        changed = self.changed
+        deadline = time.monotonic() + timeout
+        while not changed.is_set():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            await self.refresh()
+        return True
+
+
+# tails the progress file of a running job and reports each event to the job
+class ProgressFollower:
+    def __init__(self, job: Job, path: Path):
+        self.job = job
+        self.path = path
+        self.offset = 0
+
+    async def poll(self):
+        events, self.offset = await asyncio.to_thread(read_events, self.path, self.offset)
+        for event in events:
+            self.job.report(event)
+
+    async def run(self, interval: float = PROGRESS_INTERVAL):
+        while True:
+            await self.poll()
+            await asyncio.sleep(interval)
+
+
+# jobs run as background tasks, the request returns as soon as the job is queued
+# finished jobs are forgotten after retention seconds
+# with a state directory every status change is also written there, so any web process
+# can answer for a job, the process that runs it still holds it in memory
+class JobManager:
+    def __init__(self, retention: float = 60 * 10, directory: Optional[Path] = None, prune_interval: float = 60):
+        self.retention = retention
+        self.directory = directory
+        self.prune_interval = prune_interval
+        self.jobs: dict[str, Job] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.pruned = 0.0
+
+    def get(self, id: str) -> Optional[Job]:
+        return self.jobs.get(id)
+
+    async def find(self, id: str) -> Optional[Job]:
+        job = self.jobs.get(id)
+        if job is not None or self.directory is None:
+            return job
+        if not id or any(c not in ALLOWED_CHARACTERS for c in id):
+            return None
+
+        state, _ = await asyncio.to_thread(read_state, self.state_path(id))
+        if state is None:
+            return None
+
+        mirror = MirroredJob(id=id, tool_id=state["tool_id"], workdir=state["workdir"], state=self.state_path(id))
+        await mirror.refresh()
+        return mirror
+
+    def state_path(self, id: str) -> Path:
+        return self.directory / f"{id}.json"
+
+    async def save(self, job: Job):
+        if self.directory is None:
+            return
+        try:
+            await asyncio.to_thread(write_state, self.state_path(job.id), job)
+        except OSError as e:
+            logger.error(f"job {job.id} state not written: {e!r}")
+
+    def submit(
+        self, id: str, tool_id: int, run: Callable[[Job], Awaitable[Any]], workdir: Optional[Path] = None
+    ) -> Job:
+        self.prune()
+
+        job = Job(id=id, tool_id=tool_id, workdir=workdir)
+        self.jobs[id] = job
+        if self.directory is not None:
+            # written before the response, the next poll may reach another process
+            write_state(self.state_path(id), job)
+
+        task = asyncio.create_task(self.execute(job, run), name=f"job-{id}")
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    async def execute(self, job: Job, run: Callable[[Job], Awaitable[Any]]):
+        job.update("running")
+        await self.save(job)
+        try:
+            job.update("done", result=await run(job))
+        except HTTPException as e:
+            job.update("failed", error=e.detail)
+        except asyncio.CancelledError:
+            # pollers and streams see why the job ended, not a dropped connection
+            job.update("failed", error="Server shutting down")
+            await self.save(job)
+            raise
+        except Exception as e:
+            logger.error(f"job {job.id} failed: {e!r}")
+            job.update("failed", error="Runner Failed")
+        await self.save(job)
+
+    def prune(self):
+        now = time.time()
+        expired = [id for id, job in self.jobs.items() if job.finished and now - job.updated > self.retention]
+        for id in expired:
+            del self.jobs[id]
+
+        if self.directory is None or now - self.pruned < self.prune_interval:
+            return
+        self.pruned = now
+
+        # state files of every process, a job finishes long before its file is this old
+        for path in self.directory.glob("*.json"):
+            try:
+                if now - path.stat().st_mtime > self.retention:
+                    path.unlink()
+            except FileNotFoundError:
+                continue
+
+    async def stop(self, timeout: float = 0):
+        # running jobs get timeout seconds to finish, the rest are failed and cancelled
+        if self.tasks and timeout > 0:
+            await asyncio.wait(self.tasks, timeout=timeout)
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
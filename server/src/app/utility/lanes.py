@@ -0,0 +1,73 @@
+from sqlmodel import Session
+from typing import Optional
+import asyncio
+import time
+
+from app.utility.metadata import ToolMetadata
+from app.models import tools as db_tools
+from app import logger
+
+INTERACTIVE = "interactive"
+HEAVY = "heavy"
+BATCH = "batch"
+LANES = (INTERACTIVE, HEAVY, BATCH)
+
+# weight of the latest run in the in-memory runtime average
+RUNTIME_SMOOTHING = 0.2
+
+
+# tools are sorted into lanes by their mean runtime from the run history
+# the history is re-read every interval, runs on this worker update the mean at once
+# so a new tool that turns out heavy leaves the interactive lane after its first runs
+class LaneAssigner:
+    def __init__(self, heavy_seconds: float, history_age: float, interval: float = 60):
+        self.heavy_seconds = heavy_seconds
+        self.history_age = history_age
+        self.interval = interval
+        self.runtimes: dict[int, float] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name="lane-refresh")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        try:
+            with Session(db_tools.engine) as session:
+                since = time.time() - self.history_age
+                history = await db_tools.run_sync(db_tools.get_tool_runtimes, session, since)
+        except Exception as e:
+            logger.error(f"lane refresh failed: {e!r}")
+            return
+
+        # the history wins where it has runs, tools not written yet keep their local mean
+        self.runtimes = {**self.runtimes, **history}
+
+    def observe(self, tool_id: int, runtime: float):
+        previous = self.runtimes.get(tool_id)
+        if previous is None:
+            self.runtimes[tool_id] = runtime
+        else:
+            self.runtimes[tool_id] = previous + RUNTIME_SMOOTHING * (runtime - previous)
+
+    def lane_for(self, tool: ToolMetadata, batch: bool = False) -> str:
+        if tool.lane in LANES:
+            return tool.lane
+        if batch:
+            return BATCH
+        if self.runtimes.get(tool.id, 0.0) > self.heavy_seconds:
+            return HEAVY
+        return INTERACTIVE
+
+    def status(self) -> dict:
+        heavy = sum(runtime > self.heavy_seconds for runtime in self.runtimes.values())
+        return {"measured": len(self.runtimes), "heavy": heavy}
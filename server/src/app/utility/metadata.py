@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from sqlmodel import Session
+from typing import Optional
+import hashlib
+import asyncio
+
+from app.models import tools as db_tools
+from app.utility import render
+from app import logger
+
+
+@dataclass(frozen=True)
+class ToolMetadata:
+    id: int
+    name: str
+    code: str
+    code_hash: str
+    arguments: dict[str, tuple[str, str]]
+    argument_schema: Optional[dict[str, dict]]
+    tags: list[str]
+    public: bool
+    user_id: int
+    lane: Optional[str]
+    form: render.CompiledForm
+
+    @classmethod
+    def from_tool(cls, tool: db_tools.Tool) -> "ToolMetadata":
+        return cls(
+            id=tool.id,
+            name=tool.name,
+            code=tool.code,
+            code_hash=hashlib.sha256(tool.code.encode()).hexdigest(),
+            arguments=dict(tool.arguments),
+            argument_schema=tool.argument_schema,
+            tags=list(tool.tags),
+            public=tool.public,
+            user_id=tool.user_id,
+            lane=tool.lane,
+            form=render.compile_form(tool.arguments),
+        )
+
+
+# parsed tools are kept in memory, hot tools are served without touching the database
+# changes made here are dropped at once, changes from other workers within poll_interval
+class MetadataCache:
+    def __init__(self, size: int, poll_interval: float):
+        self.size = size
+        self.poll_interval = poll_interval
+        self.entries: OrderedDict[int, ToolMetadata] = OrderedDict()
+        self.version = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        with Session(db_tools.engine) as session:
+            self.version = await db_tools.run_sync(db_tools.get_latest_tool_version, session)
+        self.task = asyncio.create_task(self.poll(), name="metadata-poll")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                with Session(db_tools.engine) as session:
+                    changes = await db_tools.run_sync(db_tools.get_tool_versions, session, self.version)
+            except Exception as e:
+                logger.error(f"metadata poll failed: {e!r}")
+                continue
+
+            for tool_id, version in changes:
+                self.drop(tool_id)
+                self.version = max(self.version, version)
+
+    def drop(self, tool_id: int):
+        self.entries.pop(tool_id, None)
+        self.generation += 1
+
+    async def get(self, session: Session, tool_id: int) -> Optional[ToolMetadata]:
+        if tool_id in self.entries:
+            self.entries.move_to_end(tool_id)
+            self.hits += 1
+            return self.entries[tool_id]
+
+        self.misses += 1
+        generation = self.generation
+        tool = await db_tools.run_sync(db_tools.get_tool_by_id, session, tool_id)
+        if tool is None:
+            return None
+
+        # a tool dropped while the query ran may have been read before the change
+        metadata = ToolMetadata.from_tool(tool)
+        if generation == self.generation:
+            self.store(metadata)
+        return metadata
+
+    def store(self, metadata: ToolMetadata):
+        if self.size <= 0:
+            return
+        self.entries[metadata.id] = metadata
+        self.entries.move_to_end(metadata.id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    async def invalidate(self, session: Session, tool_id: int, tool: Optional[db_tools.Tool] = None):
+        # a changed tool is parsed and its form rendered here, not on the next page view
+        self.drop(tool_id)
+        await db_tools.run_sync(db_tools.bump_tool_version, session, tool_id)
+        if tool is not None:
+            # attributes expired on commit, reading them reloads the row
+            self.store(await db_tools.run_sync(ToolMetadata.from_tool, tool))
+
+    def status(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+import asyncio
+import fcntl
+import time
+import os
+
+
+# web processes behind one port claim a slot by holding its lock file for their lifetime
+# the slot picks the isolate boxes of the process, slot 0 also owns the housekeeping that
+# must run once: reaping job directories, evicting cached results, pruning run history
+# a process that dies drops its lock, the process started in its place takes the slot
+class ProcessSlot:
+    def __init__(self, directory: Path, slots: int):
+        self.directory = directory
+        self.slots = slots
+        self.index: Optional[int] = None
+        self.fd: Optional[int] = None
+
+    @property
+    def leader(self) -> bool:
+        return self.index == 0
+
+    @property
+    def shared(self) -> bool:
+        return self.slots > 1
+
+    def try_claim(self, index: int) -> bool:
+        fd = os.open(self.directory / f"slot-{index}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        self.index, self.fd = index, fd
+        return True
+
+    async def claim(self, timeout: float = 30) -> int:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            for index in range(self.slots):
+                if self.try_claim(index):
+                    return index
+
+            # a replaced process can hold its slot for a moment while it shuts down
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"no free process slot in {self.directory}")
+            await asyncio.sleep(0.5)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.index, self.fd = None, None
+
+    def status(self) -> dict:
+        return {"slot": self.index, "leader": self.leader, "pid": os.getpid(), "processes": self.slots}
+
+
+@contextmanager
+def file_lock(path: Path):
+    # blocks until no other process holds it
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def lock_directory(path: Path) -> int:
+    # a shared lock marks a job directory as in use, any process can test for it
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    return fd
+
+
+def unlock_directory(fd: int):
+    os.close(fd)
+
+
+def directory_locked(path: Path) -> bool:
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
@@ -0,0 +1,202 @@
+from pathlib import Path
+from typing import Optional
+import asyncio
+import shutil
+import heapq
+import time
+
+from app.utility import processes
+from app import logger
+
+# directories created by other web processes are picked up this often
+SHARED_SCAN_INTERVAL = 10
+
+
+def directory_size(directory: Path) -> int:
+    return sum(f.stat().st_size for f in directory.rglob("*") if f.is_file())
+
+
+# one task deletes every job directory, ordered by expiry in a heap
+# directories are also evicted oldest first when the quota or free disk space runs out
+# directories still in use by a request or job are only removed once expired
+# with several web processes every process locks the directories it uses, only the
+# leader runs the task and rescans for directories the other processes created
+class JobReaper:
+    def __init__(
+        self,
+        directory: Path,
+        ttl: float,
+        quota: int,
+        min_free: int,
+        interval: float = 60,
+        shared: bool = False,
+    ):
+        self.directory = directory
+        self.ttl = ttl
+        self.quota = quota
+        self.min_free = min_free
+        self.interval = min(interval, SHARED_SCAN_INTERVAL) if shared else interval
+        self.shared = shared
+
+        self.heap: list[tuple[float, str]] = []
+        self.sizes: dict[str, int] = {}
+        self.active: dict[str, int] = {}
+        self.locks: dict[str, int] = {}
+        # in use by another process when last scanned, measured once released
+        self.unmeasured: set[str] = set()
+        self.evicted = 0
+        self.expired = 0
+
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def scan(self):
+        for entry in self.directory.iterdir():
+            if not entry.is_dir() or entry.name in self.sizes:
+                continue
+            try:
+                expires = entry.stat().st_mtime + self.ttl
+                size = directory_size(entry)
+            except FileNotFoundError:
+                continue
+            heapq.heappush(self.heap, (expires, entry.name))
+            self.sizes[entry.name] = size
+            if self.shared and processes.directory_locked(entry):
+                self.unmeasured.add(entry.name)
+
+    def measure(self):
+        for name in list(self.unmeasured):
+            job_dir = self.directory / name
+            if not processes.directory_locked(job_dir):
+                self.unmeasured.discard(name)
+                self.sizes[name] = directory_size(job_dir) if job_dir.exists() else 0
+
+    def add(self, job_dir: Path):
+        self.active[job_dir.name] = 1
+        if self.shared:
+            self.locks[job_dir.name] = processes.lock_directory(job_dir)
+
+        # a process without the task only locks, the leader finds its directories by scanning
+        if self.task is not None:
+            heapq.heappush(self.heap, (time.time() + self.ttl, job_dir.name))
+            self.sizes[job_dir.name] = 0
+
+    def retain(self, job_dir: Path):
+        if job_dir.name in self.active:
+            self.active[job_dir.name] += 1
+
+    async def release(self, job_dir: Path):
+        if job_dir.name not in self.active:
+            return
+
+        self.active[job_dir.name] -= 1
+        if self.active[job_dir.name] > 0:
+            return
+
+        del self.active[job_dir.name]
+        self.unlock(job_dir.name)
+        if self.task is not None:
+            try:
+                size = await asyncio.to_thread(directory_size, job_dir)
+            except FileNotFoundError:
+                size = 0
+            # evicted while it was measured
+            if job_dir.name in self.sizes:
+                self.sizes[job_dir.name] = size
+            self.wakeup.set()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name="job-reaper")
+
+    async def stop(self):
+        # directories are left on disk, the next start rebuilds the index with scan
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except OSError as e:
+                logger.error(f"job reaper sweep failed: {e!r}")
+
+            delay = self.interval
+            if self.heap:
+                delay = min(delay, max(0, self.heap[0][0] - time.time()))
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def over_capacity(self) -> bool:
+        if self.quota and self.total_bytes > self.quota:
+            return True
+        return shutil.disk_usage(self.directory).free < self.min_free
+
+    def unlock(self, name: str):
+        fd = self.locks.pop(name, None)
+        if fd is not None:
+            processes.unlock_directory(fd)
+
+    async def sweep(self):
+        if self.shared:
+            await asyncio.to_thread(self.scan)
+            await asyncio.to_thread(self.measure)
+
+        now = time.time()
+        busy = []
+        while self.heap and self.heap[0][0] <= now:
+            _, name = heapq.heappop(self.heap)
+            # a sandbox may still write to it, it gets another ttl and is deleted after release
+            if await self.in_use(name):
+                busy.append((now + self.ttl, name))
+                continue
+            await self.delete(name)
+            self.expired += 1
+        for entry in busy:
+            heapq.heappush(self.heap, entry)
+
+        if not self.over_capacity():
+            return
+
+        # heap order is also age order, every directory gets the same ttl
+        kept = []
+        for expires, name in sorted(self.heap):
+            if name in self.active or name in self.unmeasured or not self.over_capacity():
+                kept.append((expires, name))
+                continue
+            await self.delete(name)
+            self.evicted += 1
+
+        self.heap = kept
+        heapq.heapify(self.heap)
+
+    async def in_use(self, name: str) -> bool:
+        if name in self.active or name in self.unmeasured:
+            return True
+        # locked by another web process since the last scan
+        return self.shared and await asyncio.to_thread(processes.directory_locked, self.directory / name)
+
+    async def delete(self, name: str):
+        self.sizes.pop(name, None)
+        self.active.pop(name, None)
+        self.unmeasured.discard(name)
+        self.unlock(name)
+        await asyncio.to_thread(shutil.rmtree, self.directory / name, ignore_errors=True)
+
+    def status(self) -> dict:
+        return {
+            "directories": len(self.sizes),
+            "active": len(self.active) + len(self.unmeasured),
+            "bytes": self.total_bytes,
+            "quota": self.quota,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
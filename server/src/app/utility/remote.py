@@ -0,0 +1,209 @@
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Optional
+import secrets
+import asyncio
+import time
+
+from app.utility.sandbox import Lane, RunStats
+from app import logger
+
+
+@dataclass
+class RemoteJob:
+    id: str
+    tool: Path
+    dir: Path
+    mount: Path
+    items: int
+    wall_time: int
+    done: asyncio.Future
+    worker: Optional[str] = None
+
+
+@dataclass
+class WorkerNode:
+    name: str
+    lanes: tuple[str, ...]
+    seen: float = field(default_factory=time.monotonic)
+    running: set[str] = field(default_factory=set)
+    finished: int = 0
+
+
+# worker nodes long-poll for jobs, the server keeps the queue, the routing and the liveness
+# a poll is an offer: it is handed to the next waiting job of the lane like a ready box,
+# so remote jobs get the same per client fairness as local ones
+# a job whose worker stops polling and heartbeating for timeout seconds is run again elsewhere
+class RemoteWorkers:
+    def __init__(self, token: str, timeout: float, max_attempts: int = 2):
+        self.token = token
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.lanes: dict[str, Lane] = {}
+        self.jobs: dict[str, RemoteJob] = {}
+        self.nodes: dict[str, WorkerNode] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token)
+
+    def authorized(self, token: str) -> bool:
+        return self.enabled and secrets.compare_digest(token.encode(), self.token.encode())
+
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self.monitor(), name="remote-workers")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def lane(self, name: str) -> Lane:
+        return self.lanes.setdefault(name, Lane(name, []))
+
+    def alive(self, node: WorkerNode) -> bool:
+        return time.monotonic() - node.seen < self.timeout
+
+    def available(self, lane: str) -> bool:
+        return any(self.alive(node) and lane in node.lanes for node in self.nodes.values())
+
+    def touch(self, name: str, lanes: Optional[tuple[str, ...]] = None) -> WorkerNode:
+        node = self.nodes.get(name)
+        if node is None:
+            logger.info(f"worker node {name} joined")
+            node = self.nodes[name] = WorkerNode(name, lanes or ())
+        if lanes is not None:
+            node.lanes = lanes
+        node.seen = time.monotonic()
+        return node
+
+    async def run(
+        self,
+        tool: Path,
+        dir: Path,
+        items: int,
+        mount: Path,
+        lane: str,
+        client: str,
+        wall_time: int,
+    ) -> Optional[RunStats]:
+        pool = self.lane(lane)
+        queued = time.monotonic()
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(self.max_attempts):
+            job = RemoteJob(secrets.token_urlsafe(16), tool, dir, mount, items, wall_time, loop.create_future())
+
+            # an offer can reach two lanes at once, whoever takes it second waits for the next one
+            while True:
+                offer = await pool.get(client)
+                # every worker of the lane is gone, the caller runs the job itself
+                if offer is None:
+                    return None
+                if not offer.done():
+                    offer.set_result(job)
+                    break
+
+            leased = time.monotonic()
+            try:
+                stats: Optional[RunStats] = await job.done
+            finally:
+                self.jobs.pop(job.id, None)
+
+            if stats is not None:
+                stats.queue_wait = leased - queued
+                stats.run = time.monotonic() - leased
+                return stats
+            logger.error(f"remote job {job.id} lost its worker, attempt {attempt + 1}")
+
+        return RunStats(queue_wait=time.monotonic() - queued, status="XX")
+
+    async def offer(self, name: str, lanes: tuple[str, ...], wait: float) -> Optional[RemoteJob]:
+        node = self.touch(name, lanes)
+        offer = asyncio.get_running_loop().create_future()
+        pools = [self.lane(lane) for lane in lanes]
+
+        for pool in pools:
+            pool.put(offer)
+            # taken by a waiting job, the other lanes do not see it
+            if offer not in pool.ready:
+                break
+
+        try:
+            job: Optional[RemoteJob] = await asyncio.wait_for(asyncio.shield(offer), wait)
+        except asyncio.TimeoutError:
+            job = offer.result() if offer.done() else None
+            offer.cancel()
+        finally:
+            for pool in pools:
+                if offer in pool.ready:
+                    pool.ready.remove(offer)
+
+        if job is None or job.done.done():
+            return None
+
+        job.worker = name
+        node.running.add(job.id)
+        self.jobs[job.id] = job
+        return job
+
+    def leased(self, name: str, job_id: str) -> Optional[RemoteJob]:
+        job = self.jobs.get(job_id)
+        if job is None or job.worker != name:
+            return None
+        return job
+
+    def finish(self, job: RemoteJob, report: Optional[dict]):
+        node = self.nodes.get(job.worker)
+        if node is not None:
+            node.running.discard(job.id)
+            node.finished += 1
+
+        stats = None
+        if report is not None:
+            known = {f.name for f in fields(RunStats)}
+            stats = RunStats(**{key: value for key, value in report.items() if key in known})
+            # the worker answers before its box is recycled
+            stats.cleanup = stats.cleanup or 0.0
+
+        if not job.done.done():
+            job.done.set_result(stats)
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(self.timeout / 2)
+            for job in list(self.jobs.values()):
+                node = self.nodes.get(job.worker)
+                if node is None or not self.alive(node):
+                    self.jobs.pop(job.id, None)
+                    if node is not None:
+                        node.running.discard(job.id)
+                    if not job.done.done():
+                        job.done.set_result(None)
+
+            for name, pool in self.lanes.items():
+                while pool.waiters and not self.available(name):
+                    pool.put(None)
+
+            # forget nodes that are gone for good
+            for name, node in list(self.nodes.items()):
+                if time.monotonic() - node.seen > self.timeout * 10:
+                    logger.info(f"worker node {name} left")
+                    del self.nodes[name]
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "nodes": {
+                name: {
+                    "alive": self.alive(node),
+                    "lanes": list(node.lanes),
+                    "running": len(node.running),
+                    "finished": node.finished,
+                }
+                for name, node in self.nodes.items()
+            },
+            "waiting": {name: lane.waiting for name, lane in self.lanes.items()},
+        }
@@ -1,49 +1,65 @@
-import pyparsing as pp
 from typing import Any, get_args
+from itertools import islice
+from urllib.parse import urlencode
+import secrets
+import json
+import ast
 from pprint import PrettyPrinter, pformat
 from pathlib import Path, PosixPath
 from jinja2 import Template
-from app import TEMPLATES, logger
+from app import TEMPLATES, SETTINGS, logger
 from typing import Literal, Optional  # required for form type
 from nh3 import clean as sanitize_html
+from markupsafe import escape
+from dataclasses import dataclass
+from app.utility import schema, serializer
 from app.models.tools import Tool
 
 
-def parser_literal(input: str):
-    LITERAL = pp.Suppress(pp.Literal("Literal"))
-    OPEN_BRACKET = pp.Suppress(pp.Literal("["))
-    CLOSE_BRACKET = pp.Suppress(pp.Literal("]"))
-    string_type = pp.Word(pp.alphanums + "_", pp.alphanums + "_.")
-    num_type = pp.Combine(
-        pp.Optional(".") + pp.Word(pp.nums) + pp.Optional("." + pp.Word(pp.nums))
-    )
-    empty_quote = string_type | num_type
-    single = pp.Suppress("'")
-    doube = pp.Suppress('"')
-    double_quote = pp.Group(doube + empty_quote + doube).addParseAction(
-        lambda t: "".join(t[0])
-    )
-    single_quote = pp.Group(single + empty_quote + single).addParseAction(
-        lambda t: "".join(t[0])
-    )
-    field = double_quote | single_quote | num_type
-    literal_values = pp.ZeroOrMore(field + pp.Suppress(pp.Optional(",")))
-    literal_expr = LITERAL + OPEN_BRACKET + literal_values + CLOSE_BRACKET
-    return literal_expr.parseString(input)
+def parser_literal(input: str) -> list[str]:
+    # the annotation was already checked at upload, read the values from its ast
+    node = ast.parse(input, mode="eval").body
+    return [str(value) for value in schema.literal_choices(node.slice)]
+
+
+# values of a mapped side file shown next to its download link
+BINARY_HEAD = 8
+
+
+def path_to_html(object: Path) -> str:
+    hyper_link = Path("/download") / object.relative_to(object.anchor)
+    download = f'<a href="{hyper_link}" style="white-space: pre;">{object}</a>'
+
+    viewer = ""
+    if hyper_link.suffix == ".stl":
+        viewer = f'<stl-viewer url="{hyper_link}"></stl-viewer>'
+
+    return f"{download}{viewer}"
+
+
+def binary_to_html(object: serializer.BinaryRef, directory: Optional[Path]) -> str:
+    # only the first values are read from the mapped side file, and only from the job directory
+    summary = escape(object.summary())
+    head = object.head(BINARY_HEAD + 1, directory) if directory is not None else None
+    if head is None:
+        return f"{escape(str(object.path))} {summary} [unavailable]"
+
+    values = ", ".join(map(repr, head[:BINARY_HEAD])) + (", ..." if len(head) > BINARY_HEAD else "")
+    return f"{path_to_html(Path(escape(str(object.path))))} {summary} [{escape(values)}]"
 
 
 # TODO: customize web display for more objects
 class MyPrettyPrinter(PrettyPrinter):
+    def __init__(self, *args, directory: Optional[Path] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.directory = directory
+
     def format(self, object, context, maxlevels, level):
         if isinstance(object, (Path, PosixPath)):
-            hyper_link = Path("/download") / object.relative_to(object.anchor)
-            download = f'<a href="{hyper_link}" style="white-space: pre;">{object}</a>'
-
-            viewer = ""
-            if hyper_link.suffix == ".stl":
-                viewer = f'<stl-viewer url="{hyper_link}"></stl-viewer>'
+            return (path_to_html(object), True, False)
 
-            return (f"{download}{viewer}", True, False)
+        if isinstance(object, serializer.BinaryRef):
+            return (binary_to_html(object, self.directory), True, False)
 
         return super().format(object, context, maxlevels, level)
 
@@ -107,18 +123,47 @@ def form_group(name: str, type: str, default: str):
     return type_to_label(name, "str", "invalid type")
 
 
-def args_to_form(arguments: dict[str, tuple[str, str]]):
-    items = []
+# stands in for a default value while the form is rendered, then split out
+DEFAULT_MARKER = f"default-{secrets.token_hex(8)}"
+
+
+@dataclass(frozen=True)
+class CompiledForm:
+    # rendered html with a gap for each default value, parts has one more item than names
+    parts: tuple[str, ...]
+    names: tuple[str, ...]
+    defaults: dict[str, str]
+
+    def render(self, overrides: Optional[dict[str, str]] = None) -> str:
+        overrides = overrides or {}
+        html = [self.parts[0]]
+        for name, part in zip(self.names, self.parts[1:]):
+            default = overrides.get(name, self.defaults[name]) or ""
+            html.append(escape(sanitize_html(default) or ""))
+            html.append(part)
+        return "".join(html)
+
+
+def compile_form(arguments: dict[str, tuple[str, str]]) -> CompiledForm:
+    parts, names = [""], []
     for name, (type, default) in arguments.items():
-        items.append(form_group(name, type, default))
+        pieces = form_group(name, type, DEFAULT_MARKER).split(DEFAULT_MARKER)
+        parts[-1] += pieces[0]
+        for piece in pieces[1:]:
+            names.append(name)
+            parts.append(piece)
+        parts[-1] += "\n"
 
-    return "\n".join(items)
+    parts[-1] = parts[-1].removesuffix("\n")
+    defaults = {name: default or "" for name, (_, default) in arguments.items()}
+    return CompiledForm(tuple(parts), tuple(names), defaults)
 
 
 def list_items(
     base_url: str,
     tools: list[tuple[str, str]],
-    end: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = 50,
     tags: Optional[list[str]] = None,
 ):
     tags = tags or []
@@ -135,14 +180,15 @@ def list_items(
         )
         htmlx.append(form)
 
-    if end is not None:
+    if after is not None:
         template: Template = TEMPLATES.get_template(
             "components/tool_scroll_loader.html"
         )
         form = template.render(
             {
-                "start": end,
-                "end": end + 1,
+                "root_path": base_url,
+                "after": after,
+                "limit": limit,
                 "tags": " ".join(tags),
             },
         )
@@ -169,11 +215,16 @@ def list_item_user(root_path: str, tools: list[Tool]):
     return "".join(htmlx)
 
 
-pretty_printer = MyPrettyPrinter(indent=4, width=50)
+def render(results: Any, job: Optional[str] = None, directory: Optional[Path] = None):
+    # side files are read while rendering, callers on the event loop run this in a thread
+    if directory is None and job is not None:
+        directory = SETTINGS.JOBS_DIRECTORY / job
 
+    # small results keep the pretty printer, large ones get a bounded preview
+    if result_size(results, SETTINGS.RESULT_PREVIEW_CHARS) > SETTINGS.RESULT_PREVIEW_CHARS:
+        return ResultPreview(job, directory).render(results)
 
-def render(results: Any):
-    return_string = pretty_printer.pformat(results)
+    return_string = MyPrettyPrinter(indent=4, width=50, directory=directory).pformat(results)
 
     sanatized = (
         sanitize_html(
@@ -186,3 +237,129 @@ def render(results: Any):
     )
 
     return f"<pre>{sanatized}</pre>"
+
+
+def result_size(results: Any, limit: int) -> int:
+    # stops once limit is passed, a huge result costs no more to measure than a small one
+    size = 0
+    stack = [results]
+    while stack and size <= limit:
+        value = stack.pop()
+        if isinstance(value, dict):
+            size += 2 + 4 * len(value)
+            stack.extend(islice(value.keys(), limit))
+            stack.extend(islice(value.values(), limit))
+        elif isinstance(value, (list, tuple, set)):
+            size += 2 + 2 * len(value)
+            stack.extend(islice(value, limit))
+        elif isinstance(value, str):
+            size += len(value) + 2
+        else:
+            size += len(str(value))
+    return size
+
+
+def result_node(results: Any, path: list) -> Any:
+    for key in path:
+        if isinstance(results, dict) and isinstance(key, str) and key in results:
+            results = results[key]
+        elif isinstance(results, (list, tuple)) and isinstance(key, int) and 0 <= key < len(results):
+            results = results[key]
+        else:
+            raise KeyError(key)
+    return results
+
+
+# renders at most RESULT_PREVIEW_CHARS of a result, every cut is a link that fetches the next part
+# the links read the job's result.json, which is also offered as a download
+class ResultPreview:
+    INDENT = "    "
+
+    def __init__(self, job: Optional[str] = None, directory: Optional[Path] = None):
+        self.job = job
+        self.directory = directory if directory is not None or job is None else SETTINGS.JOBS_DIRECTORY / job
+        self.remaining = SETTINGS.RESULT_PREVIEW_CHARS
+        self.max_items = SETTINGS.RESULT_PREVIEW_ITEMS
+        self.max_string = SETTINGS.RESULT_PREVIEW_STRING
+
+    def render(self, results: Any) -> str:
+        download = ""
+        if self.job is not None:
+            artifact = Path("/download") / SETTINGS.JOBS_DIRECTORY.relative_to("/") / self.job / "result.json"
+            download = f'<a href="{escape(str(artifact))}">full result (json)</a>\n'
+        return f"<pre>{download}{self.value(results, [])}</pre>"
+
+    def render_part(self, results: Any, path: list, offset: Optional[int]) -> str:
+        node = result_node(results, path)
+        if offset is None:
+            return self.value(node, path)
+        if isinstance(node, str):
+            return self.string(node, path, offset)
+        if isinstance(node, (dict, list, tuple)):
+            return self.items(node, path, offset)
+        raise KeyError(offset)
+
+    def link(self, path: list, offset: Optional[int], label: str) -> str:
+        if self.job is None:
+            return f"... {label}"
+
+        query = {"path": json.dumps(path)}
+        if offset is not None:
+            query["offset"] = offset
+        url = f"/result/{self.job}?{urlencode(query)}"
+        return f'<a href="#" hx-get="{escape(url)}" hx-swap="outerHTML">... {label}</a>'
+
+    def value(self, value: Any, path: list) -> str:
+        if isinstance(value, Path):
+            return path_to_html(Path(escape(str(value))))
+
+        if isinstance(value, serializer.BinaryRef):
+            return binary_to_html(value, self.directory)
+
+        if isinstance(value, str):
+            return "'" + self.string(value, path, 0) + "'"
+
+        if isinstance(value, (dict, list, tuple)):
+            if not value:
+                return "{}" if isinstance(value, dict) else "[]"
+            if self.remaining <= 0:
+                return self.link(path, None, f"{len(value)} items")
+
+            indent = self.INDENT * len(path)
+            start, end = ("{", "}") if isinstance(value, dict) else ("[", "]")
+            return f"{start}\n{indent}{self.INDENT}{self.items(value, path, 0)}\n{indent}{end}"
+
+        text = repr(value)
+        self.remaining -= len(text)
+        return str(escape(text))
+
+    def string(self, value: str, path: list, offset: int) -> str:
+        end = offset + max(0, min(self.max_string, self.remaining))
+        chunk = value[offset:end]
+        self.remaining -= len(chunk)
+
+        html = str(escape(chunk))
+        if end < len(value):
+            html += self.link(path, end, f"{len(value) - end} more characters")
+        return html
+
+    def items(self, value: dict | list | tuple, path: list, offset: int) -> str:
+        indent = self.INDENT * (len(path) + 1)
+        keys = value.keys() if isinstance(value, dict) else range(len(value))
+
+        lines = []
+        end = offset
+        for key in islice(keys, offset, offset + self.max_items):
+            if self.remaining <= 0:
+                break
+            rendered = self.value(value[key], [*path, key])
+            if isinstance(value, dict):
+                self.remaining -= len(repr(key))
+                rendered = f"{escape(repr(key))}: {rendered}"
+            lines.append(f"{rendered},")
+            end += 1
+
+        if end < len(value):
+            lines.append(self.link(path, end, f"{len(value) - end} more items"))
+
+        return f"\n{indent}".join(lines)
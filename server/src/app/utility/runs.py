@@ -0,0 +1,137 @@
+from pathlib import Path
+from sqlmodel import Session
+from typing import Optional
+import asyncio
+import time
+import os
+
+from app.utility.sandbox import RunStats
+from app.models import tools as db_tools
+from app import logger
+
+# a run that never finished its cleanup (server stopped mid recycle) is written without it
+CLEANUP_GRACE = 60
+
+
+def directory_bytes(directory: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+# run records are collected in memory and written in one transaction per interval
+# a record waits for its box to be cleaned up, the cleanup duration is part of it
+class RunRecorder:
+    def __init__(
+        self,
+        interval: float,
+        max_age: float,
+        downsample_age: float,
+        downsample: int,
+        prune_interval: float = 60 * 60,
+    ):
+        self.interval = interval
+        self.max_age = max_age
+        self.downsample_age = downsample_age
+        self.downsample = downsample
+        self.prune_interval = prune_interval
+        self.pending: list[tuple[db_tools.RunRecord, RunStats]] = []
+        self.written = 0
+        self.pruned = 0.0
+        self.pruning = True
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age > 0
+
+    def add(self, tool_id: int, code_hash: str, args_hash: str, stats: RunStats, output_bytes: int, items: int = 1):
+        if not self.enabled:
+            return
+
+        record = db_tools.RunRecord(
+            created=time.time(),
+            tool_id=tool_id,
+            code_hash=code_hash,
+            args_hash=args_hash,
+            items=max(1, items),
+            queue_wait=stats.queue_wait,
+            init=stats.init,
+            run=stats.run,
+            cpu=stats.cpu,
+            rss=stats.rss,
+            exit_status=stats.exit_status,
+            status=stats.status,
+            output_bytes=output_bytes,
+        )
+        self.pending.append((record, stats))
+
+    def start(self, prune: bool = True):
+        # with several web processes one of them prunes
+        self.pruning = prune
+        if self.enabled:
+            self.task = asyncio.create_task(self.run(), name="run-records")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.flush(force=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+            if self.pruning and time.time() - self.pruned > self.prune_interval:
+                await self.prune()
+
+    async def flush(self, force: bool = False):
+        now = time.time()
+        ready, waiting = [], []
+        for record, stats in self.pending:
+            if stats.cleanup is not None or force or now - record.created > CLEANUP_GRACE:
+                record.cleanup = stats.cleanup
+                ready.append(record)
+            else:
+                waiting.append((record, stats))
+
+        if not ready:
+            return
+
+        self.pending = waiting
+        try:
+            with Session(db_tools.engine) as session:
+                await db_tools.run_sync(db_tools.add_run_records, session, ready)
+        except Exception as e:
+            # history is best effort, a failed write is dropped rather than piling up
+            logger.error(f"run record flush failed: {e!r}")
+            return
+
+        self.written += len(ready)
+
+    async def prune(self):
+        now = time.time()
+        self.pruned = now
+        try:
+            with Session(db_tools.engine) as session:
+                await db_tools.run_sync(
+                    db_tools.prune_run_records,
+                    session,
+                    now - self.max_age,
+                    now - self.downsample_age,
+                    self.downsample,
+                )
+        except Exception as e:
+            logger.error(f"run record prune failed: {e!r}")
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "pending": len(self.pending),
+            "written": self.written,
+        }
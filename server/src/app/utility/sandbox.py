@@ -1,85 +1,423 @@
-import subprocess
 from pathlib import Path
-from threading import Lock
-from asyncio import create_subprocess_exec as async_exec
-import random
-import shutil
-from app import logger, ENVIRONMENT
-
-
-def docker_run(image: str, tool: Path, workdir: Path):
-    command = [
-        "docker",
-        "run",
-        "--network=none",
-        "-m=512m",
-        "--cpus=1.5",
-        "--rm",
-        "-v",
-        f"{tool}:/sandbox/{tool.name}:ro",
-        "-v",
-        f"{workdir}:{'/sandbox' / workdir}",
-        f"{image}",
-        "python3",
-        "runner.py",
-        "--file",
-        f"/sandbox/{tool.name}",
-        "--workdir",
-        f"{'sandbox' / workdir}",
-    ]
-    subprocess.call(command)
+from typing import Optional
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
+import tempfile
+import asyncio
+import json
+import time
+import os
+from app import logger, SETTINGS
+from app.utility import backends
+from app.utility.backends import SandboxBackend
 
 
+# resource accounting of one run, durations in seconds and memory in KiB
+# cleanup is only known once the box was recycled after the run
+@dataclass
+class RunStats:
+    queue_wait: float = 0.0
+    init: float = 0.0
+    run: float = 0.0
+    cleanup: Optional[float] = None
+    cpu: Optional[float] = None
+    rss: Optional[int] = None
+    exit_status: Optional[int] = None
+    status: str = "OK"
+
+
+def apply_meta(stats: RunStats, meta: dict[str, str]):
+    try:
+        if "time" in meta:
+            stats.cpu = float(meta["time"])
+        # the cgroup peak covers every process of the run, max-rss only the largest one
+        if "cg-mem" in meta or "max-rss" in meta:
+            stats.rss = int(meta.get("cg-mem") or meta["max-rss"])
+        if "exitcode" in meta:
+            stats.exit_status = int(meta["exitcode"])
+        elif "exitsig" in meta:
+            stats.exit_status = -int(meta["exitsig"])
+    except ValueError as e:
+        logger.error(f"run meta unreadable: {e!r}")
+    stats.status = meta.get("status", "OK")
+
+
+DEFAULT_LANE = "interactive"
+
+
+class SandboxBusy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"sandbox queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+# a lane owns a fixed set of boxes, a heavy job can only ever hold up its own lane
+# waiting jobs are served round robin across clients and in FIFO order per client,
+# a client that queues many jobs does not delay another client's single job
+class Lane:
+    def __init__(self, name: str, boxes: list[int]):
+        self.name = name
+        self.boxes = boxes
+        self.ready: deque[int] = deque()
+        self.waiters: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        self.waiting = 0
+        self.leased = 0
+        self.lease_duration: deque[float] = deque(maxlen=100)
+
+    def put(self, box: int):
+        while self.waiters:
+            client, queue = next(iter(self.waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiters.move_to_end(client)
+            else:
+                del self.waiters[client]
+
+            # cancelled waiters are skipped here instead of searched for on cancel
+            if not future.done():
+                future.set_result(box)
+                return
+        self.ready.append(box)
+
+    async def get(self, client: str) -> int:
+        if self.ready:
+            return self.ready.popleft()
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(client, deque()).append(future)
+        self.waiting += 1
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # a box handed over while the waiter was cancelled goes to the next waiter
+            if future.done() and not future.cancelled():
+                self.put(future.result())
+            raise
+        finally:
+            self.waiting -= 1
+
+    def retry_after(self) -> int:
+        mean = sum(self.lease_duration) / len(self.lease_duration) if self.lease_duration else 1
+        return max(1, round(mean * (self.waiting + 1) / max(1, len(self.boxes))))
+
+    def status(self) -> dict:
+        return {
+            "size": len(self.boxes),
+            "ready": len(self.ready),
+            "leased": self.leased,
+            "waiting": self.waiting,
+            "clients": len(self.waiters),
+        }
+
+
+# boxes are initialized ahead of time and handed out by the lane that owns them
+# used boxes are cleaned up and re-initialized in the background by the sandbox backend
+# at most max_queue jobs can wait for a box in each lane
+# with preload modules configured, each warm box also holds a zygote interpreter
+# that already imported them and forks the job, boxes without one run cold
 class IsolationWorkers:
     def __init__(
         self,
-        workers: int = 5,
+        workers: int = SETTINGS.POOL_SIZE,
+        lanes: tuple[tuple[str, int], ...] = SETTINGS.POOL_LANES,
         memory: int = 512000,
         processors: int = 50,
+        recycle_timeout: float = SETTINGS.POOL_RECYCLE_TIMEOUT,
+        retry_delay: float = SETTINGS.POOL_RETRY_DELAY,
+        max_queue: int = SETTINGS.POOL_MAX_QUEUE,
+        wall_time: int = 30,
+        preload: tuple[str, ...] = SETTINGS.SANDBOX_PRELOAD,
+        preload_timeout: float = SETTINGS.PRELOAD_TIMEOUT,
+        idle_time: int = SETTINGS.PRELOAD_IDLE_TIME,
+        remote=None,
+        root: Path = Path("/"),
+        first_box: int = 0,
+        backend: Optional[SandboxBackend] = None,
     ):
-        self.workers = workers
         self.memory = memory
         self.processors = processors
-        self.worker_locks = [Lock() for i in range(self.processors)]
-
-    async def run(self, tool: Path, dir: Path):
-        worker = random.randint(0, self.workers)
-        logger.info(f"worker {worker} running {tool.name}")
-
-        with self.worker_locks[worker]:
-            p = await async_exec("isolate", "--init", "--cg", f"--box-id={worker}")
-            await p.wait()
-
-            # isolate manual: https://www.ucw.cz/moe/isolate.1.html
-            cmd = [
-                "isolate",
-                "--share-net",  # internet
-                "--dir=/etc/",  # resolve.conf
-                "--cg",
-                "--cg-mem=104857600",
-                "--env",
-                "HOME=/box",
-                f"--box-id={worker}",
-                "--dir=/tmp=",
-                f"--dir={dir}:rw",
-                f"--dir=/sandbox={ENVIRONMENT.SANDBOX}",
-                f"--processes={self.processors}",
-                "--wall-time=30",
-                "--run",
-                "--",
-                "/sandbox/bin/python",
-                "-B",
-                "/sandbox/bin/sandbox",
-                "--file",
-                f"{dir}/{tool.name}",
-                "--workdir",
-                f"{dir}",
-            ]
-
-            print(" ".join(cmd))
-
-            p = await async_exec(*cmd)
-            await p.wait()
-
-            p = await async_exec("isolate", "--cg", "--cleanup", f"--box-id={worker}")
-            await p.wait()
+        self.recycle_timeout = recycle_timeout
+        self.retry_delay = retry_delay
+        self.max_queue = max_queue
+        self.wall_time = wall_time
+        self.preload = preload
+        self.preload_timeout = preload_timeout
+        self.idle_time = idle_time
+        self.remote = remote
+        self.backend = backend or backends.create(SETTINGS.SANDBOX_BACKEND, memory, processors, recycle_timeout, root)
+
+        # without configured lanes every job shares one lane of workers boxes
+        self.lane_sizes = lanes or ((DEFAULT_LANE, workers),)
+        self.workers = sum(size for _, size in self.lane_sizes)
+        self.place(first_box)
+
+        self.leased: set[int] = set()
+        self.recycling: set[int] = set()
+        self.unhealthy: set[int] = set()
+        self.recycle_latency: deque[float] = deque(maxlen=100)
+        self.init_duration: dict[int, float] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.zygotes: dict[int, asyncio.subprocess.Process] = {}
+        # monotonic time the backend kills a zygote at, idle_time after it was spawned
+        self.zygote_deadlines: dict[int, float] = {}
+
+    def place(self, first_box: int):
+        # box ids are global to the machine, every web process or worker node needs its own range
+        self.lanes: dict[str, Lane] = {}
+        self.box_lane: dict[int, Lane] = {}
+        for name, size in self.lane_sizes:
+            boxes = list(range(first_box + len(self.box_lane), first_box + len(self.box_lane) + size))
+            self.lanes[name] = Lane(name, boxes)
+            self.box_lane.update((box, self.lanes[name]) for box in boxes)
+        self.boxes = list(self.box_lane)
+
+    async def start(self):
+        await self.backend.start()
+        for box in self.boxes:
+            self.recycle(box)
+        if self.preload:
+            task = asyncio.create_task(self.renew_zygotes(), name="renew-zygotes")
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        for box in self.boxes:
+            zygote = self.zygotes.pop(box, None)
+            if zygote is not None:
+                await self.stop_zygote(zygote)
+            try:
+                await self.backend.release(box)
+            except (OSError, RuntimeError, asyncio.TimeoutError):
+                pass
+
+    def recycle(self, box: int, delay: float = 0, stats: Optional[RunStats] = None):
+        self.recycling.add(box)
+        task = asyncio.create_task(self._recycle(box, delay, stats), name=f"recycle-box-{box}")
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _recycle(self, box: int, delay: float, stats: Optional[RunStats] = None):
+        await asyncio.sleep(delay)
+        start = time.monotonic()
+
+        zygote = self.zygotes.pop(box, None)
+        if zygote is not None:
+            await self.stop_zygote(zygote)
+
+        try:
+            # cleanup first, a crashed server can leave initialized boxes behind
+            await self.backend.release(box)
+            cleaned = time.monotonic()
+            await self.backend.prepare(box)
+        except (OSError, RuntimeError, asyncio.TimeoutError) as e:
+            logger.error(f"box {box} recycle failed: {e!r}")
+            if stats is not None:
+                stats.cleanup = time.monotonic() - start
+            self.unhealthy.add(box)
+            self.recycling.discard(box)
+            self.recycle(box, self.retry_delay)
+            return
+
+        # the run that used the box is accounted its cleanup, the next run its init
+        if stats is not None:
+            stats.cleanup = cleaned - start
+
+        if self.preload:
+            await self.start_zygote(box)
+
+        self.init_duration[box] = time.monotonic() - cleaned
+        self.recycle_latency.append(time.monotonic() - start)
+        self.unhealthy.discard(box)
+        self.recycling.discard(box)
+        self.box_lane[box].put(box)
+
+    async def start_zygote(self, box: int):
+        args = ["--zygote", "--preload", ",".join(self.preload)]
+
+        try:
+            deadline = time.monotonic() + self.idle_time
+            p = await self.backend.spawn(box, SETTINGS.JOBS_DIRECTORY, self.idle_time, args, pipes=True)
+        except OSError as e:
+            logger.error(f"box {box} zygote failed to start: {e!r}")
+            return
+
+        try:
+            line = await asyncio.wait_for(p.stdout.readline(), self.preload_timeout)
+            if not json.loads(line).get("ready"):
+                raise ValueError("zygote not ready")
+        except (asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"box {box} zygote failed to preload: {e!r}")
+            await self.stop_zygote(p)
+            return
+
+        self.zygotes[box] = p
+        self.zygote_deadlines[box] = deadline
+
+    def zygote_lifetime(self, box: int) -> float:
+        zygote = self.zygotes.get(box)
+        if zygote is None or zygote.returncode is not None:
+            return 0
+        return self.zygote_deadlines.get(box, 0) - time.monotonic()
+
+    async def renew_zygotes(self):
+        # the wall time of a zygote covers the jobs it forks, a ready box is recycled
+        # before a job could outlive it, and so is one whose zygote died
+        # boxes whose zygote failed to preload have none and keep running cold
+        while True:
+            for lane in self.lanes.values():
+                for box in list(lane.ready):
+                    if box in self.zygotes and self.zygote_lifetime(box) < self.wall_time:
+                        lane.ready.remove(box)
+                        self.recycle(box)
+            await asyncio.sleep(max(1, self.wall_time / 2))
+
+    async def stop_zygote(self, zygote: asyncio.subprocess.Process):
+        if zygote.returncode is not None:
+            return
+
+        zygote.stdin.close()
+        try:
+            await asyncio.wait_for(zygote.wait(), 1)
+        except asyncio.TimeoutError:
+            zygote.kill()
+            await zygote.wait()
+
+    def lane(self, name: Optional[str] = None) -> Lane:
+        # a lane that is not configured falls back to the first one
+        return self.lanes.get(name) or next(iter(self.lanes.values()))
+
+    def retry_after(self, lane: Optional[str] = None) -> int:
+        return self.lane(lane).retry_after()
+
+    def full(self, lane: Optional[str] = None) -> bool:
+        if self.remote is not None and self.remote.available(lane or DEFAULT_LANE):
+            return self.remote.lane(lane or DEFAULT_LANE).waiting >= self.max_queue
+        return self.lane(lane).waiting >= self.max_queue
+
+    @asynccontextmanager
+    async def lease(self, stats: Optional[RunStats] = None, lane: Optional[str] = None, client: str = ""):
+        pool = self.lane(lane)
+        if pool.waiting >= self.max_queue:
+            raise SandboxBusy(pool.retry_after())
+
+        queued = time.monotonic()
+        box = await pool.get(client)
+
+        self.leased.add(box)
+        pool.leased += 1
+        start = time.monotonic()
+        if stats is not None:
+            stats.queue_wait = start - queued
+            stats.init = self.init_duration.get(box, 0.0)
+        try:
+            yield box
+        finally:
+            pool.lease_duration.append(time.monotonic() - start)
+            pool.leased -= 1
+            self.leased.discard(box)
+            self.recycle(box, stats=stats)
+
+    def status(self) -> dict:
+        latency = list(self.recycle_latency)
+        return {
+            "size": self.workers,
+            "ready": sum(len(lane.ready) for lane in self.lanes.values()),
+            "leased": len(self.leased),
+            "waiting": sum(lane.waiting for lane in self.lanes.values()),
+            "lanes": {name: lane.status() for name, lane in self.lanes.items()},
+            "remote": self.remote.status() if self.remote is not None else None,
+            "max_queue": self.max_queue,
+            "recycling": len(self.recycling - self.unhealthy),
+            "unhealthy": sorted(self.unhealthy),
+            "zygotes": sum(z.returncode is None for z in self.zygotes.values()),
+            "backend": self.backend.status(),
+            "recycle_latency": {
+                "last": latency[-1] if latency else None,
+                "mean": sum(latency) / len(latency) if latency else None,
+                "max": max(latency) if latency else None,
+            },
+        }
+
+    async def run_zygote(
+        self,
+        zygote: asyncio.subprocess.Process,
+        tool: Path,
+        dir: Path,
+        wall_time: int,
+        batch: bool,
+        stats: RunStats,
+    ):
+        job = {"file": str(dir / tool.name), "workdir": str(dir), "batch": batch}
+        zygote.stdin.write((json.dumps(job) + "\n").encode())
+        await zygote.stdin.drain()
+
+        # a timed out zygote is killed when the box is recycled
+        try:
+            line = await asyncio.wait_for(zygote.stdout.readline(), wall_time)
+        except asyncio.TimeoutError:
+            logger.error(f"zygote job {tool.name} exceeded wall time")
+            stats.status = "TO"
+            return
+
+        # the zygote reports the forked child's exit status and rusage
+        try:
+            report = json.loads(line)
+        except ValueError:
+            stats.status = "XX"
+            return
+        stats.exit_status = report.get("status")
+        stats.cpu = report.get("cpu")
+        stats.rss = report.get("rss")
+        stats.status = "OK" if stats.exit_status == 0 else "RE"
+
+    async def run(
+        self,
+        tool: Path,
+        dir: Path,
+        items: int = 0,
+        mount: Optional[Path] = None,
+        lane: Optional[str] = None,
+        client: str = "",
+        wall_time: Optional[int] = None,
+    ) -> RunStats:
+        # a batch of items shares one box and one import, its wall time grows with the items
+        wall_time = wall_time or self.wall_time * max(1, items)
+        args = ["--file", f"{dir}/{tool.name}", "--workdir", f"{dir}"] + (["--batch"] if items else [])
+        stats = RunStats()
+
+        # boxes here are used first, worker nodes take the jobs that would have to wait
+        if self.remote is not None and self.remote.available(lane or DEFAULT_LANE) and not self.lane(lane).ready:
+            remote_lane = lane or DEFAULT_LANE
+            remote_stats = await self.remote.run(tool, dir, items, mount or dir, remote_lane, client, wall_time)
+            if remote_stats is not None:
+                return remote_stats
+
+        async with self.lease(stats, lane, client) as worker:
+            start = time.monotonic()
+            # a zygote that would be killed before the job's own wall time runs it cold
+            zygote = self.zygotes.get(worker)
+            if zygote is not None and self.zygote_lifetime(worker) > wall_time:
+                logger.info(f"worker {worker} forking {tool.name}")
+                await self.run_zygote(zygote, tool, dir, wall_time, bool(items), stats)
+                stats.run = time.monotonic() - start
+                return stats
+
+            logger.info(f"worker {worker} running {tool.name}")
+            # the meta file is written outside the box, the tool can not touch it
+            fd, meta = tempfile.mkstemp(prefix=f"isolate-meta-{worker}-")
+            os.close(fd)
+
+            try:
+                p = await self.backend.spawn(worker, mount or dir, wall_time, args, meta=Path(meta))
+                await p.wait()
+                stats.run = time.monotonic() - start
+                apply_meta(stats, await self.backend.collect(worker, Path(meta)))
+            finally:
+                os.unlink(meta)
+
+        return stats
@@ -0,0 +1,99 @@
+from pathlib import Path
+from typing import Any
+import math
+import ast
+
+# arguments are compiled once at upload, requests are checked against the result
+# without evaluating annotations, a request that fails never reaches a box
+INT_BOUNDS = (-(2**63), 2**63 - 1)
+SCALAR_TYPES = ("str", "int", "float", "Path")
+
+
+class SchemaError(ValueError):
+    pass
+
+
+def literal_choices(node: ast.expr) -> list[Any]:
+    elements = node.elts if isinstance(node, ast.Tuple) else [node]
+    choices = []
+    for element in elements:
+        if not isinstance(element, ast.Constant) or not isinstance(element.value, (str, int, float)):
+            raise SchemaError(f"unsupported Literal value {ast.unparse(element)}")
+        choices.append(element.value)
+    return choices
+
+
+def compile_argument(annotation: str, default: Any) -> dict:
+    try:
+        node = ast.parse(annotation, mode="eval").body
+    except SyntaxError:
+        raise SchemaError(f"unsupported type {annotation}")
+
+    argument = {"required": default is None}
+
+    if isinstance(node, ast.Name) and node.id in SCALAR_TYPES:
+        argument["type"] = node.id
+    elif isinstance(node, ast.Subscript) and ast.unparse(node.value) in ("Literal", "typing.Literal"):
+        argument["type"] = "Literal"
+        argument["choices"] = literal_choices(node.slice)
+    else:
+        raise SchemaError(f"unsupported type {annotation}")
+
+    if argument["type"] == "int":
+        argument["min"], argument["max"] = INT_BOUNDS
+
+    return argument
+
+
+def compile_schema(arguments: dict[str, tuple[str, Any]]) -> dict[str, dict]:
+    return {name: compile_argument(annotation, default) for name, (annotation, default) in arguments.items()}
+
+
+def coerce(name: str, argument: dict, value: str) -> Any:
+    kind = argument["type"]
+
+    if kind == "str":
+        return value
+
+    if kind == "Literal":
+        for choice in argument["choices"]:
+            if str(choice) == value:
+                return choice
+        raise SchemaError(f"{name} must be one of {', '.join(map(str, argument['choices']))}")
+
+    try:
+        number = int(value) if kind == "int" else float(value)
+    except ValueError:
+        raise SchemaError(f"{name} must be {kind}")
+
+    if kind == "float" and not math.isfinite(number):
+        raise SchemaError(f"{name} must be finite")
+    if kind == "int" and not argument["min"] <= number <= argument["max"]:
+        raise SchemaError(f"{name} out of range")
+
+    return number
+
+
+def validate(schema: dict[str, dict], fields: dict[str, str], files: dict[str, Path]) -> dict[str, Any]:
+    kwargs = {}
+
+    for name in (*fields, *files):
+        if name not in schema:
+            raise SchemaError(f"unknown argument {name}")
+
+    for name, argument in schema.items():
+        is_file = argument["type"] == "Path"
+
+        if is_file and name in fields:
+            raise SchemaError(f"{name} must be a file upload")
+        if not is_file and name in files:
+            raise SchemaError(f"{name} must not be a file upload")
+
+        if name in files:
+            kwargs[name] = files[name]
+        elif name in fields:
+            kwargs[name] = coerce(name, argument, fields[name])
+        elif argument["required"]:
+            raise SchemaError(f"{name} is required")
+
+    return kwargs
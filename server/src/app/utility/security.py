@@ -1,22 +1,21 @@
 from functools import wraps
+import asyncio
 import random
 import time
 
 
+# pads the response time to a random delay without blocking the event loop
 def constant_time_with_random_delay(min_delay: float, max_delay: float):
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            start_time = time.time()
-            result = await func(*args, **kwargs)
-            elapsed_time = time.time() - start_time
-
-            random_delay = random.uniform(min_delay, max_delay)
-            remaining_time = random_delay + elapsed_time
-
-            time.sleep(remaining_time + random_delay)
-
-            return result
+            start_time = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed_time = time.monotonic() - start_time
+                random_delay = random.uniform(min_delay, max_delay)
+                await asyncio.sleep(max(0, random_delay - elapsed_time))
 
         return wrapper
 
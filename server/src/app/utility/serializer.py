@@ -1,10 +1,98 @@
+from dataclasses import dataclass
 from pathlib import Path, PosixPath
-from typing import Any
+from typing import Any, Optional
+import base64
+import mmap
+import stat
 import json
 import io
+import os
 
 from app import logger
 
+# result format, keep in sync with sandbox/serializer.py
+# version 1 is plain json, version 2 wraps the tree in an envelope and writes
+# bytes and arrays above SIDE_FILE_BYTES as raw side files next to the result
+FORMAT_VERSION = 2
+SIDE_FILE_BYTES = 1 << 16
+
+# numpy dtype strings the server can read without numpy, as memoryview formats
+MEMORYVIEW_FORMATS = {
+    "b1": "?",
+    "i1": "b",
+    "u1": "B",
+    "i2": "h",
+    "u2": "H",
+    "i4": "i",
+    "u4": "I",
+    "i8": "q",
+    "u8": "Q",
+    "f4": "f",
+    "f8": "d",
+}
+
+
+# a side file written by the sandbox, the data is mapped on demand and never parsed
+@dataclass(frozen=True)
+class BinaryRef:
+    path: Any
+    kind: str
+    dtype: str
+    shape: tuple[int, ...]
+
+    @property
+    def format(self) -> Optional[str]:
+        if self.dtype[0] == ">":
+            return None
+        return MEMORYVIEW_FORMATS.get(self.dtype[1:])
+
+    def open(self, directory: Path) -> Optional[int]:
+        # the path comes from the tool, only regular files inside its job directory are read
+        try:
+            path = Path(self.path).resolve(strict=True)
+            if not path.is_relative_to(directory.resolve()):
+                return None
+            # without O_NONBLOCK opening a fifo would wait for a writer
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        except (OSError, TypeError, ValueError, RuntimeError):
+            return None
+
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            os.close(fd)
+            return None
+        return fd
+
+    def view(self, directory: Path) -> Optional[memoryview]:
+        fd = self.open(directory)
+        if fd is None:
+            return None
+
+        with open(fd, "rb") as f:
+            if f.seek(0, io.SEEK_END) == 0:
+                return memoryview(b"")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(data)
+        return view.cast(self.format) if self.format else view
+
+    def head(self, count: int, directory: Path) -> Optional[list]:
+        # None when the file can not be read, a truncated file does not cast to its dtype
+        if self.format is None:
+            return []
+        try:
+            view = self.view(directory)
+            return None if view is None else view[:count].tolist()
+        except (OSError, TypeError, ValueError):
+            return None
+
+    def summary(self) -> str:
+        shape = "x".join(map(str, self.shape))
+        return f"{self.kind} {self.dtype} {shape}"
+
+    def __repr__(self) -> str:
+        # not the generated one, the pretty printer would print the fields instead of calling format
+        return f"BinaryRef({self.path!r}, {self.summary()!r})"
+
 
 class JsonEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -14,6 +102,13 @@ class JsonEncoder(json.JSONEncoder):
         if isinstance(obj, (Path, PosixPath)):
             return {"__path__": str(obj.absolute())}
 
+        if isinstance(obj, (bytes, bytearray)):
+            return {"__bytes__": base64.b64encode(obj).decode()}
+
+        if isinstance(obj, BinaryRef):
+            binary = {"path": obj.path, "kind": obj.kind, "dtype": obj.dtype, "shape": list(obj.shape)}
+            return {"__binary__": binary}
+
         return super().default(obj)
 
 
@@ -24,20 +119,42 @@ class JsonDecoder(json.JSONDecoder):
     def object_hook(self, obj):
         if "__path__" in obj:
             return Path(obj["__path__"])
+        if "__bytes__" in obj:
+            return base64.b64decode(obj["__bytes__"])
+        if "__binary__" in obj:
+            binary = obj["__binary__"]
+            return BinaryRef(binary["path"], binary["kind"], binary["dtype"], tuple(binary["shape"]))
+        if "__dataframe__" in obj:
+            return obj["__dataframe__"]
+        if "__series__" in obj:
+            return obj["__series__"]
         return obj
 
 
+def envelope(objects: Any) -> dict:
+    return {"__format__": FORMAT_VERSION, "result": objects}
+
+
+def unwrap(objects: Any) -> Any:
+    if not isinstance(objects, dict) or "__format__" not in objects:
+        return objects
+    if objects["__format__"] > FORMAT_VERSION:
+        raise ValueError(f"unsupported result format {objects['__format__']}")
+    return objects["result"]
+
+
 def dumps(objects: Any) -> str:
-    return json.dumps(objects, cls=JsonEncoder)
+    return json.dumps(envelope(objects), cls=JsonEncoder)
 
 
 def loads(serial: str) -> Any:
-    return json.loads(serial, cls=JsonDecoder)
+    return unwrap(json.loads(serial, cls=JsonDecoder))
 
 
 def dump(objects: Any, file: io.FileIO) -> str:
-    json.dump(objects, file, cls=JsonEncoder)
+    # dumps takes the c encoder, dump would fall back to the pure python one
+    file.write(json.dumps(envelope(objects), cls=JsonEncoder))
 
 
 def load(file: io.FileIO) -> Any:
-    return json.load(file, cls=JsonDecoder)
+    return unwrap(json.load(file, cls=JsonDecoder))
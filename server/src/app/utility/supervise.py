@@ -0,0 +1,79 @@
+import subprocess
+import argparse
+import ctypes
+import resource
+import signal
+import time
+import sys
+import os
+
+# runs one sandbox command for the namespace and subprocess backends, started as
+# `python -I -S supervise.py` so it only loads the standard library and starts in milliseconds
+# applies rlimits, joins the box cgroup, enforces the wall time and writes the resource
+# usage of the whole process tree in the isolate --meta format
+PR_SET_PDEATHSIG = 1
+
+
+def limits(args: argparse.Namespace):
+    # runs in the child between fork and exec, the run dies with its supervisor
+    ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    if args.cgroup:
+        with open(os.path.join(args.cgroup, "cgroup.procs"), "w") as f:
+            f.write("0")
+    if args.mem:
+        resource.setrlimit(resource.RLIMIT_AS, (args.mem * 1024,) * 2)
+    if args.cpu:
+        resource.setrlimit(resource.RLIMIT_CPU, (args.cpu, args.cpu))
+    if args.fsize:
+        resource.setrlimit(resource.RLIMIT_FSIZE, (args.fsize * 1024,) * 2)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (args.files, args.files))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--meta", type=str, default=None)
+    parser.add_argument("--wall-time", type=float, default=None)
+    parser.add_argument("--mem", type=int, default=None, help="address space in KiB")
+    parser.add_argument("--cpu", type=int, default=None, help="cpu seconds")
+    parser.add_argument("--fsize", type=int, default=None, help="largest written file in KiB")
+    parser.add_argument("--files", type=int, default=1024)
+    parser.add_argument("--cgroup", type=str, default=None)
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+
+    start = time.monotonic()
+    meta = {}
+    process = subprocess.Popen(command, preexec_fn=lambda: limits(args), start_new_session=True)
+    # a stopped server must not leave runs behind
+    signal.signal(signal.SIGTERM, lambda *_: os.killpg(process.pid, signal.SIGKILL))
+
+    try:
+        code = process.wait(args.wall_time)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        code = process.wait()
+        meta["status"] = "TO"
+
+    # the only child, its usage includes every process of the run it waited for
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    meta["time"] = f"{usage.ru_utime + usage.ru_stime:.3f}"
+    meta["time-wall"] = f"{time.monotonic() - start:.3f}"
+    meta["max-rss"] = str(usage.ru_maxrss)
+    if code < 0:
+        meta["exitsig"] = str(-code)
+        meta.setdefault("status", "SG")
+    else:
+        meta["exitcode"] = str(code)
+        if code:
+            meta.setdefault("status", "RE")
+
+    if args.meta:
+        with open(args.meta, "w") as f:
+            f.writelines(f"{key}:{value}\n" for key, value in meta.items())
+    sys.exit(0 if "status" not in meta else 1)
+
+
+if __name__ == "__main__":
+    main()
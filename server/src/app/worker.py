@@ -0,0 +1,161 @@
+from dataclasses import asdict
+from pathlib import Path
+from typing import Optional
+import requests
+import argparse
+import logging
+import asyncio
+import socket
+import shutil
+import json
+import stat
+import os
+
+from app.utility import archive, sandbox
+from app import ENVIRONMENT, SETTINGS, logger
+
+# a worker node runs sandbox jobs for a server, see routes/workers.py for the other side
+# every box has its own loop: poll for a job, receive the job directory, run it, send back
+# what the run wrote. job directories live under root, boxes see them at the server's paths
+
+
+class WorkerClient:
+    def __init__(self, server: str, token: str, name: str, lanes: tuple[str, ...], wait: float):
+        self.server = server.rstrip("/")
+        self.name = name
+        self.lanes = lanes
+        self.wait = wait
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        # heartbeats are sent from another thread while the run's result is uploaded, sessions are not thread safe
+        self.heartbeats = requests.Session()
+        self.heartbeats.headers["Authorization"] = f"Bearer {token}"
+
+    def url(self, path: str) -> str:
+        return f"{self.server}{path}"
+
+    def lease(self, root: Path) -> Optional[dict]:
+        params = {"worker": self.name, "lanes": ",".join(self.lanes), "wait": self.wait}
+        timeout = (10, self.wait + 30)
+        with self.session.post(self.url("/worker/lease"), params=params, stream=True, timeout=timeout) as r:
+            if r.status_code == 204:
+                return None
+            r.raise_for_status()
+
+            job = {
+                "id": r.headers["X-Job"],
+                "tool": Path(r.headers["X-Tool"]),
+                "workdir": Path(r.headers["X-Workdir"]),
+                "mount": Path(r.headers["X-Mount"]),
+                "items": int(r.headers["X-Items"]),
+                "wall_time": int(r.headers["X-Wall-Time"]),
+            }
+            local = local_path(root, job["mount"])
+            archive.box_directories(local, local)
+            archive.read_tar(r.raw, local, SETTINGS.JOBS_QUOTA_BYTES)
+            return job
+
+    def heartbeat(self):
+        self.heartbeats.post(self.url("/worker/heartbeat"), params={"worker": self.name}, timeout=10)
+
+    def result(self, job: dict, stats: sandbox.RunStats, local: Path, names: list[str]):
+        headers = {"X-Run-Stats": json.dumps(asdict(stats)), "Content-Type": "application/x-tar"}
+        params = {"worker": self.name}
+        data = archive.iter_tar(local, names)
+        url = self.url(f"/worker/result/{job['id']}")
+        r = self.session.post(url, params=params, data=data, headers=headers, timeout=60)
+        if r.status_code == 404:
+            logger.info(f"job {job['id']} was given up by the server")
+            return
+        r.raise_for_status()
+
+
+def local_path(root: Path, path: Path) -> Path:
+    return root / path.relative_to("/")
+
+
+async def heartbeat(client: WorkerClient, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(client.heartbeat)
+        except requests.RequestException as e:
+            logger.error(f"heartbeat failed: {e!r}")
+
+
+async def serve(pool: sandbox.IsolationWorkers, client: WorkerClient, root: Path, interval: float):
+    while True:
+        try:
+            job = await asyncio.to_thread(client.lease, root)
+        except (requests.RequestException, archive.ArchiveError, OSError) as e:
+            logger.error(f"lease failed: {e!r}")
+            await asyncio.sleep(interval)
+            continue
+
+        if job is None:
+            continue
+
+        local = local_path(root, job["mount"])
+        try:
+            before = await asyncio.to_thread(archive.snapshot, local)
+
+            # heartbeats keep the job ours while it runs longer than the server timeout
+            beating = asyncio.create_task(heartbeat(client, interval))
+            try:
+                # the server already gave a batch the wall time of all its items
+                stats = await pool.run(
+                    job["tool"], job["workdir"], job["items"], mount=job["mount"], wall_time=job["wall_time"]
+                )
+            finally:
+                beating.cancel()
+
+            after = await asyncio.to_thread(archive.snapshot, local)
+            changed = [name for name, state in after.items() if before.get(name) != state]
+            await asyncio.to_thread(client.result, job, stats, local, changed)
+        except (requests.RequestException, archive.ArchiveError, OSError) as e:
+            logger.error(f"job {job['id']} failed: {e!r}")
+        finally:
+            await asyncio.to_thread(shutil.rmtree, local, ignore_errors=True)
+
+
+async def work(args: argparse.Namespace):
+    root = Path(args.root).absolute()
+    # like on the server, job directories are reachable by name but can not be listed from a box
+    jobs_directory = local_path(root, SETTINGS.JOBS_DIRECTORY)
+    jobs_directory.mkdir(parents=True, exist_ok=True)
+    os.chmod(jobs_directory, stat.S_IRWXU | stat.S_IXGRP | stat.S_IXOTH)
+
+    pool = sandbox.IsolationWorkers(workers=args.boxes, lanes=(), root=root, first_box=args.first_box)
+    await pool.start()
+
+    lanes = tuple(lane for lane in args.lanes.split(",") if lane)
+    interval = max(1.0, SETTINGS.WORKER_TIMEOUT / 3)
+    clients = [WorkerClient(args.server, args.token, args.name, lanes, args.wait) for _ in range(args.boxes)]
+    try:
+        await asyncio.gather(*(serve(pool, client, root, interval) for client in clients))
+    finally:
+        await pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run sandbox jobs for a PyTools server")
+    parser.add_argument("--server", "-s", type=str, required=True)
+    parser.add_argument("--token", "-t", type=str, default=os.environ.get("WORKER_TOKEN", ""))
+    parser.add_argument("--name", "-n", type=str, default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--boxes", "-b", type=int, default=SETTINGS.POOL_SIZE)
+    parser.add_argument("--first-box", type=int, default=0)
+    parser.add_argument("--lanes", "-l", type=str, default="interactive,heavy,batch")
+    parser.add_argument("--root", "-r", type=str, default="/tmp/pytools-worker")
+    parser.add_argument("--wait", type=float, default=20)
+    args = parser.parse_args()
+
+    if not args.token:
+        parser.error("--token or WORKER_TOKEN is required")
+    ENVIRONMENT.check("SANDBOX")
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(work(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,493 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+from pathlib import Path
+import subprocess
+import platform
+import argparse
+import requests
+import tempfile
+import sqlite3
+import random
+import socket
+import shutil
+import json
+import time
+import sys
+import os
+
+# end to end load benchmark: the server runs against a throwaway database seeded with tools/
+# and the fake isolate (or another sandbox backend), mixed workloads run concurrently for a fixed time, the results are
+# written as json that `compare` checks against the results of another commit
+REPO = Path(__file__).resolve().parents[2]
+SERVER_SOURCE = REPO / "server" / "src"
+SANDBOX_SOURCE = REPO / "sandbox" / "src"
+FAKE_ISOLATE = Path(__file__).resolve().parent / "fake_isolate.py"
+
+DEFAULT_MIX = "tool=4,page=3,text=2,convert=2,job=2,batch=1,pipeline=1"
+PAYLOAD = b"benchmark payload\n" * 256
+PHASES = ("queue_wait", "init", "run", "cleanup", "cpu")
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class Sample:
+    workload: str
+    start: float
+    latency: float
+    ok: bool
+    status: int
+    phases: dict[str, float] = field(default_factory=dict)
+
+
+class Client:
+    def __init__(self, base: str, tools: dict[str, int]):
+        self.base = base
+        self.tools = tools
+        self.session = requests.Session()
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.session.post(f"{self.base}{path}", timeout=120, **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.session.get(f"{self.base}{path}", timeout=120, **kwargs)
+
+
+# each workload returns the response status and client side phases in seconds
+def tool_run(client: Client) -> tuple[int, dict]:
+    files = {"file": ("payload.txt", PAYLOAD)}
+    return client.post(f"/tool/{client.tools['sha256']}", data={"hash": "sha256"}, files=files).status_code, {}
+
+
+def tool_page(client: Client) -> tuple[int, dict]:
+    return client.get(f"/tool/{client.tools['sha256']}").status_code, {}
+
+
+def text_run(client: Client) -> tuple[int, dict]:
+    files = {"input": ("payload.txt", PAYLOAD)}
+    headers = {"HX-Request": "true"}
+    return client.post(f"/tool/{client.tools['lower_case_text']}", files=files, headers=headers).status_code, {}
+
+
+def convert_run(client: Client) -> tuple[int, dict]:
+    data = {"input": "benchmark", "output": "hexadecimal"}
+    return client.post(f"/tool/{client.tools['byte_converter']}", data=data).status_code, {}
+
+
+def job_run(client: Client) -> tuple[int, dict]:
+    start = time.monotonic()
+    files = {"file": ("payload.txt", PAYLOAD)}
+    r = client.post(f"/job/tool/{client.tools['sha256']}", data={"hash": "md5"}, files=files)
+    submitted = time.monotonic()
+    if r.status_code != 202:
+        return r.status_code, {}
+
+    job = r.json()
+    while job["status"] not in ("done", "failed"):
+        time.sleep(0.05)
+        r = client.get(f"/job/{job['id']}")
+        if r.status_code != 200:
+            return r.status_code, {}
+        job = r.json()
+
+    phases = {"submit": submitted - start, "complete": time.monotonic() - submitted}
+    return (200 if job["status"] == "done" else 500), phases
+
+
+def batch_run(client: Client) -> tuple[int, dict]:
+    items = [{"hash": name} for name in ("md5", "sha1", "sha256", "sha512")]
+    files = {f"{index}.file": ("payload.txt", PAYLOAD) for index in range(len(items))}
+    url = f"/batch/tool/{client.tools['sha256']}"
+    return client.post(url, data={"items": json.dumps(items)}, files=files).status_code, {}
+
+
+def pipeline_run(client: Client) -> tuple[int, dict]:
+    steps = [
+        {"tool": client.tools["lower_case_text"]},
+        {"tool": client.tools["sha256"], "args": {"hash": "sha256"}, "map": {"file": "0"}},
+    ]
+    files = {"0.input": ("payload.txt", PAYLOAD)}
+    return client.post("/pipeline", data={"steps": json.dumps(steps)}, files=files).status_code, {}
+
+
+WORKLOADS: dict[str, Callable[[Client], tuple[int, dict]]] = {
+    "tool": tool_run,
+    "page": tool_page,
+    "text": text_run,
+    "convert": convert_run,
+    "job": job_run,
+    "batch": batch_run,
+    "pipeline": pipeline_run,
+}
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in filter(None, mix.split(",")):
+        name, _, weight = part.partition("=")
+        if name not in WORKLOADS:
+            raise SystemExit(f"unknown workload {name}, one of {', '.join(WORKLOADS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_revision() -> dict:
+    def git(*args: str) -> str:
+        result = subprocess.run(["git", *args], cwd=REPO, capture_output=True, text=True)
+        return result.stdout.strip()
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def prepare(workdir: Path, args: argparse.Namespace) -> dict[str, str]:
+    # namespace boxes run as their own uid, they reach the sandbox and their scratch directory through workdir
+    workdir.chmod(0o755)
+
+    # the sandbox venv is this interpreter with the sandbox package on its path
+    sandbox = workdir / "sandbox"
+    (sandbox / "bin").mkdir(parents=True)
+    (sandbox / "bin" / "python").symlink_to(sys.executable)
+    (sandbox / "bin" / "sandbox").write_text(
+        f"import sys\nsys.path.insert(0, {str(SANDBOX_SOURCE)!r})\nfrom sandbox.runner import main\nmain()\n"
+    )
+
+    bin = workdir / "bin"
+    bin.mkdir()
+    isolate = bin / "isolate"
+    isolate.write_text(f'#!/bin/sh\nexec {sys.executable} {FAKE_ISOLATE} "$@"\n')
+    isolate.chmod(0o755)
+
+    return {
+        **os.environ,
+        "SESSION_KEY": "benchmark",
+        "GOOGLE_CLIENT_ID": "benchmark",
+        "GOOGLE_CLIENT_SECRET": "benchmark",
+        "GOOGLE_REDIRECT_URI": "http://localhost/auth/google",
+        "DATABASE": str(workdir / "benchmark.db"),
+        "SANDBOX": str(sandbox),
+        "PATH": f"{bin}:{os.environ.get('PATH', '')}",
+        "PYTHONPATH": str(SERVER_SOURCE),
+        "FAKE_ISOLATE_ROOT": str(workdir / "boxes"),
+        "SANDBOX_BACKEND": args.backend,
+        # the benchmark tools are trusted, the subprocess backend may be measured too
+        "SANDBOX_UNISOLATED": "1",
+        "SANDBOX_DIRECTORY": str(workdir / "boxes"),
+        "JOBS_DIRECTORY": str(workdir / "jobs"),
+        "STATE_DIRECTORY": str(workdir / "state"),
+        "RESULT_CACHE_DIRECTORY": str(workdir / "cache"),
+        "POOL_SIZE": str(args.pool_size),
+        "WEB_WORKERS": str(args.web_workers),
+        "POOL_MAX_QUEUE": str(args.max_queue),
+        "COUNTER_FLUSH_INTERVAL": "1",
+        "WORKER_TOKEN": "",
+    }
+
+
+def seed(env: dict[str, str]) -> dict[str, int]:
+    # the app reads its settings at import, this process only ever talks to the benchmark db
+    os.environ.update(env)
+    sys.path.insert(0, str(SERVER_SOURCE))
+    from sqlmodel import Session
+    from app.models import tools as db_tools
+
+    db_tools.create_db_and_tables()
+    tools = {}
+    with Session(db_tools.engine) as session:
+        user = db_tools.get_user(session, 1)
+        for path in sorted((REPO / "tools").glob("*.py")):
+            tool = db_tools.create_tool(user.id, path.stem, path.read_text())
+            tool.public = True
+            db_tools.add_tool(session, tool)
+            tools[path.stem] = tool.id
+    return tools
+
+
+def start_server(env: dict[str, str], port: int, workdir: Path, args: argparse.Namespace) -> subprocess.Popen:
+    log = open(workdir / "server.log", "wb")
+    command = [sys.executable, "-m", "uvicorn", "app.app:app", "--port", str(port), "--workers", str(args.web_workers)]
+    server = subprocess.Popen(command, cwd=SERVER_SOURCE, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    # every process of the server warms its boxes, ready once the status sees a full pool
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"server exited with {server.returncode}, see {workdir / 'server.log'}")
+        try:
+            status = requests.get(f"http://127.0.0.1:{port}/status/sandbox", timeout=1).json()
+            if status["ready"] >= status["size"]:
+                return server
+        except (requests.RequestException, ValueError, KeyError):
+            pass
+        time.sleep(0.2)
+
+    server.kill()
+    raise SystemExit(f"server not ready after {args.startup_timeout}s, see {workdir / 'server.log'}")
+
+
+def stop_server(server: subprocess.Popen):
+    # a clean shutdown flushes the pending run records
+    server.terminate()
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def drive(base: str, tools: dict[str, int], weights: dict[str, float], args: argparse.Namespace) -> list[Sample]:
+    # closed loop: every client sends its next request as soon as the last one returned
+    start = time.monotonic()
+    measure = start + args.warmup
+    end = measure + args.duration
+
+    def client_loop(index: int) -> list[Sample]:
+        rng = random.Random(args.seed + index)
+        client = Client(base, tools)
+        names, choices = list(weights), list(weights.values())
+        samples = []
+        while (now := time.monotonic()) < end:
+            name = rng.choices(names, choices)[0]
+            try:
+                status, phases = WORKLOADS[name](client)
+            except requests.RequestException:
+                status, phases = 0, {}
+            finished = time.monotonic()
+            if now >= measure and finished <= end:
+                samples.append(Sample(name, now, finished - now, 200 <= status < 300, status, phases))
+        return samples
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        return [sample for samples in pool.map(client_loop, range(args.concurrency)) for sample in samples]
+
+
+def percentile(values: list[float], p: float) -> Optional[float]:
+    # linear interpolation between closest ranks
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def distribution(values: list[float]) -> dict:
+    result = {f"p{p}": percentile(values, p) for p in PERCENTILES}
+    result["mean"] = sum(values) / len(values) if values else None
+    result["max"] = max(values) if values else None
+    return result
+
+
+def summarize(samples: list[Sample], duration: float) -> dict:
+    workloads = {}
+    for name in sorted({sample.workload for sample in samples}):
+        selected = [sample for sample in samples if sample.workload == name]
+        ok = [sample for sample in selected if sample.ok]
+        statuses: dict[str, int] = {}
+        for sample in selected:
+            statuses[str(sample.status)] = statuses.get(str(sample.status), 0) + 1
+
+        phases = sorted({phase for sample in ok for phase in sample.phases})
+        workloads[name] = {
+            "requests": len(selected),
+            "errors": len(selected) - len(ok),
+            "statuses": statuses,
+            "throughput": len(ok) / duration,
+            "latency": distribution([sample.latency for sample in ok]),
+            "phases": {phase: distribution([s.phases[phase] for s in ok if phase in s.phases]) for phase in phases},
+        }
+
+    ok = [sample for sample in samples if sample.ok]
+    total = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "throughput": len(ok) / duration,
+        "latency": distribution([sample.latency for sample in ok]),
+    }
+    return {"total": total, "workloads": workloads}
+
+
+def sandbox_phases(database: Path, since: float) -> dict:
+    # the server records every sandbox run with its queue wait, init, run, cleanup and cpu time
+    connection = sqlite3.connect(database)
+    try:
+        rows = connection.execute(
+            "SELECT tool.name, runrecord.queue_wait, runrecord.init, runrecord.run, runrecord.cleanup, runrecord.cpu, "
+            "runrecord.status FROM runrecord JOIN tool ON tool.id = runrecord.tool_id WHERE runrecord.created >= ?",
+            (since,),
+        ).fetchall()
+    finally:
+        connection.close()
+
+    tools: dict[str, list[tuple]] = {}
+    for row in rows:
+        tools.setdefault(row[0], []).append(row[1:])
+
+    def phases(runs: list[tuple]) -> dict:
+        result = {"runs": len(runs), "failed": sum(run[-1] != "OK" for run in runs)}
+        for index, phase in enumerate(PHASES):
+            result[phase] = distribution([run[index] for run in runs if run[index] is not None])
+        return result
+
+    return {"total": phases([row[1:] for row in rows]), "tools": {name: phases(runs) for name, runs in tools.items()}}
+
+
+def run(args: argparse.Namespace):
+    weights = parse_mix(args.mix)
+    workdir = Path(tempfile.mkdtemp(prefix="pytools-benchmark-"))
+    print(f"workdir {workdir}", file=sys.stderr)
+
+    try:
+        env = prepare(workdir, args)
+        tools = seed(env)
+        port = free_port()
+        server = start_server(env, port, workdir, args)
+        base = f"http://127.0.0.1:{port}"
+
+        started = time.time()
+        try:
+            samples = drive(base, tools, weights, args)
+            status = requests.get(f"{base}/status/sandbox", timeout=10).json()
+        finally:
+            stop_server(server)
+
+        results = {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "config": {
+                "mix": weights,
+                "concurrency": args.concurrency,
+                "duration": args.duration,
+                "warmup": args.warmup,
+                "seed": args.seed,
+                "pool_size": args.pool_size,
+                "web_workers": args.web_workers,
+                "max_queue": args.max_queue,
+                "backend": args.backend,
+            },
+            **summarize(samples, args.duration),
+            "sandbox": sandbox_phases(workdir / "benchmark.db", started + args.warmup),
+            "server": {"recycle": status.get("recycle"), "jobs": status.get("jobs"), "runs": status.get("runs")},
+        }
+    finally:
+        if args.keep:
+            print(f"kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = Path(args.output or f"benchmark-{results['revision']['commit'][:10] or 'unknown'}.json")
+    output.write_text(json.dumps(results, indent=2))
+    print_summary(results)
+    print(f"results written to {output}")
+
+    if args.baseline:
+        sys.exit(compare_files(Path(args.baseline), output, args.threshold))
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+def print_summary(results: dict):
+    print(f"{'workload':<10} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for name, workload in [*results["workloads"].items(), ("total", results["total"])]:
+        latency = workload["latency"]
+        print(
+            f"{name:<10} {workload['requests']:>8} {workload['errors']:>6} {workload['throughput']:>8.1f} "
+            f"{format_seconds(latency['p50']):>10} {format_seconds(latency['p95']):>10} "
+            f"{format_seconds(latency['p99']):>10}"
+        )
+
+    sandbox = results["sandbox"]["total"]
+    print(f"\nsandbox runs {sandbox['runs']}, failed {sandbox['failed']}")
+    for phase in PHASES:
+        values = sandbox[phase]
+        print(f"{phase:<10} p50 {format_seconds(values['p50']):>10} p95 {format_seconds(values['p95']):>10}")
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    # latency may grow and throughput may drop by threshold before it counts as a regression
+    regressions = []
+    names = sorted(set(baseline["workloads"]) & set(current["workloads"])) + ["total"]
+    print(f"{'workload':<10} {'metric':<10} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name in names:
+        old = baseline["total"] if name == "total" else baseline["workloads"][name]
+        new = current["total"] if name == "total" else current["workloads"][name]
+
+        metrics = [(f"p{p}", old["latency"][f"p{p}"], new["latency"][f"p{p}"], True) for p in PERCENTILES]
+        metrics.append(("req/s", old["throughput"], new["throughput"], False))
+        for metric, before, after, lower_is_better in metrics:
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = change > threshold if lower_is_better else change < -threshold
+            flag = "  REGRESSION" if regressed else ""
+            if metric == "req/s":
+                print(f"{name:<10} {metric:<10} {before:>10.1f} {after:>10.1f} {change:>+8.1%}{flag}")
+            else:
+                before, after = format_seconds(before), format_seconds(after)
+                print(f"{name:<10} {metric:<10} {before:>10} {after:>10} {change:>+8.1%}{flag}")
+            # p99 of a short run is a handful of requests, only p50, p95 and throughput fail the check
+            if regressed and metric != "p99":
+                regressions.append(f"{name} {metric} {change:+.1%}")
+    return regressions
+
+
+def compare_files(baseline: Path, current: Path, threshold: float) -> int:
+    old, new = json.loads(baseline.read_text()), json.loads(current.read_text())
+    print(f"baseline {old['revision']['commit'][:10]}, current {new['revision']['commit'][:10]}")
+    if old["config"] != new["config"]:
+        print("warning: the runs used different configurations")
+
+    regressions = compare(old, new, threshold)
+    if regressions:
+        print(f"{len(regressions)} regressions over {threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end to end load benchmark for the PyTools server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="start a throwaway server and measure it")
+    run_parser.add_argument(
+        "--mix", type=str, default=DEFAULT_MIX, help=f"workload weights, from {', '.join(WORKLOADS)}"
+    )
+    run_parser.add_argument("--concurrency", "-c", type=int, default=8)
+    run_parser.add_argument("--duration", "-d", type=float, default=30)
+    run_parser.add_argument("--warmup", type=float, default=5)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--pool-size", type=int, default=4)
+    run_parser.add_argument("--web-workers", type=int, default=1)
+    run_parser.add_argument("--max-queue", type=int, default=100)
+    run_parser.add_argument(
+        "--backend", type=str, default="isolate", help="sandbox backend, isolate runs the fake isolate"
+    )
+    run_parser.add_argument("--startup-timeout", type=float, default=60)
+    run_parser.add_argument("--output", "-o", type=str, default=None)
+    run_parser.add_argument("--baseline", "-b", type=str, default=None, help="results to compare against")
+    run_parser.add_argument("--threshold", type=float, default=0.15)
+    run_parser.add_argument("--keep", action="store_true", help="keep the work directory and server log")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline", type=str)
+    compare_parser.add_argument("current", type=str)
+    compare_parser.add_argument("--threshold", type=float, default=0.15)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare_files(Path(args.baseline), Path(args.current), args.threshold))
+
+
+if __name__ == "__main__":
+    main()
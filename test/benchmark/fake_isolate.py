@@ -0,0 +1,127 @@
+import subprocess
+import resource
+import signal
+import shutil
+import time
+import sys
+import os
+from pathlib import Path
+
+# stand-in for isolate on machines without it, benchmark.py puts it on PATH as "isolate"
+# boxes are plain directories and runs are local processes under rlimits, there are no
+# namespaces or cgroups: it measures the server around the sandbox, not the isolation
+ROOT = Path(os.environ.get("FAKE_ISOLATE_ROOT", "/tmp/fake-isolate"))
+
+
+def parse(argv: list[str]) -> tuple[dict, list[str]]:
+    options = {"dirs": {}, "env": {}, "action": None}
+    args = iter(argv)
+    for arg in args:
+        if arg == "--":
+            return options, list(args)
+
+        name, _, value = arg.partition("=")
+        if name in ("--init", "--cleanup", "--run"):
+            options["action"] = name[2:]
+        elif name == "--env":
+            key, _, env = (value or next(args)).partition("=")
+            options["env"][key] = env
+        elif name == "--dir":
+            # --dir=inside=outside, --dir=path or --dir=inside= for an empty directory
+            inside, _, outside = value.split(":")[0].partition("=")
+            options["dirs"][inside.rstrip("/")] = outside if "=" in value else inside
+        else:
+            options[name.lstrip("-")] = value
+    return options, []
+
+
+def box_path(options: dict) -> Path:
+    return ROOT / options.get("box-id", "0") / "box"
+
+
+def outside(path: str, options: dict) -> str:
+    for inside, target in options["dirs"].items():
+        if target and (path == inside or path.startswith(inside + "/")):
+            return target.rstrip("/") + path[len(inside) :]
+    if path == "/box" or path.startswith("/box/"):
+        return str(box_path(options)) + path[len("/box") :]
+    return path
+
+
+def limits(options: dict):
+    # isolate sizes are in kilobytes
+    memory = options.get("mem") or options.get("cg-mem")
+    if memory:
+        resource.setrlimit(resource.RLIMIT_AS, (int(memory) * 1024,) * 2)
+    if options.get("time"):
+        seconds = int(float(options["time"])) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds))
+    if options.get("fsize"):
+        resource.setrlimit(resource.RLIMIT_FSIZE, (int(options["fsize"]) * 1024,) * 2)
+    if options.get("open-files"):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (int(options["open-files"]),) * 2)
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def write_meta(path: str, meta: dict):
+    with open(path, "w") as f:
+        f.writelines(f"{key}:{value}\n" for key, value in meta.items())
+
+
+def run(options: dict, command: list[str]) -> int:
+    box = box_path(options)
+    box.mkdir(parents=True, exist_ok=True)
+    env = {"PATH": "/usr/local/bin:/usr/bin:/bin", **options["env"]}
+    env = {key: outside(value, options) for key, value in env.items()}
+    command = [outside(arg, options) for arg in command]
+    wall_time = float(options.get("wall-time") or 0) or None
+
+    start = time.monotonic()
+    meta = {}
+    process = subprocess.Popen(command, cwd=box, env=env, preexec_fn=lambda: limits(options), start_new_session=True)
+    try:
+        code = process.wait(wall_time)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        code = process.wait()
+        meta["status"] = "TO"
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    meta.update(
+        {
+            "time": f"{usage.ru_utime + usage.ru_stime:.3f}",
+            "time-wall": f"{time.monotonic() - start:.3f}",
+            "max-rss": usage.ru_maxrss,
+        }
+    )
+    if code < 0:
+        meta["exitsig"] = -code
+        meta.setdefault("status", "SG")
+    else:
+        meta["exitcode"] = code
+        if code:
+            meta.setdefault("status", "RE")
+
+    if options.get("meta"):
+        write_meta(options["meta"], meta)
+    return 0 if "status" not in meta else 1
+
+
+def main():
+    options, command = parse(sys.argv[1:])
+    box = box_path(options)
+
+    if options["action"] == "init":
+        shutil.rmtree(box, ignore_errors=True)
+        box.mkdir(parents=True)
+        print(box.parent)
+    elif options["action"] == "cleanup":
+        shutil.rmtree(box.parent, ignore_errors=True)
+    elif options["action"] == "run":
+        sys.exit(run(options, command))
+    else:
+        sys.exit("fake isolate: one of --init, --cleanup or --run is required")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from pathlib import Path
+import tempfile
+import unittest
+import time
+import sys
+
+SERVER_SOURCE = Path(__file__).resolve().parents[1] / "server" / "src"
+sys.path.insert(0, str(SERVER_SOURCE))
+
+from app.utility.reaper import JobReaper  # noqa: E402
+
+
+class JobReaperTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.directory = Path(self.temp.name)
+        self.reaper = JobReaper(self.directory, ttl=600, quota=0, min_free=0)
+        self.reaper.start()
+
+    async def asyncTearDown(self):
+        await self.reaper.stop()
+        self.temp.cleanup()
+
+    def expire(self):
+        # every directory is past its ttl
+        self.reaper.heap = [(time.time() - 1, name) for _, name in self.reaper.heap]
+
+    async def test_active_directory_survives_expiry(self):
+        job_dir = self.directory / "active"
+        job_dir.mkdir()
+        self.reaper.add(job_dir)
+        self.expire()
+
+        await self.reaper.sweep()
+        self.assertTrue(job_dir.exists())
+        self.assertEqual(self.reaper.expired, 0)
+
+        # released, it expires a ttl after the sweep that kept it
+        await self.reaper.release(job_dir)
+        self.expire()
+        await self.reaper.sweep()
+        self.assertFalse(job_dir.exists())
+        self.assertEqual(self.reaper.expired, 1)
+
+    async def test_retained_directory_survives_first_release(self):
+        job_dir = self.directory / "retained"
+        job_dir.mkdir()
+        self.reaper.add(job_dir)
+        self.reaper.retain(job_dir)
+        await self.reaper.release(job_dir)
+        self.expire()
+
+        await self.reaper.sweep()
+        self.assertTrue(job_dir.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,18 @@
 # cadquery
 
 from cadquery.occ_impl import shapes as occ_shapes
+from typing import Generator
 from pathlib import Path
 import cadquery as cq
 import numpy as np
 
+try:
+    from sandbox import progress
+except ImportError:
+    # the download bundle runs without the sandbox package
+    def progress(fraction: float, message: str = ""):
+        pass
+
 
 def loft_faces(f1: occ_shapes.Face, f2: occ_shapes.Face) -> occ_shapes.Solid:
     solid = cq.Solid.makeLoft([f1.outerWire(), f2.outerWire()])
@@ -138,7 +146,7 @@ def container_with_lid_sweep(
     top_ratio: float = 0.30,
     ridge_factor_top: float = 2.2,
     ridge_factor_bot: float = 2.2,
-) -> cq.Compound:
+) -> Generator[Path, None, Path]:
     width = width + thickness * 2
     depth = depth + thickness * 2
     height = height + thickness * 2 + ledge
@@ -151,6 +159,7 @@ def container_with_lid_sweep(
     ridge_top = tolerance * ridge_factor_top
     ridge_bot = tolerance * ridge_factor_bot
 
+    progress(0.0, "lower container")
     lower = container(
         width,
         depth,
@@ -164,6 +173,11 @@ def container_with_lid_sweep(
         ridge_bot,
     )
 
+    lower_path = Path("container.stl")
+    lower.exportStl(str(lower_path))
+    yield lower_path
+
+    progress(0.5, "lid")
     higher = (
         container(
             width,
@@ -181,6 +195,11 @@ def container_with_lid_sweep(
         .translate([width * 1.2, 0, 0])
     )
 
+    higher_path = Path("lid.stl")
+    higher.exportStl(str(higher_path))
+    yield higher_path
+
+    progress(0.9, "container with lid")
     compound = cq.Compound.makeCompound([lower, higher])
     compound_path = "container_with_lid.stl"
     compound.exportStl(compound_path)